@@ -3,7 +3,14 @@
 import os
 import sys
 import time
+import heapq
 import argparse
+from collections import deque
+
+# Only the numpy engine needs NumPy, which is slow to import, so that
+# waits until the engine is used
+numpy = None
+numpy_checked = False
 
 # Any letter except V is acceptable as a collector name
 collectorNames = "ABCDEFGHIJKLMNOPQRSTUWXYZ"
@@ -11,6 +18,10 @@ collectorNames = "ABCDEFGHIJKLMNOPQRSTUWXYZ"
 # Separator for decimal I/O formats
 SEPARATOR = ","
 
+# Number of binary digits a sink collects before adding them to the
+# number it is decoding (see Sink.addDigits)
+CHUNK_BITS = 4096
+
 # Magic numbers
 RAW = 0
 UNSIGNED_UNARY = 1
@@ -19,16 +30,53 @@ UNSIGNED_BINARY = 3
 SIGNED_BINARY = 4
 STEP = -1
 
+# Characters that change the state of a bit moving onto them. Arrows only
+# do so for bits not already moving their way; the rest always count,
+# including - | { } which don't act on bits but can change back to
+# devices that do
+DEVICES = "+\\/~@=-|{}"
+ARROWS = {">": (1, 0), "<": (-1, 0), "v": (0, 1), "^": (0, -1)}
+
+# Device codes for the numpy engine. Bits on FIXUP devices are handled
+# one at a time, in order, since what those devices do depends on bits
+# that reached them earlier
+PASS = 0
+GO_RIGHT = 1
+GO_LEFT = 2
+GO_DOWN = 3
+GO_UP = 4
+TURN = 5
+DUPNEG = 6
+DELETE = 7
+FIXUP = 8
+deviceCodes = {">": GO_RIGHT, "}": GO_RIGHT, "<": GO_LEFT, "{": GO_LEFT,
+               "v": GO_DOWN, "^": GO_UP, "+": TURN, "~": DUPNEG,
+               "\\": FIXUP, "/": FIXUP, "=": FIXUP, "@": FIXUP}
+arrowCodes = {GO_RIGHT: (1, 0), GO_LEFT: (-1, 0), GO_DOWN: (0, 1),
+              GO_UP: (0, -1)}
+
+
+def error(message):
+    print("Error:", message, file=sys.stderr)
+
 
 class Playfield:
-    def __init__(self, codeLines, inputs, ioFormat=RAW):
+    def __init__(self, codeLines, inputs, ioFormat=RAW, width=None):
         self.height = len(codeLines)
         self.width = max(map(len, codeLines))
         self.collectors = {}
+        # Number of bits stored in the collectors with each letter, for
+        # letters whose collectors have any
+        self.storedBits = {}
         self.openCollectors = []
         self.sources = []
         self.sinks = []
         self.activeBits = []
+        self.ticks = 0
+        # Positions of splitters and switches that need resetting when
+        # collectors next open, and how many were reset each time
+        self.changedCells = []
+        self.resetCounts = []
         self.grid = []
         for y in range(self.height):
             row = []
@@ -37,7 +85,7 @@ class Playfield:
                     char = codeLines[y][x]
                     if char.upper() in collectorNames:
                         # A letter, not v, is a collector
-                        collector = Collector(char.upper())
+                        collector = Collector(x, y, char.upper())
                         if collector.letter in self.collectors:
                             self.collectors[collector.letter].append(collector)
                         else:
@@ -47,7 +95,7 @@ class Playfield:
                         # A question mark is a source
                         if inputs:
                             data = inputs.pop(0)
-                            source = Source(x, y, data, ioFormat)
+                            source = Source(x, y, data, ioFormat, width)
                             self.sources.append(source)
                             row.append(source)
                         else:
@@ -56,7 +104,7 @@ class Playfield:
                             row.append(Source(x, y, ""))
                     elif char == "!":
                         # An exclamation point is a sink
-                        sink = Sink(x, y, ioFormat)
+                        sink = Sink(x, y, ioFormat, width)
                         self.sinks.append(sink)
                         row.append(sink)
                     elif char in "01":
@@ -68,6 +116,11 @@ class Playfield:
                         # V cannot be a collector, so treat it in either
                         # case as a downward arrow
                         row.append("v")
+                    elif char in "-|{}":
+                        # Splitters and switches that start out in their
+                        # changed states still get reset
+                        self.changedCells.append((x, y))
+                        row.append(char)
                     else:
                         row.append(char)
                 else:
@@ -84,12 +137,34 @@ class Playfield:
                          for row in displayGrid)
 
     def tick(self):
+        self.ticks += 1
+        self.activeBits.extend(self.emitBits())
+        if self.activeBits:
+            indicesToRemove = []
+            newBits = []
+            for index, bit in enumerate(self.activeBits):
+                bit.tick()
+                if self.land(bit, newBits):
+                    indicesToRemove.append(index)
+            for index in reversed(indicesToRemove):
+                # Iterate over the indices to remove from largest to smallest
+                # so that removing smaller indices doesn't modify the
+                # larger ones
+                self.activeBits.pop(index)
+            self.activeBits.extend(newBits)
+        else:
+            self.openNextCollectors()
+
+    def emitBits(self):
+        # Return the bits that sources and open collectors put into play
+        # this tick
+        outBits = []
         if self.sources:
             indicesToRemove = []
             for index, source in enumerate(self.sources):
                 outBit = source.tick()
                 if outBit:
-                    self.activeBits.append(outBit)
+                    outBits.append(outBit)
                 else:
                     # No output means that source is empty; remove it from
                     # the sources list
@@ -105,7 +180,10 @@ class Playfield:
             for index, collector in enumerate(self.openCollectors):
                 outBit = collector.tick()
                 if outBit:
-                    self.activeBits.append(outBit)
+                    outBits.append(outBit)
+                    self.storedBits[collector.letter] -= 1
+                    if not self.storedBits[collector.letter]:
+                        del self.storedBits[collector.letter]
                 else:
                     # No output means that collector is empty; deactivate it
                     collector.open = False
@@ -115,106 +193,317 @@ class Playfield:
                 # so that removing smaller indices doesn't modify the
                 # larger ones
                 self.openCollectors.pop(index)
-                    
-        if self.activeBits:
-            indicesToRemove = []
-            newBits = []
-            for index, bit in enumerate(self.activeBits):
-                bit.tick()
-                if 0 <= bit.x < self.width and 0 <= bit.y < self.height:
-                    device = self.grid[bit.y][bit.x]
-                    if type(device) is Source:
-                        # Bits that hit sources are deleted
-                        indicesToRemove.append(index)
-                    elif type(device) is Collector:
-                        # Add the bit to the collector's queue
-                        device.enqueue(bit)
-                        indicesToRemove.append(index)
-                    elif type(device) is Sink:
-                        device.enqueue(bit)
-                        indicesToRemove.append(index)
-                    elif device in [">", "}"]:
-                        bit.dx, bit.dy = 1, 0
-                    elif device in ["<", "{"]:
-                        bit.dx, bit.dy = -1, 0
-                    elif device == "v":
-                        bit.dx, bit.dy = 0, 1
-                    elif device == "^":
-                        bit.dx, bit.dy = 0, -1
-                    elif device == "+":
-                        # Turn right if bit is 1, left if 0
-                        if bit.value == 1:
-                            bit.dx, bit.dy = -bit.dy, bit.dx
-                        elif bit.value == 0:
-                            bit.dx, bit.dy = bit.dy, -bit.dx
-                    elif device == "\\":
-                        # Reflect bit and change mirror to inactive state
-                        bit.dx, bit.dy = bit.dy, bit.dx
-                        self.grid[bit.y][bit.x] = "-"
-                    elif device == "/":
-                        # Reflect bit and change mirror to inactive state
-                        bit.dx, bit.dy = -bit.dy, -bit.dx
-                        self.grid[bit.y][bit.x] = "|"
-                    elif device == "~":
-                        # Turn original bit right, create new one with
-                        # opposite value going opposite direction
-                        bit.dx, bit.dy = -bit.dy, bit.dx
-                        newBits.append(Bit(bit.x, bit.y, 1 - bit.value,
-                                           -bit.dx, -bit.dy))
-                    elif device == "@":
-                        # Terminate immediately
-                        raise StopIteration
-                    elif device == "=":
-                        # Pass this bit straight through, but change to
-                        # one of {} based on this bit's value
-                        if bit.value == 1:
-                            self.grid[bit.y][bit.x] = "}"
-                        elif bit.value == 0:
-                            self.grid[bit.y][bit.x] = "{"
+        return outBits
+
+    def land(self, bit, newBits):
+        # Apply the device at the bit's new position to it; return True
+        # if the bit is removed from play. New bits go in newBits
+        if 0 <= bit.x < self.width and 0 <= bit.y < self.height:
+            device = self.grid[bit.y][bit.x]
+            if type(device) is Source:
+                # Bits that hit sources are deleted
+                return True
+            elif type(device) is Collector:
+                # Add the bit to the collector's queue
+                device.enqueue(bit)
+                self.storedBits[device.letter] = (
+                    self.storedBits.get(device.letter, 0) + 1)
+                return True
+            elif type(device) is Sink:
+                device.enqueue(bit)
+                return True
+            elif device in [">", "}"]:
+                bit.dx, bit.dy = 1, 0
+            elif device in ["<", "{"]:
+                bit.dx, bit.dy = -1, 0
+            elif device == "v":
+                bit.dx, bit.dy = 0, 1
+            elif device == "^":
+                bit.dx, bit.dy = 0, -1
+            elif device == "+":
+                # Turn right if bit is 1, left if 0
+                if bit.value == 1:
+                    bit.dx, bit.dy = -bit.dy, bit.dx
+                elif bit.value == 0:
+                    bit.dx, bit.dy = bit.dy, -bit.dx
+            elif device == "\\":
+                # Reflect bit and change mirror to inactive state
+                bit.dx, bit.dy = bit.dy, bit.dx
+                self.grid[bit.y][bit.x] = "-"
+                self.changedCells.append((bit.x, bit.y))
+            elif device == "/":
+                # Reflect bit and change mirror to inactive state
+                bit.dx, bit.dy = -bit.dy, -bit.dx
+                self.grid[bit.y][bit.x] = "|"
+                self.changedCells.append((bit.x, bit.y))
+            elif device == "~":
+                # Turn original bit right, create new one with
+                # opposite value going opposite direction
+                bit.dx, bit.dy = -bit.dy, bit.dx
+                newBits.append(Bit(bit.x, bit.y, 1 - bit.value,
+                                   -bit.dx, -bit.dy))
+            elif device == "@":
+                # Terminate immediately
+                raise StopIteration
+            elif device == "=":
+                # Pass this bit straight through, but change to
+                # one of {} based on this bit's value
+                if bit.value == 1:
+                    self.grid[bit.y][bit.x] = "}"
+                elif bit.value == 0:
+                    self.grid[bit.y][bit.x] = "{"
+                self.changedCells.append((bit.x, bit.y))
+            return False
+        else:
+            # Bit went outside playfield; delete it
+            return True
+
+    def openNextCollectors(self):
+        # Called when there are no active bits
+        if self.storedBits:
+            # Open the collectors with the earliest letter that have bits
+            # in them (storedBits only has letters with a nonzero count)
+            letter = min(self.storedBits)
+            self.openCollectors = self.collectors[letter].copy()
+            for collector in self.openCollectors:
+                collector.open = True
+            self.reset()
+        else:
+            # No active bits & no collectors with bits in them: end
+            # the program
+            raise StopIteration
+
+    def reset(self):
+        # Each splitter or switch changes at most once between resets, so
+        # changedCells has no repeats
+        for x, y in self.changedCells:
+            device = self.grid[y][x]
+            if device == "|":
+                self.grid[y][x] = "/"
+            elif device == "-":
+                self.grid[y][x] = "\\"
+            elif device in ["{", "}"]:
+                self.grid[y][x] = "="
+        self.resetCounts.append(len(self.changedCells))
+        self.changedCells = []
+
+
+class EventPlayfield(Playfield):
+    # Instead of moving every bit one cell per tick, move each bit
+    # straight to the next cell that can change its state, and keep the
+    # bits in a heap of (arrival tick, creation order, bit). Bits arriving
+    # on the same tick are handled in creation order, which is the order
+    # Playfield keeps activeBits in, so devices that change state, sinks
+    # and @ see bits in the same order as in Playfield
+    def __init__(self, codeLines, inputs, ioFormat=RAW, width=None):
+        super().__init__(codeLines, inputs, ioFormat, width)
+        self.nextStops = {direction: self.findStops(*direction)
+                          for direction in ARROWS.values()}
+        self.events = []
+        self.bitCount = 0
+        for bit in self.activeBits:
+            self.schedule(bit, 0)
+        self.activeBits = []
+
+    def isStop(self, x, y, dx, dy):
+        device = self.grid[y][x]
+        if type(device) is not str:
+            # Sources, collectors and sinks
+            return True
+        elif device in ARROWS:
+            return ARROWS[device] != (dx, dy)
+        else:
+            return device in DEVICES
+
+    def findStops(self, dx, dy):
+        # For each cell, the distance to and position of the first stop
+        # reached by a bit leaving the cell in direction dx, dy. Work
+        # backwards from the edge the bits are moving towards, so that
+        # each cell can extend the entry of the cell after it
+        stops = [[None] * self.width for y in range(self.height)]
+        xs = range(self.width)
+        ys = range(self.height)
+        if dx > 0:
+            xs = xs[::-1]
+        if dy > 0:
+            ys = ys[::-1]
+        for y in ys:
+            for x in xs:
+                nextX, nextY = x + dx, y + dy
+                if not (0 <= nextX < self.width
+                        and 0 <= nextY < self.height):
+                    # Off the playfield
+                    stops[y][x] = (1, nextX, nextY)
+                elif self.isStop(nextX, nextY, dx, dy):
+                    stops[y][x] = (1, nextX, nextY)
                 else:
-                    # Bit went outside playfield; delete it
-                    indicesToRemove.append(index)
-            for index in reversed(indicesToRemove):
-                # Iterate over the indices to remove from largest to smallest
-                # so that removing smaller indices doesn't modify the
-                # larger ones
-                self.activeBits.pop(index)
-            self.activeBits.extend(newBits)
+                    distance, stopX, stopY = stops[nextY][nextX]
+                    stops[y][x] = (distance + 1, stopX, stopY)
+        return stops
+
+    def schedule(self, bit, tick, order=None):
+        # Move the bit to its next stop, which it reaches some ticks after
+        # the given one
+        if order is None:
+            order = self.bitCount
+            self.bitCount += 1
+        distance, bit.x, bit.y = self.nextStops[bit.dx, bit.dy][bit.y][bit.x]
+        heapq.heappush(self.events, (tick + distance, order, bit))
+
+    def tick(self):
+        if self.events and not (self.sources or self.openCollectors):
+            # Nothing happens until the next bit arrives at a stop
+            self.ticks = self.events[0][0] - 1
+        self.ticks += 1
+        # Bits emitted this tick first move this tick, so they leave
+        # their sources and collectors as of the previous one
+        for bit in self.emitBits():
+            self.schedule(bit, self.ticks - 1)
+
+        if self.events:
+            newBits = []
+            while self.events and self.events[0][0] == self.ticks:
+                arrival, order, bit = heapq.heappop(self.events)
+                if not self.land(bit, newBits):
+                    self.schedule(bit, arrival, order)
+            for bit in newBits:
+                self.schedule(bit, self.ticks)
         else:
-            for letter in collectorNames:
-                if letter not in self.collectors:
-                    # No collectors in this program use that letter
-                    continue
-                if any(collector.queue
-                       for collector in self.collectors[letter]):
-                    # Some collectors with this letter have bits in them:
-                    # open these
-                    self.openCollectors = self.collectors[letter].copy()
-                    for collector in self.openCollectors:
-                        collector.open = True
-                    self.reset()
-                    break
+            self.openNextCollectors()
+
+
+def importNumpy():
+    """Import NumPy if possible; return the module, or None."""
+    global numpy, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+class NumpyPlayfield(Playfield):
+    # Keep the active bits as NumPy arrays of positions, directions and
+    # values, in the same order as Playfield's activeBits, and move them
+    # all at once each tick
+    def __init__(self, codeLines, inputs, ioFormat=RAW, width=None):
+        importNumpy()
+        super().__init__(codeLines, inputs, ioFormat, width)
+        self.codes = self.findCodes()
+        self.bitX = numpy.zeros(0, dtype=int)
+        self.bitY = numpy.zeros(0, dtype=int)
+        self.bitDX = numpy.zeros(0, dtype=int)
+        self.bitDY = numpy.zeros(0, dtype=int)
+        self.bitValues = numpy.zeros(0, dtype=int)
+        self.addBits(self.activeBits)
+        self.activeBits = []
+
+    def deviceCode(self, device):
+        if type(device) is Source:
+            return DELETE
+        elif type(device) is not str:
+            # Collectors and sinks
+            return FIXUP
+        else:
+            return deviceCodes.get(device, PASS)
+
+    def findCodes(self):
+        # The grid has a border of DELETE cells, so the codes of bits that
+        # have just left the playfield can be looked up like any other.
+        # A cell's code is at [y + 1, x + 1]
+        codes = numpy.full((self.height + 2, self.width + 2), DELETE,
+                           dtype=numpy.int8)
+        codes[1:-1, 1:-1] = [[self.deviceCode(device) for device in row]
+                             for row in self.grid]
+        return codes
+
+    def addBits(self, bits):
+        if bits:
+            self.addArrays([bit.x for bit in bits],
+                           [bit.y for bit in bits],
+                           [bit.dx for bit in bits],
+                           [bit.dy for bit in bits],
+                           [bit.value for bit in bits])
+
+    def addArrays(self, xs, ys, dxs, dys, values):
+        self.bitX = numpy.concatenate((self.bitX, xs)).astype(int)
+        self.bitY = numpy.concatenate((self.bitY, ys)).astype(int)
+        self.bitDX = numpy.concatenate((self.bitDX, dxs)).astype(int)
+        self.bitDY = numpy.concatenate((self.bitDY, dys)).astype(int)
+        self.bitValues = numpy.concatenate((self.bitValues,
+                                            values)).astype(int)
+
+    def tick(self):
+        self.ticks += 1
+        self.addBits(self.emitBits())
+        if len(self.bitValues):
+            self.moveBits()
+        else:
+            self.openNextCollectors()
+
+    def moveBits(self):
+        bitX, bitY = self.bitX, self.bitY
+        bitDX, bitDY = self.bitDX, self.bitDY
+        bitX += bitDX
+        bitY += bitDY
+        codes = self.codes[bitY + 1, bitX + 1]
+        for code, (dx, dy) in arrowCodes.items():
+            onArrow = codes == code
+            bitDX[onArrow] = dx
+            bitDY[onArrow] = dy
+        # Turn right if bit is 1, left if 0
+        onTurn = codes == TURN
+        sign = 2 * self.bitValues[onTurn] - 1
+        dx = bitDX[onTurn]
+        bitDX[onTurn] = -sign * bitDY[onTurn]
+        bitDY[onTurn] = sign * dx
+        # Turn original bits right; their opposite copies go the opposite
+        # way and join the end of the list, as in Playfield
+        onDupneg = codes == DUPNEG
+        dx = bitDX[onDupneg]
+        bitDX[onDupneg] = -bitDY[onDupneg]
+        bitDY[onDupneg] = dx
+        newBits = (bitX[onDupneg], bitY[onDupneg], -bitDX[onDupneg],
+                   -bitDY[onDupneg], 1 - self.bitValues[onDupneg])
+
+        keep = codes != DELETE
+        for index in numpy.flatnonzero(codes == FIXUP):
+            x, y = int(bitX[index]), int(bitY[index])
+            bit = Bit(x, y, int(self.bitValues[index]),
+                      int(bitDX[index]), int(bitDY[index]))
+            # FIXUP devices don't make new bits
+            if self.land(bit, None):
+                keep[index] = False
             else:
-                # No active bits & no collectors with bits in them: end
-                # the program
-                raise StopIteration
+                bitDX[index], bitDY[index] = bit.dx, bit.dy
+                self.codes[y + 1, x + 1] = self.deviceCode(self.grid[y][x])
+
+        if not keep.all():
+            self.bitX = bitX[keep]
+            self.bitY = bitY[keep]
+            self.bitDX = bitDX[keep]
+            self.bitDY = bitDY[keep]
+            self.bitValues = self.bitValues[keep]
+        if len(newBits[0]):
+            self.addArrays(*newBits)
 
     def reset(self):
-        for y, row in enumerate(self.grid):
-            for x, device in enumerate(row):
-                if device == "|":
-                    self.grid[y][x] = "/"
-                elif device == "-":
-                    self.grid[y][x] = "\\"
-                elif device in ["{", "}"]:
-                    self.grid[y][x] = "="
+        # Every changed cell goes back to a splitter or switch
+        for x, y in self.changedCells:
+            self.codes[y + 1, x + 1] = FIXUP
+        super().reset()
 
 
 class Collector:
-    def __init__(self, letter):
+    def __init__(self, x, y, letter):
+        self.x = x
+        self.y = y
         self.letter = letter.upper()
         self.open = letter.islower()
-        self.queue = []
+        # Runs of equal bits, as [value, count] lists
+        self.queue = deque()
 
     def __str__(self):
         if self.open:
@@ -225,10 +514,11 @@ class Collector:
     def tick(self):
         if self.open:
             if self.queue:
-                bit = self.queue.pop(0)
-                bit.dx = 1
-                bit.dy = 0
-                return bit
+                run = self.queue[0]
+                run[1] -= 1
+                if not run[1]:
+                    self.queue.popleft()
+                return Bit(self.x, self.y, run[0])
             else:
                 self.open = False
                 return None
@@ -236,11 +526,14 @@ class Collector:
             return None
 
     def enqueue(self, bit):
-        self.queue.append(bit)
+        if self.queue and self.queue[-1][0] == bit.value:
+            self.queue[-1][1] += 1
+        else:
+            self.queue.append([bit.value, 1])
 
 
 class Source:
-    def __init__(self, x, y, data, ioFormat=RAW):
+    def __init__(self, x, y, data, ioFormat=RAW, width=None):
         self.x = x
         self.y = y
         self.ioFormat = ioFormat
@@ -283,6 +576,38 @@ class Source:
                 unaryNumber += "1" * abs(decimalNumber)
                 unaryNumbers.append(unaryNumber)
             self.data = iter("0".join(unaryNumbers))
+        elif ioFormat == UNSIGNED_BINARY:
+            # A nonnegative integer becomes its binary digits, least
+            # significant first. Without a fixed width there's no way to
+            # tell where one number ends, so each input is one number
+            try:
+                decimalNumber = int(data)
+            except ValueError:
+                decimalNumber = None
+            if decimalNumber is None or decimalNumber < 0:
+                error("input %r is not a nonnegative integer" % data)
+                self.data = iter("")
+            else:
+                self.data = iter(format(decimalNumber, "b")[::-1])
+        elif ioFormat == SIGNED_BINARY:
+            # Integers become width bits of two's complement, least
+            # significant first, one after another
+            decimalNumbers = data.split(SEPARATOR)
+            binaryNumbers = []
+            for decimalNumber in decimalNumbers:
+                try:
+                    decimalNumber = int(decimalNumber)
+                except ValueError:
+                    error("input %r is not an integer" % decimalNumber)
+                    continue
+                if not -2**(width-1) <= decimalNumber < 2**(width-1):
+                    error("input %d doesn't fit in %d bits"
+                          % (decimalNumber, width))
+                    continue
+                binaryNumber = format(decimalNumber % 2**width,
+                                      "0%db" % width)
+                binaryNumbers.append(binaryNumber[::-1])
+            self.data = iter("".join(binaryNumbers))
         else:
             raise NotImplemented("Unknown I/O format: %s" % self.ioFormat)
 
@@ -303,11 +628,21 @@ class Source:
 
 
 class Sink:
-    def __init__(self, x, y, ioFormat=RAW):
+    def __init__(self, x, y, ioFormat=RAW, width=None):
         self.x = x
         self.y = y
         self.ioFormat = ioFormat
-        self.queue = []
+        self.width = width
+        # The number being decoded: for the unary formats, its count of
+        # 1's and whether it has a sign bit; for the binary formats, its
+        # digits that haven't been added to value yet, least significant
+        # first, and for -b, the value of the digits before them and how
+        # many there were
+        self.count = 0
+        self.signBit = False
+        self.digits = []
+        self.value = 0
+        self.shift = 0
         self.output = ""
         self.rawOutput = ""
 
@@ -323,43 +658,81 @@ class Sink:
             self.output += str(bit)
         elif self.ioFormat == UNSIGNED_UNARY:
             if bit.value == 0:
-                # 0 is separator; output the current queue value
-                self.output += str(len(self.queue))
+                # 0 is separator; output the current value
+                self.output += str(self.count)
                 self.output += SEPARATOR
-                self.queue = []
+                self.count = 0
             else:
-                # Add a bit to the current queue value
-                self.queue.append(bit)
+                # Add a bit to the current value
+                self.count += 1
         elif self.ioFormat == SIGNED_UNARY:
-            if bit.value == 0 and self.queue:
-                # 0 with nonempty queue is separator; output the current
-                # queue value
-                if self.queue[0].value == 0:
-                    # A leading 0 on the value is a sign bit
-                    self.queue.pop(0)
-                    if self.queue:
-                        # Output a minus sign unless the number was just
-                        # the 0 bit (in which case it represents 0)
-                        self.output += "-"
-                self.output += str(len(self.queue))
+            if bit.value == 0 and (self.signBit or self.count):
+                # 0 after a sign bit or a 1 is separator; output the
+                # current value
+                self.output += self.signedUnary()
                 self.output += SEPARATOR
-                self.queue = []
+                self.count = 0
+                self.signBit = False
+            elif bit.value == 0:
+                # 0 at the start of a number is sign bit
+                self.signBit = True
             else:
-                # 0 with empty queue is sign bit; 1 is always part of a
-                # number; add to the current queue value
-                self.queue.append(bit)
+                # 1 is always part of a number
+                self.count += 1
+        elif self.ioFormat == UNSIGNED_BINARY:
+            # The whole output is one number; its digits are added to it
+            # in chunks, since adding bits to an int one at a time would
+            # take quadratic time
+            self.digits.append(str(bit))
+            if len(self.digits) == CHUNK_BITS:
+                self.addDigits()
+        elif self.ioFormat == SIGNED_BINARY:
+            self.digits.append(str(bit))
+            if len(self.digits) == self.width:
+                # Output each number as soon as all of its bits are in
+                if self.output:
+                    self.output += SEPARATOR
+                self.output += self.signedBinary()
+                self.digits = []
         else:
             raise NotImplemented("Unknown I/O format: %s" % self.ioFormat)
 
+    def signedUnary(self):
+        if self.signBit and self.count:
+            # A minus sign, unless the number was just the 0 bit (in
+            # which case it represents 0)
+            return "-" + str(self.count)
+        else:
+            return str(self.count)
+
+    def addDigits(self):
+        # Add the digits collected so far to the top of the value
+        if self.digits:
+            self.value |= int("".join(reversed(self.digits)), 2) << self.shift
+            self.shift += len(self.digits)
+            self.digits = []
+
+    def signedBinary(self):
+        value = int("".join(reversed(self.digits)), 2)
+        if len(self.digits) == self.width and self.digits[-1] == "1":
+            # Top bit set: a negative number
+            value -= 2**self.width
+        return str(value)
+
     def finalize(self):
         if self.ioFormat == UNSIGNED_UNARY:
-            self.output += str(len(self.queue))
+            self.output += str(self.count)
         elif self.ioFormat == SIGNED_UNARY:
-            if self.queue and self.queue[0].value == 0:
-                self.queue.pop(0)
-                if self.queue:
-                    self.output += "-"
-            self.output += str(len(self.queue))
+            self.output += self.signedUnary()
+        elif self.ioFormat == UNSIGNED_BINARY:
+            self.addDigits()
+            self.output += str(self.value)
+        elif self.ioFormat == SIGNED_BINARY and self.digits:
+            # Leftover bits that don't fill a whole number are read as if
+            # the missing high bits were 0
+            if self.output:
+                self.output += SEPARATOR
+            self.output += self.signedBinary()
 
 
 class Bit:
@@ -378,12 +751,19 @@ class Bit:
         return str(self.value)
 
 
-def run(codeLines, pause, ioFormat, *inputs):
+engines = {"tick": Playfield,
+           "event": EventPlayfield,
+           "numpy": NumpyPlayfield,
+           }
+
+
+def run(codeLines, pause, ioFormat, *inputs, engine="tick", stats=False,
+        width=None):
     if pause == STEP:
         # Manual step mode: buffer output and display the buffer at each step
         print("Press enter to step; type anything else or Ctrl-C to stop.")
         input()
-    playfield = Playfield(codeLines, list(inputs), ioFormat)
+    playfield = engines[engine](codeLines, list(inputs), ioFormat, width)
     try:
         while True:
             if pause != 0:
@@ -408,6 +788,16 @@ def run(codeLines, pause, ioFormat, *inputs):
     for sink in playfield.sinks:
         sink.finalize()
         print(sink.output)
+    if stats:
+        print("Ticks:", playfield.ticks, file=sys.stderr)
+        resetCounts = playfield.resetCounts
+        if resetCounts:
+            print("Cells reset: %d in %d cycles (%.1f per cycle, most %d)"
+                  % (sum(resetCounts), len(resetCounts),
+                     sum(resetCounts) / len(resetCounts), max(resetCounts)),
+                  file=sys.stderr)
+        else:
+            print("Cells reset: 0 in 0 cycles", file=sys.stderr)
 
 
 testCode = r"""
@@ -451,10 +841,32 @@ if __name__ == "__main__":
                                "--signed-unary",
                                help="render decimal I/O as signed unary",
                                action="store_true")
+        ioOptions.add_argument("-b",
+                               "--unsigned-binary",
+                               help="render decimal I/O as unsigned "
+                                    "binary (little-endian)",
+                               action="store_true")
+        ioOptions.add_argument("-B",
+                               "--signed-binary",
+                               help="render decimal I/O as fixed-width "
+                                    "two's complement signed binary "
+                                    "(little-endian)",
+                               type=int,
+                               metavar="WIDTH")
+        argparser.add_argument("-e",
+                               "--engine",
+                               help="how to run the program: tick moves "
+                                    "every bit one cell per tick, event "
+                                    "moves bits straight to the next device, "
+                                    "numpy moves all bits at once with "
+                                    "NumPy (default: tick)",
+                               choices=engines,
+                               default="tick")
+        argparser.add_argument("--stats",
+                               help="print the number of ticks run and "
+                                    "of cells reset when collectors open",
+                               action="store_true")
         # Flags TODO:
-        # -b  Translate decimal I/O as unsigned binary (little-endian)
-        # -B width  Translate decimal I/O as fixed-width twos' complement
-        #           signed binary (little-endian)
         # (Possibly something for ASCII I/O?)
         argparser.add_argument("filename",
                                help="name of code file")
@@ -482,15 +894,37 @@ if __name__ == "__main__":
             else:
                 if pause < 0:
                     pause = 0
+        engine = options.engine
+        if engine != "tick" and pause != 0:
+            argparser.error("only the tick engine can pause between ticks")
+        if engine == "numpy" and importNumpy() is None:
+            argparser.error("the numpy engine needs NumPy to be installed")
+        stats = options.stats
         ioFormat = RAW
+        width = None
         if options.unsigned_unary:
             ioFormat = UNSIGNED_UNARY
         elif options.signed_unary:
             ioFormat = SIGNED_UNARY
+        elif options.unsigned_binary:
+            ioFormat = UNSIGNED_BINARY
+        elif options.signed_binary is not None:
+            ioFormat = SIGNED_BINARY
+            width = options.signed_binary
+            if width < 1:
+                argparser.error("binary width must be at least 1")
+        if ioFormat in [UNSIGNED_BINARY, SIGNED_BINARY]:
+            # Binary I/O can handle numbers with many thousands of digits
+            if hasattr(sys, "set_int_max_str_digits"):
+                sys.set_int_max_str_digits(0)
     else:
         code = testCode
         pause = testPause
         ioFormat = testIOFormat
         args = testArgs
-    run(code, pause, ioFormat, *args)
+        engine = "tick"
+        stats = False
+        width = None
+    run(code, pause, ioFormat, *args, engine=engine, stats=stats,
+        width=width)
 
@@ -0,0 +1,125 @@
+import io
+import os
+import subprocess
+import sys
+import unittest
+from contextlib import redirect_stdout, redirect_stderr
+
+import bitcycle
+from bitcycle import RAW, UNSIGNED_BINARY, SIGNED_BINARY
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load(filename):
+    with open(os.path.join(HERE, filename)) as codeFile:
+        return codeFile.read().splitlines()
+
+
+def run(codeLines, *inputs, engine="tick", ioFormat=RAW, width=None):
+    """Run a program and return what it writes to stdout."""
+    stdout = io.StringIO()
+    with redirect_stdout(stdout):
+        bitcycle.run(codeLines, 0, ioFormat, *inputs, engine=engine,
+                     width=width)
+    return stdout.getvalue()
+
+
+def runWithTicks(codeLines, *inputs, engine="tick"):
+    """Run a program and return its output and the ticks it took."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        bitcycle.run(codeLines, 0, RAW, *inputs, engine=engine, stats=True)
+    return stdout.getvalue(), stderr.getvalue().splitlines()[0]
+
+
+# Programs that halt, with inputs to run them on
+PROGRAMS = [
+    (["?!"], ["1101"]),
+    (["?A!"], ["1101"]),
+    (["?~", " !"], ["1101"]),
+    (["?/!", " !"], ["1101"]),
+    (["?" + " " * 20 + "v", "", "!" + " " * 20 + "<"], ["1101"]),
+    (load("truth_machine.btc"), ["0"]),
+    (load("cyclic_tag.btc"), ["110100", "10"]),
+    (load("cyclic_tag.btc"), ["0011", "1101"]),
+    (bitcycle.testCode, bitcycle.testArgs),
+]
+
+
+class EngineTests(unittest.TestCase):
+    """Differential tests of the other engines against the tick engine."""
+
+    engines = ["event", "numpy"]
+
+    def test_programs(self):
+        for engine in self.engines:
+            if engine == "numpy" and bitcycle.importNumpy() is None:
+                continue
+            for codeLines, inputs in PROGRAMS:
+                with self.subTest(engine=engine, code=codeLines,
+                                  inputs=inputs):
+                    self.assertEqual(
+                        runWithTicks(codeLines, *inputs, engine=engine),
+                        runWithTicks(codeLines, *inputs))
+
+    def test_binary_formats(self):
+        for engine in self.engines:
+            if engine == "numpy" and bitcycle.importNumpy() is None:
+                continue
+            with self.subTest(engine=engine):
+                self.assertEqual(run(["?!"], "1,-2,7", engine=engine,
+                                     ioFormat=SIGNED_BINARY, width=4),
+                                 "1,-2,7\n")
+
+    def test_tick_engine_does_not_import_numpy(self):
+        code = ("import sys, bitcycle\n"
+                "bitcycle.run(['?!'], 0, bitcycle.RAW, '1')\n"
+                "print('numpy' in sys.modules)\n")
+        result = subprocess.run([sys.executable, "-c", code], cwd=HERE,
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.stdout.split(), ["1", "False"])
+
+
+class BinaryFormatTests(unittest.TestCase):
+    def test_unsigned_round_trip(self):
+        # Big enough for the sink to decode it in several chunks
+        number = 3 ** 6000
+        self.assertGreater(number.bit_length(), 2 * bitcycle.CHUNK_BITS)
+        for data in ["0", "6", str(number)]:
+            with self.subTest(data=data[:20]):
+                self.assertEqual(run(["?!"], data,
+                                     ioFormat=UNSIGNED_BINARY),
+                                 data + "\n")
+
+    def test_unsigned_bits(self):
+        self.assertEqual("".join(bitcycle.Source(0, 0, "6",
+                                                 UNSIGNED_BINARY).data),
+                         "011")
+
+    def test_signed_round_trip(self):
+        self.assertEqual(run(["?!"], "1,-2,7,-8,0", ioFormat=SIGNED_BINARY,
+                             width=4),
+                         "1,-2,7,-8,0\n")
+        self.assertEqual("".join(bitcycle.Source(0, 0, "1,-2",
+                                                 SIGNED_BINARY, 4).data),
+                         "10000111")
+
+    def test_invalid_inputs_give_errors(self):
+        for data, ioFormat, width, output, errors in [
+                ("-5", UNSIGNED_BINARY, None, "0\n", 1),
+                ("x", UNSIGNED_BINARY, None, "0\n", 1),
+                ("8,x,3,-8", SIGNED_BINARY, 4, "3,-8\n", 2)]:
+            with self.subTest(data=data):
+                stderr = io.StringIO()
+                with redirect_stderr(stderr):
+                    self.assertEqual(run(["?!"], data, ioFormat=ioFormat,
+                                         width=width),
+                                     output)
+                self.assertEqual(stderr.getvalue().count("Error:"), errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,365 @@
+#!/usr/bin/python3
+
+"""Benchmarks for the tinylisp interpreter.
+
+Runs a fixed set of workloads over the standard library, reports how
+long each one takes, and compares the timings with a baseline saved by
+an earlier run. The library runs as tinylisp code, since with its
+intrinsics most of the workloads would hardly use the interpreter:
+
+    python3 benchmark.py --json before.json
+    (change tinylisp.py)
+    python3 benchmark.py --baseline before.json
+"""
+
+import sys
+import argparse
+import io
+import json
+import platform
+import statistics
+import time
+from contextlib import redirect_stdout, redirect_stderr
+
+import tinylisp
+
+
+# Definitions that every benchmark can use, loaded before it is timed
+
+PRELUDE = """
+(load library)
+
+(def _repeat
+  (lambda (count function arg result)
+    (if count
+      (_repeat (dec count) function arg (function arg))
+      result)))
+
+(def repeat
+  (lambda (count function arg) (_repeat count function arg nil)))
+"""
+
+
+def random_numbers(count, seed=42, low=0, high=1000):
+    """Return tinylisp code for a list of pseudo-random integers.
+
+The integers are at least low and less than high. They are made in
+Python, since making them with the standard library's arithmetic would
+take longer than some of the benchmarks.
+"""
+    numbers = []
+    for i in range(count):
+        seed = (seed * 1103515245 + 12345) % 2147483648
+        numbers.append(low + seed % (high - low))
+    return "(%s)" % " ".join(map(str, numbers))
+
+
+# Each benchmark is a (name, setup code, timed code) triple; the setup
+# code runs after the prelude and isn't timed
+
+BENCHMARKS = [
+    ("merge-sort",
+     "(def xs (q %s))" % random_numbers(500),
+     "(repeat 5 merge-sort xs)"),
+    ("insertion-sort",
+     "(def xs (q %s))" % random_numbers(150),
+     "(repeat 5 insertion-sort xs)"),
+    ("bignum",
+     """
+(def big (q %s))
+(def bignum-ops
+  (lambda (n)
+    (list (* n n) (pow n 3) (div2 (* n 300) (add2 n 1)) (mod (* n 97) n)
+          (factorial 30))))
+""" % (7 ** 40),
+     "(repeat 10 bignum-ops big)"),
+    ("transpose",
+     "(def square-matrix (q (%s)))"
+     % " ".join(random_numbers(40, seed) for seed in range(40)),
+     "(repeat 10 transpose square-matrix)"),
+    ("string-chars",
+     """
+(def text (string (q %s)))
+(def round-trip (lambda (name) (string (reverse (chars name)))))
+""" % random_numbers(500, low=32, high=127),
+     "(repeat 100 round-trip text)"),
+    ("tail-recursion",
+     """
+(def count-down
+  (lambda (n accum)
+    (if n
+      (count-down (dec n) (inc accum))
+      accum)))
+""",
+     "(count-down 20000 0)"),
+    ("fib",
+     """
+(def fib
+  (lambda (n)
+    (if (less? n 2)
+      n
+      (add2 (fib (sub2 n 1)) (fib (sub2 n 2))))))
+""",
+     "(fib 18)"),
+]
+
+# Version of the format of the JSON results
+
+RESULTS_VERSION = 1
+
+# Percentage by which a benchmark's median time can exceed the
+# baseline's before it counts as a regression
+
+DEFAULT_THRESHOLD = 10.0
+
+
+def new_program(engine, intrinsics, setup):
+    """Make a program that has run the prelude and a benchmark's setup."""
+    program = tinylisp.engines[engine](intrinsics=intrinsics)
+    messages = io.StringIO()
+    with redirect_stdout(io.StringIO()), redirect_stderr(messages):
+        program.execute(PRELUDE)
+        program.execute(setup)
+        tinylisp.output.flush()
+    return program, messages.getvalue()
+
+
+def first_lines(text, count=5):
+    lines = text.splitlines()
+    if len(lines) > count:
+        lines[count:] = ["(%d more lines)" % (len(lines) - count)]
+    return "\n".join(lines)
+
+
+def timed_run(program, code):
+    """Run code and return the time taken and the errors it gave."""
+    messages = io.StringIO()
+    with redirect_stdout(io.StringIO()), redirect_stderr(messages):
+        start = time.perf_counter()
+        program.execute(code)
+        tinylisp.output.flush()
+        elapsed = time.perf_counter() - start
+    return elapsed, messages.getvalue()
+
+
+def count_steps(engine, intrinsics, setup, code):
+    """Count the calls and builtin calls that running code takes.
+
+Counting uses the profiler, so it is only done for the tree engine;
+returns None for other engines.
+"""
+    if engine != "tree":
+        return None
+    program, messages = new_program(engine, intrinsics, setup)
+    program.profiler = tinylisp.Profiler(program)
+    timed_run(program, code)
+    records, builtin_counts = program.profiler.results()
+    calls = sum(record.calls for record in records
+                if record.name != tinylisp.Profiler.TOP_LEVEL)
+    tail_calls = sum(record.tail_calls for record in records)
+    builtin_calls = sum(builtin_counts.values())
+    return {"calls": calls,
+            "tail_calls": tail_calls,
+            "builtin_calls": builtin_calls,
+            "total": calls + tail_calls + builtin_calls,
+            }
+
+
+def run_benchmark(name, setup, code, engine="tree", intrinsics=False,
+                  repeat=5):
+    """Time a benchmark and return its results as a dictionary."""
+    times = []
+    for run in range(repeat):
+        # Each run starts from a fresh program, since definitions made
+        # by the timed code can't be made again
+        program, messages = new_program(engine, intrinsics, setup)
+        if messages:
+            raise RuntimeError("setup of %s failed:\n%s"
+                               % (name, first_lines(messages)))
+        elapsed, messages = timed_run(program, code)
+        if messages:
+            raise RuntimeError("%s failed:\n%s"
+                               % (name, first_lines(messages)))
+        times.append(elapsed)
+    median = statistics.median(times)
+    return {"times": times,
+            "median": median,
+            "min": min(times),
+            "max": max(times),
+            # Median absolute deviation, which outliers affect less than
+            # the standard deviation
+            "mad": statistics.median(abs(t - median) for t in times),
+            "steps": count_steps(engine, intrinsics, setup, code),
+            }
+
+
+def run_benchmarks(names=None, engine="tree", intrinsics=False, repeat=5,
+                   report=None):
+    """Run the benchmarks with the given names (default: all of them).
+
+If report is given, it is called with each benchmark's name and results
+as soon as they are ready. Returns the results of the whole run.
+"""
+    results = {}
+    for name, setup, code in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results[name] = run_benchmark(name, setup, code, engine, intrinsics,
+                                      repeat)
+        if report is not None:
+            report(name, results[name])
+    return {"version": RESULTS_VERSION,
+            "python": platform.python_version(),
+            "engine": engine,
+            "intrinsics": intrinsics,
+            "repeat": repeat,
+            "benchmarks": results,
+            }
+
+
+def format_result(name, result):
+    steps = result["steps"]
+    return "%-16s %10.2f %10.2f %10.2f %12s" % (
+        name, result["median"] * 1000, result["mad"] * 1000,
+        result["min"] * 1000,
+        "-" if steps is None else steps["total"])
+
+
+def noise(result):
+    """Return a benchmark's median absolute deviation, in percent."""
+    return result["mad"] / result["median"] * 100
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Compare results with a baseline.
+
+Returns a list of (name, baseline median, median, change in percent,
+regressed, noisy) tuples for the benchmarks that both have. A
+comparison is noisy if the median absolute deviation of either run is
+more than threshold percent of its median, since a change of that size
+could then be chance. Otherwise, regressed is True if the median time
+grew by more than threshold percent.
+"""
+    comparisons = []
+    old_benchmarks = baseline["benchmarks"]
+    for name, result in results["benchmarks"].items():
+        if name not in old_benchmarks:
+            continue
+        old_result = old_benchmarks[name]
+        old_median = old_result["median"]
+        change = (result["median"] / old_median - 1) * 100
+        noisy = max(noise(result), noise(old_result)) > threshold
+        comparisons.append((name, old_median, result["median"], change,
+                            not noisy and change > threshold, noisy))
+    return comparisons
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Run the tinylisp benchmarks.")
+    argparser.add_argument("names",
+                           help="benchmarks to run (default: all of them)",
+                           nargs="*")
+    argparser.add_argument("-e",
+                           "--engine",
+                           help="evaluation engine to benchmark",
+                           choices=tinylisp.engines,
+                           default="tree")
+    argparser.add_argument("--intrinsics",
+                           help="run standard library functions as "
+                                "native code instead of tinylisp code",
+                           action="store_true")
+    argparser.add_argument("-r",
+                           "--repeat",
+                           help="number of times to run each benchmark "
+                                "(default: 5)",
+                           type=int,
+                           default=5)
+    argparser.add_argument("--json",
+                           help="save the results to a JSON file")
+    argparser.add_argument("--baseline",
+                           help="compare the results with those saved "
+                                "in a JSON file by an earlier run")
+    argparser.add_argument("--threshold",
+                           help="percentage by which a median time can "
+                                "grow before it counts as a regression "
+                                "(default: %g)" % DEFAULT_THRESHOLD,
+                           type=float,
+                           default=DEFAULT_THRESHOLD)
+    argparser.add_argument("-l",
+                           "--list",
+                           help="list the benchmarks and exit",
+                           action="store_true")
+    options = argparser.parse_args()
+    benchmark_names = [name for name, setup, code in BENCHMARKS]
+    if options.list:
+        print("\n".join(benchmark_names))
+        return 0
+    for name in options.names:
+        if name not in benchmark_names:
+            argparser.error("no benchmark named %s" % name)
+    if options.repeat < 1:
+        argparser.error("--repeat must be at least 1")
+    baseline = None
+    if options.baseline:
+        try:
+            with open(options.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError) as err:
+            argparser.error("could not read baseline %s: %s"
+                            % (options.baseline, err))
+        if baseline.get("version") != RESULTS_VERSION:
+            argparser.error("baseline %s was saved by a different version "
+                            "of this script" % options.baseline)
+
+    # Deep non-tail recursion needs more than the default recursion limit,
+    # as it does when running tinylisp.py
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    print("%-16s %10s %10s %10s %12s" % ("benchmark", "median ms", "mad ms",
+                                         "min ms", "eval steps"))
+    try:
+        results = run_benchmarks(
+            options.names, options.engine, options.intrinsics,
+            options.repeat,
+            lambda name, result: print(format_result(name, result),
+                                       flush=True))
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        return 1
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+            json_file.write("\n")
+    if baseline is None:
+        return 0
+    if (baseline.get("engine"), baseline.get("intrinsics")) != (
+            results["engine"], results["intrinsics"]):
+        print("Warning: the baseline was run with different options",
+              file=sys.stderr)
+    print()
+    print("%-16s %12s %12s %9s" % ("benchmark", "baseline ms", "median ms",
+                                   "change"))
+    regressions = 0
+    noisy_count = 0
+    for name, old_median, median, change, regressed, noisy in compare(
+            results, baseline, options.threshold):
+        print("%-16s %12.2f %12.2f %+8.1f%%%s"
+              % (name, old_median * 1000, median * 1000, change,
+                 "  NOISY" if noisy else "  REGRESSION" if regressed else ""))
+        regressions += regressed
+        noisy_count += noisy
+    if noisy_count:
+        print("%d benchmark%s too noisy to compare: the median absolute "
+              "deviation is more than %g%% of the median"
+              % (noisy_count, " was" if noisy_count == 1 else "s were",
+                 options.threshold))
+    if regressions:
+        print("%d benchmark%s slower than the baseline by more than %g%%"
+              % (regressions, "" if regressions == 1 else "s",
+                 options.threshold))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
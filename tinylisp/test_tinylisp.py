@@ -0,0 +1,494 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout, redirect_stderr
+
+import tinylisp
+from tinylisp import Program
+
+
+TINYLISP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "tinylisp.py")
+
+
+def run(code, environment=None, engine="tree", **options):
+    """Run code in a new Program, returning its stdout and stderr."""
+    if environment is None:
+        environment = tinylisp.engines[engine](**options)
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            environment.execute(code)
+        finally:
+            tinylisp.output.flush()
+    return stdout.getvalue(), stderr.getvalue()
+
+
+class EngineTests(unittest.TestCase):
+    """Differential tests of the VM engine against the tree engine."""
+
+    programs = [
+        "(disp (a 2 3)) (disp (s 2 (q x))) (disp (c 1 (q (2 3))))",
+        "(d f (q ((x) (i (l x 3) (q small) (q big))))) (disp (f 1))"
+        " (disp (f 5))",
+        "(d count (q ((n acc) (i n (count (s n 1) (a acc 1)) acc))))"
+        " (disp (count 10000 0))",
+        "(d m (q (() (x y) (c (q a) (c x (c y ())))))) (disp (m 3 4))",
+        "(d r (q (args args))) (disp (r 1 2 3)) (disp (r))",
+        "(d x 1) (d x 2) (disp undefined-name) (disp (h 5))",
+        "(disp (v (q (a 1 2)))) (disp (string (q (72 105))))",
+        "(load library) (disp (merge-sort (q (5 3 9 1 7))))"
+        " (disp (factorial 20)) (disp (map inc (1to 5)))",
+        "(load library) (disp (foldl add2 (1to 100)))"
+        " (disp (join (q (a b c)) (q -)))",
+        "(load library) (def g (lambda (n) (if (less? n 1) 0"
+        " (add2 n (g (dec n)))))) (disp (g 100))",
+    ]
+
+    def test_same_results_as_tree_engine(self):
+        for intrinsics in [True, False]:
+            for program in self.programs:
+                with self.subTest(program=program, intrinsics=intrinsics):
+                    self.assertEqual(
+                        run(program, engine="vm", intrinsics=intrinsics),
+                        run(program, intrinsics=intrinsics))
+
+    def test_deep_recursion(self):
+        code = """(d f (q ((n) (i n (a 1 (f (s n 1))) 0))))
+(disp (f 50000))"""
+        with self.assertRaises(RecursionError):
+            run(code)
+        self.assertEqual(run(code, engine="vm"), ("50000\n", ""))
+
+
+class CompileTests(unittest.TestCase):
+    # Counting down 100000 times only works if the self tail call in
+    # count is compiled into a loop
+    code = """(load library)
+(d count (q ((n acc) (i n (count (s n 1) (a acc 1)) acc))))
+(disp (count 100000 0))
+(def rev (lambda (x) (reverse x)))
+(disp (rev (merge-sort (q (5 3 9 1 7)))))
+(disp (factorial 20))
+(disp (s 1 (q x)))
+(d count 5)
+(disp (join (q (a b c)) (q -)))
+"""
+
+    def run_file(self, *args):
+        result = subprocess.run([sys.executable, *args], capture_output=True,
+                                text=True, timeout=60)
+        return result.stdout, result.stderr
+
+    def test_same_output_as_interpreter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            program = os.path.join(directory, "program.tl")
+            with open(program, "w") as program_file:
+                program_file.write(self.code)
+            module = os.path.join(directory, "program.py")
+            for options in [[], ["--no-intrinsics"]]:
+                with self.subTest(options=options):
+                    self.assertEqual(self.run_file(TINYLISP, *options,
+                                                   "--compile", "-o", module,
+                                                   program),
+                                     ("", ""))
+                    stdout, stderr = self.run_file(module)
+                    self.assertIn("100000\n", stdout)
+                    self.assertEqual((stdout, stderr),
+                                     self.run_file(TINYLISP, *options,
+                                                   program))
+
+
+class LimitTests(unittest.TestCase):
+    recurse = "(d f (q ((n) (i n (a 1 (f (s n 1))) 0))))"
+
+    def test_max_depth(self):
+        environment = tinylisp.VMProgram(max_depth=100)
+        run(self.recurse, environment)
+        self.assertEqual(run("(disp (f 50))", environment), ("50\n", ""))
+        with self.assertRaisesRegex(tinylisp.EvaluationLimit,
+                                    "call depth exceeded limit of 100"):
+            run("(disp (f 200))", environment)
+        # The program can still be used afterwards
+        self.assertEqual(run("(disp (f 90))", environment), ("90\n", ""))
+
+    @unittest.skipIf(tinylisp.memory_use() is None,
+                     "memory use is not available")
+    def test_max_heap(self):
+        code = "(d count (q ((n) (i n (count (s n 1)) 0)))) (count 100000)"
+        with self.assertRaisesRegex(tinylisp.EvaluationLimit,
+                                    "memory use exceeded limit of 1 MB"):
+            run(code, engine="vm", max_heap=1)
+
+    def test_limit_ends_only_the_current_line(self):
+        lines = "%s\n(f 200) (disp 1)\n(disp 2)\n" % self.recurse
+        result = subprocess.run([sys.executable, TINYLISP, "-e", "vm",
+                                 "--max-depth", "100"],
+                                input=lines, capture_output=True, text=True,
+                                timeout=60)
+        self.assertEqual(result.stderr.count("Error: call depth exceeded"),
+                         1)
+        self.assertNotIn("tl> 1", result.stdout)
+        self.assertIn("tl> 2", result.stdout)
+
+    def test_tree_engine_rejects_limits(self):
+        for option in ["--max-depth", "--max-heap"]:
+            with self.subTest(option=option):
+                result = subprocess.run([sys.executable, TINYLISP, option,
+                                         "100"],
+                                        input="", capture_output=True,
+                                        text=True, timeout=60)
+                self.assertEqual(result.returncode, 2)
+                self.assertIn("only supported by the vm engine",
+                              result.stderr)
+
+
+class ModuleCacheTests(unittest.TestCase):
+    def test_cached_module_runs_the_same(self):
+        with tempfile.TemporaryDirectory() as directory:
+            module = os.path.join(directory, "module.tl")
+            with open(module, "w") as module_file:
+                module_file.write("(d x 2)\n(d y (a x 1))\n")
+            code = "(load %s) (disp (c x (c y ())))" % module
+            for run_number in range(2):
+                self.assertEqual(run(code), ("(2 3)\n", ""))
+            self.assertTrue(os.path.exists(tinylisp.cache_path(module)))
+            # A changed module is parsed again
+            with open(module, "w") as module_file:
+                module_file.write("(d x 5)\n(d y (a x 1))\n")
+            self.assertEqual(run(code), ("(5 6)\n", ""))
+
+    def test_intrinsics_match_library(self):
+        environment = Program()
+        run("(load library)", environment)
+        self.assertEqual(len(environment.natives), len(tinylisp.intrinsics))
+
+
+class IntrinsicTests(unittest.TestCase):
+    """Tests that intrinsics give the same results as the library code."""
+
+    calls = [
+        # Arithmetic
+        "(* 6 7 (neg 2))", "(*)", "(+ 1 2 (neg 5))", "(- 10 3 (neg 2))",
+        "(- 5)", "(/ 100 3 2)", "(/ (neg 7) 2)", "(/ 7 0)", "(abs (neg 9))",
+        "(abs 0)", "(div2 7 2)", "(div2 (neg 7) 2)", "(div2 7 (neg 2))",
+        "(div2 (neg 7) (neg 2))", "(div2 7 0)", "(div2 0 0)", "(mod 7 3)",
+        "(mod (neg 7) 3)", "(mod 7 (neg 3))", "(mod (neg 7) (neg 3))",
+        "(mod 7 0)", "(mul2 (neg 6) 7)", "(mul2 0 (neg 1))", "(divides? 3 12)",
+        "(divides? 0 0)", "(divides? 0 5)", "(divides? (neg 3) 12)",
+        "(divides? 5 (neg 12))", "(even? 0)", "(even? (neg 3))",
+        "(odd? (neg 3))", "(odd? 4)", "(pow 2 10)", "(pow (neg 3) 3)",
+        "(pow 0 0)", "(pow 5 (neg 1))", "(gcd 12 18)", "(gcd (neg 12) 18)",
+        "(gcd 0 0)", "(gcd 0 (neg 5))", "(factorial 0)", "(factorial 10)",
+        "(factorial (neg 2))", "(prime? 1)", "(prime? 97)", "(prime? 0)",
+        "(prime? (neg 7))", "(prime-factors 360)", "(prime-factors 1)",
+        "(prime-factors 0)", "(prime-factors (neg 12))", "(to-base 2 10)",
+        "(to-base 10 0)", "(to-base 16 (neg 255))",
+        "(from-base 2 (q (1 0 1 0)))", "(from-base 10 ())",
+        "(from-base (neg 2) (q (1 1)))", "(max (list 3 (neg 1) 7))",
+        "(max ())", "(min (q (3 1 7)))", "(min ())", "(sum (q (1 2 3)))",
+        "(sum ())", "(product (q (2 3 4)))", "(product ())",
+        # Lists
+        "(0to 5)", "(0to 0)", "(0to (neg 2))", "(1to 5)", "(1to 0)",
+        "(1to (neg 2))", "(to0 5)", "(to0 (neg 1))", "(to1 5)", "(to1 0)",
+        "(range 5)", "(range 2 8)", "(range 2 8 3)", "(range 8 2 (neg 2))",
+        "(range 8 2)", "(range 0)", "(range (neg 3))", "(inclusive-range 2 5)",
+        "(inclusive-range 5 2)", "(inclusive-range (neg 2) 2)",
+        "(reverse-inclusive-range 5 2)", "(reverse-inclusive-range 2 5)",
+        "(repeat-val (q x) 3)", "(repeat-val 1 0)", "(repeat-val 1 (neg 1))",
+        "(length (q (1 2 3)))", "(length ())", "(length 5)", "(length (q x))",
+        "(nth (q (a b c)) 1)", "(nth (q (a b c)) 5)",
+        "(nth (q (a b c)) (neg 1))", "(nth () 0)", "(last (q (a b c)))",
+        "(last ())", "(reverse (q (1 2 3)))", "(reverse ())", "(reverse 5)",
+        "(concat (q (1 2)) (q (3)))", "(concat () ())", "(concat (q (1)) 5)",
+        "(insert-end 4 (q (1 2)))", "(insert-end 4 ())",
+        "(contains? (q (1 2)) 2)", "(contains? () 2)",
+        "(contains? (q ((1) 2)) (q (1)))", "(count-occurrences (q (1 2 1)) 1)",
+        "(count-occurrences () 1)", "(first-index (q (a b a)) (q a))",
+        "(first-index (q (a b)) (q c))", "(last-index (q (a b a)) (q a))",
+        "(last-index () (q a))",
+        # Sorting
+        "(insertion-sort (list 3 1 2 (neg 5) 3))", "(insertion-sort ())",
+        "(merge-sort (list 3 1 2 (neg 5) 3))", "(merge-sort ())",
+        "(merge-sort (q (1)))", "(merge-sort (q (b a)))",
+        # Strings
+        "(strlen (string (q (104 105))))", "(strlen (q ||))",
+        "(strcat (q ab) (q cd))", "(strcat (q ab) 5)",
+        "(starts-with? (q abc) (q ab))", "(starts-with? (q ab) (q abc))",
+        "(starts-with? (q abc) (q ||))", "(join2 (q a) (q b) (q -))",
+        "(join (q (a b c)) (q , ))", "(join () (q -))", "(join (q (a)) (q -))",
+        "(join (q (1 2)) (q -))",
+    ]
+
+    def test_same_results_as_library(self):
+        environments = {}
+        for intrinsics in [True, False]:
+            environments[intrinsics] = Program(intrinsics=intrinsics)
+            run("(load library)", environments[intrinsics])
+        self.assertTrue(environments[True].natives)
+        self.assertFalse(environments[False].natives)
+        for call in self.calls:
+            with self.subTest(call=call):
+                self.assertEqual(run("(disp %s)" % call, environments[True]),
+                                 run("(disp %s)" % call, environments[False]))
+
+
+class HashConsTests(unittest.TestCase):
+    def test_equal_across_table_clears(self):
+        code = """(d x (c 1 (c 2 (c 3 ()))))
+(d build (q ((n acc) (i n (build (s n 1) (c (c n ()) acc)) acc))))
+(d y (build 30 ()))
+(d z (build 30 ()))
+(disp (e y z))
+(disp (e x (c 1 (c 2 (c 3 ())))))
+(disp (e (build 5 ()) (build 5 ())))
+(disp (e y (c 0 z)))"""
+        # With a small table, building each list clears it several times
+        with mock.patch("tinylisp.CONS_TABLE_SIZE", 10):
+            environment = Program(hash_cons=True)
+            self.assertEqual(run(code, environment), ("1\n1\n1\n0\n", ""))
+        self.assertLessEqual(len(environment.cons_table.cells), 10)
+        self.assertEqual(run(code), ("1\n1\n1\n0\n", ""))
+
+
+class LazyLoadTests(unittest.TestCase):
+    programs = [
+        "(disp (merge-sort (q (5 3 9 1 7))))",
+        "(disp (factorial 20)) (disp (prime-factors 360))",
+        "(disp (map inc (1to 5))) (disp (foldl add2 (1to 10)))",
+        "(disp (transpose (q ((1 2) (3 4)))))",
+        "(disp (join (q (a b c)) (q -)))",
+        "(def neg2 (lambda (x) (neg (neg x)))) (disp (neg2 5))",
+        "(disp undefined-name)",
+        "(d inc 5) (disp (inc 5))",
+        # args is a parameter of list, which lambda calls
+        "(d args 5) (disp (inc 3))",
+    ]
+
+    def test_same_results_as_eager_loading(self):
+        for intrinsics in [True, False]:
+            for program in self.programs:
+                code = "(load library) " + program
+                with self.subTest(program=program, intrinsics=intrinsics):
+                    self.assertEqual(
+                        run(code, lazy=True, intrinsics=intrinsics),
+                        run(code, intrinsics=intrinsics))
+
+
+class MatrixTests(unittest.TestCase):
+    def test_matrix_functions(self):
+        code = """(load library)
+(disp (transpose (q ((1 2 3) (4 5 6)))))
+(disp (trace (q ((1 2) (3 4)))))
+(disp (main-diagonal (q ((1 2) (3 4)))))"""
+        expected = "((1 4) (2 5) (3 6))\n5\n(1 4)\n"
+        for intrinsics in [False, True]:
+            with self.subTest(intrinsics=intrinsics):
+                self.assertEqual(run(code, intrinsics=intrinsics),
+                                 (expected, ""))
+
+    def test_numpy_is_imported_on_first_use(self):
+        code = ("import sys, tinylisp\n"
+                "tinylisp.Program().execute('(load library)')\n"
+                "print('numpy' in sys.modules)\n")
+        result = subprocess.run([sys.executable, "-c", code],
+                                cwd=os.path.dirname(TINYLISP),
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.stdout.split(), ["False"])
+
+
+class ProfilerTests(unittest.TestCase):
+    def profile(self, code):
+        environment = Program()
+        environment.profiler = tinylisp.Profiler(environment)
+        run(code, environment)
+        return environment.profiler
+
+    def test_tail_builtin_call_is_counted_once(self):
+        profiler = self.profile("""(d f (q ((x) (a x 1))))
+(f 5)""")
+        self.assertEqual(profiler.records["f"].builtin_calls, 1)
+        self.assertEqual(profiler.builtin_counts["a"], 1)
+
+    def test_branches_are_counted(self):
+        profiler = self.profile("""(d f (q ((x) (i x (s x (a 1 1)) 0))))
+(f 5)
+(f 0)""")
+        self.assertEqual(profiler.records["f"].calls, 2)
+        self.assertEqual(profiler.records["f"].builtin_calls, 4)
+        self.assertEqual(profiler.builtin_counts["i"], 2)
+        self.assertEqual(profiler.builtin_counts["s"], 1)
+        self.assertEqual(profiler.builtin_counts["a"], 1)
+
+    def test_tail_calls_are_counted(self):
+        profiler = self.profile("""(d count (q ((n) (i n (count (s n 1)) 0))))
+(count 3)""")
+        record = profiler.records["count"]
+        self.assertEqual((record.calls, record.tail_calls), (1, 3))
+        self.assertEqual(profiler.builtin_counts["i"], 4)
+        self.assertEqual(profiler.builtin_counts["s"], 3)
+
+
+class MemoTests(unittest.TestCase):
+    def test_pure_function_is_cached(self):
+        code = """(d sq (q ((x) (a x x))))
+(sq 3)
+(sq 3)"""
+        environment = Program(memo=["sq"])
+        self.assertEqual(run(code, environment), ("6\n6\n", ""))
+        memo = environment.memos[id(environment.global_names["sq"])][2]
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+
+    def test_disp_is_not_cached(self):
+        code = """(d f (q ((x) (disp x))))
+(f 5)
+(f 5)"""
+        stdout, stderr = run(code, memo=["f"])
+        self.assertEqual(stdout, "5\n()\n5\n()\n")
+        self.assertIn("not memoizing f", stderr)
+
+    def test_quoted_call_head_is_not_cached(self):
+        code = """(d f (q ((x) ((q ((y) (disp y))) x))))
+(f 5)
+(f 5)"""
+        stdout, stderr = run(code, memo=["f"])
+        self.assertEqual(stdout, "5\n()\n5\n()\n")
+        self.assertIn("not memoizing f", stderr)
+
+    def test_computed_call_head_is_not_cached(self):
+        code = """(d printer (q ((y) (disp y))))
+(d pick (q ((fs) fs)))
+(d g (q ((fs x) ((pick fs) x))))
+(g printer 5)
+(g printer 5)"""
+        stdout, stderr = run(code, memo=["g"])
+        self.assertEqual(stdout, "5\n()\n5\n()\n")
+        self.assertIn("not memoizing g", stderr)
+
+    def test_parameter_call_is_not_cached(self):
+        code = """(d call (q ((f x) (f x))))
+(call disp 5)
+(call disp 5)"""
+        stdout, stderr = run(code, memo=["call"])
+        self.assertEqual(stdout, "5\n()\n5\n()\n")
+
+    def test_call_with_error_is_not_cached(self):
+        code = """(d bad (q ((x) (s x (q y)))))
+(bad 1)
+(bad 1)"""
+        stdout, stderr = run(code, memo=["bad"])
+        self.assertEqual(stderr.count("Error: cannot subtract"), 2)
+
+
+class PureMacroTests(unittest.TestCase):
+    def test_expansion_is_cached(self):
+        code = """(d m (q (() (z) (c z ()))))
+(d f (q ((x) (m (a b)))))
+(f 1)
+(f 2)"""
+        environment = Program(pure_macros=["m"])
+        self.assertEqual(run(code, environment), ("((a b))\n((a b))\n", ""))
+        self.assertEqual(len(environment.expansions), 1)
+
+    def test_quoted_call_head_is_not_cached(self):
+        code = """(d m (q (() (z) ((q ((y) (disp y))) z))))
+(d show (q ((x) (m 4))))
+(show 1)
+(show 1)"""
+        stdout, stderr = run(code, pure_macros=["m"])
+        self.assertEqual(stdout, "4\n()\n4\n()\n")
+        self.assertIn("not caching results of m", stderr)
+
+    def test_profile_counts_are_unchanged(self):
+        code = """(d m (q (() (z) (c z ()))))
+(d f (q ((x) (m (a b)))))
+(d g (q ((x) (c (m (a b)) x))))
+(f 1)
+(f 2)
+(g 1)
+(g 2)"""
+        counts = []
+        for pure_macros in [(), ["m"]]:
+            environment = Program(pure_macros=pure_macros)
+            environment.profiler = tinylisp.Profiler(environment)
+            run(code, environment)
+            records = environment.profiler.records
+            counts.append({name: (record.calls, record.tail_calls)
+                           for name, record in records.items()})
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[1]["m"], (2, 2))
+
+
+class PmapTests(unittest.TestCase):
+    code = """(d sq (q ((x) (c x (c (a x x) ())))))
+(d nums (q (9 3 7 1 8 2 6 4 5 0 12 11)))
+(disp (pmap sq nums %s))
+(disp (pmap h (q ((1 2) (3 4) (5 6))) %s))"""
+    expected = ("((9 18) (3 6) (7 14) (1 2) (8 16) (2 4) (6 12) (4 8)"
+                " (5 10) (0 0) (12 24) (11 22))\n(1 3 5)\n")
+
+    def test_results_are_in_order(self):
+        # Pretend there are several processors, so that workers are used
+        with mock.patch("os.cpu_count", return_value=4):
+            for chunk in ["", "1", "5", "100"]:
+                with self.subTest(chunk=chunk):
+                    self.assertEqual(run(self.code % (chunk, chunk)),
+                                     (self.expected, ""))
+
+    def test_errors(self):
+        stdout, stderr = run("(pmap (q (() (x) x)) (q (1)))")
+        self.assertIn("pmap needs a function, not a macro", stderr)
+        stdout, stderr = run("(pmap h (q (1)) 0)")
+        self.assertIn("must be a positive Int", stderr)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "--serve needs os.fork")
+class ServeTests(unittest.TestCase):
+    def serve(self, requests, *args):
+        lines = "".join(json.dumps(request) + "\n" for request in requests)
+        result = subprocess.run([sys.executable, TINYLISP, "--serve", *args],
+                                input=lines, capture_output=True, text=True,
+                                timeout=60)
+        return [json.loads(line) for line in result.stdout.splitlines()]
+
+    def test_output_is_not_echoed(self):
+        response, = self.serve([{"code": "(disp 5) (d x 1)", "id": 1}])
+        self.assertEqual(response["id"], 1)
+        self.assertEqual(response["status"], "ok")
+        self.assertEqual(response["stdout"], "5\n")
+        self.assertEqual(response["result"], "x")
+
+    def test_requests_are_isolated(self):
+        first, second = self.serve([{"code": "(d x 1) x"}, {"code": "x"}])
+        self.assertEqual(first["result"], "1")
+        self.assertEqual(second["result"], "()")
+        self.assertIn("undefined name x", second["stderr"])
+
+    def test_timeout(self):
+        code = "(d loop (q ((n) (loop n)))) (loop 1)"
+        response, = self.serve([{"code": code, "timeout": 0.2}])
+        self.assertEqual(response["status"], "timeout")
+
+    def test_invalid_request(self):
+        response, = self.serve(["(disp 5)"])
+        self.assertEqual(response["status"], "invalid")
+
+    def test_import_without_unix_sockets(self):
+        code = ("import socketserver\n"
+                "del socketserver.ForkingMixIn\n"
+                "del socketserver.UnixStreamServer\n"
+                "import tinylisp\n")
+        result = subprocess.run([sys.executable, "-c", code],
+                                cwd=os.path.dirname(TINYLISP),
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
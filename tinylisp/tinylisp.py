@@ -2,8 +2,22 @@
 
 import sys
 import os
-from contextlib import contextmanager
-from itertools import zip_longest
+import argparse
+import atexit
+import re
+import io
+import math
+import hashlib
+import marshal
+import json
+import time
+import select
+import signal
+import socketserver
+from array import array
+from collections import OrderedDict
+from contextlib import redirect_stdout, redirect_stderr
+from itertools import chain, zip_longest
 
 
 whitespace = " \t\n\r"
@@ -26,27 +40,120 @@ def warn(*args):
     print("Warning:", *args, file=sys.stderr)
 
 
+# Number of characters of output to collect before writing them out
+
+OUTPUT_BUFFER_SIZE = 65536
+
+
+class Output:
+    """Buffer for the output of disp.
+
+Text is collected and written to sys.stdout in large pieces. When it is
+written out also depends on the flush policy: "disp" flushes after each
+value that disp shows, "exit" only when the buffer is full or the
+program ends, and "auto" acts like "disp" if stdout is a terminal or
+Python is running unbuffered (-u), and like "exit" otherwise. If
+sys.stdout is replaced, text collected before that is written to the
+stream it was meant for.
+"""
+
+    policies = ["auto", "disp", "exit"]
+
+    def __init__(self, policy="auto"):
+        self.policy = policy
+        self.chunks = []
+        self.size = 0
+        self.stream = None
+        self.interactive = False
+
+    def write(self, text):
+        if sys.stdout is not self.stream:
+            self.flush()
+            self.stream = sys.stdout
+            try:
+                self.interactive = (self.stream.isatty()
+                                    or getattr(self.stream, "write_through",
+                                               False))
+            except (AttributeError, ValueError):
+                self.interactive = False
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def end_value(self):
+        """Flush after a value has been shown, if the policy says so."""
+        if self.policy == "disp" or self.policy == "auto" and self.interactive:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            text = "".join(self.chunks)
+            self.chunks = []
+            self.size = 0
+            self.stream.write(text)
+            self.stream.flush()
+
+
+output = Output()
+atexit.register(output.flush)
+
+
+# Regex that matches a single token: a parenthesis or a run of characters
+# that are neither parentheses nor whitespace
+token_regex = re.compile("[%s]|[^%s]+" % (re.escape(symbols),
+                                          re.escape(symbols + whitespace)))
+
+
 def scan(code):
-    """Take a string and yield a series of tokens."""
-    # Add a space to the end to allow peeking at the next character
-    # without requiring a check for end-of-string
-    code += " "
-    i = 0
-    while i < len(code):
-        char = code[i]
-        if char in whitespace:
-            # Whitespace (ignore)
-            pass
-        elif char in symbols:
-            # Reserved symbol
-            yield char
+    """Take a string and yield a series of tokens.
+
+The code can also be an iterable of lines (such as a file), in which
+case the lines are scanned one at a time as they are read.
+"""
+    if isinstance(code, str):
+        code = [code]
+    for line in code:
+        yield from token_regex.findall(line)
+
+
+def parse_forms(code):
+    """Take code and yield the expressions in it one at a time.
+
+The code can be a string or an iterator that yields tokens. Each
+top-level expression is yielded as soon as it is complete. Any lists
+still open at the end of the code are closed; an unmatched closing
+parenthesis ends the code. The parser keeps its own stack of open
+lists, so nesting depth is not limited by Python's recursion limit.
+"""
+    if isinstance(code, str):
+        # If we're given a raw codestring, scan it before parsing
+        code = scan(code)
+    # Items of the lists that are currently open, innermost last
+    open_lists = []
+    for token in code:
+        if token == "(":
+            open_lists.append([])
+            continue
+        elif token == ")":
+            if not open_lists:
+                return
+            element = to_cons(open_lists.pop())
+        elif token.isdigit():
+            element = int(token)
+        else:
+            element = token
+        if open_lists:
+            open_lists[-1].append(element)
+        else:
+            yield element
+    # Close any lists that are still open
+    while open_lists:
+        element = to_cons(open_lists.pop())
+        if open_lists:
+            open_lists[-1].append(element)
         else:
-            # Start of a name or literal--scan till the end of it
-            a = i
-            while code[i+1] not in whitespace + symbols:
-                i += 1
-            yield code[a:i+1]
-        i += 1
+            yield element
 
 
 def parse(code):
@@ -55,22 +162,99 @@ def parse(code):
 The code can be a string or an iterator that yields tokens.
 The resulting parse tree is a tinylisp list (i.e. nested tuples).
 """
-    if isinstance(code, str):
-        # If we're given a raw codestring, scan it before parsing
-        code = scan(code)
-    try:
-        token = next(code)
-    except StopIteration:
-        token = ")"
-    if token == "(":
-        element = parse(code)
-    elif token == ")":
-        return nil
-    elif token.isdigit():
-        element = int(token)
-    else:
-        element = token
-    return (element, parse(code))
+    return to_cons(parse_forms(code))
+
+
+def read_forms(lines):
+    """Take an iterable of lines of code and yield its expressions.
+
+The code can be in single-line or multiline form:
+In single-line form, the code is parsed one line at a time with closing
+parentheses inferred at the end of each line
+In multiline form, the code is parsed as a whole, with closing
+parentheses inferred only at the end
+If any line in the code contains more closing parens than opening
+parens, the code is assumed to be in multiline form; otherwise, it's
+single-line
+
+Lines that hold only complete expressions parse the same way in either
+form, so their expressions are yielded right away. Other lines are
+held back until a line with extra closing parens shows that the code is
+in multiline form (after which everything is streamed) or the end of
+the code shows that it is in single-line form.
+"""
+    lines = iter(lines)
+    pending = []
+    for line in lines:
+        if line.count(")") > line.count("("):
+            # Multiline form
+            yield from parse_forms(scan(chain(pending, [line], lines)))
+            return
+        elif pending or not is_balanced(line):
+            pending.append(line)
+        else:
+            yield from parse_forms(line)
+    # Single-line form
+    for line in pending:
+        yield from parse_forms(line)
+
+
+def is_balanced(line):
+    """Check whether a line of code consists of complete expressions."""
+    depth = 0
+    for char in line:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def display_text(value):
+    """Return the text that disp shows for a value.
+
+Lists are rendered with an explicit stack, so that any depth of
+nesting can be shown.
+"""
+    parts = []
+    # Tails of the lists whose items are being rendered
+    tails = []
+    while True:
+        if isinstance(value, tuple):
+            if value:
+                parts.append("(")
+                tails.append(value[1])
+                value = value[0]
+                continue
+            parts.append("()")
+        elif isinstance(value, (int, str)):
+            parts.append(str(value))
+        else:
+            # One of the builtin functions or macros
+            parts.append("<builtin %s %s>"
+                         % ("macro" if value.is_macro else "function",
+                            value.__name__))
+        # Go on to the next item, closing any lists that have ended
+        while tails:
+            tail = tails.pop()
+            if tail:
+                parts.append(" ")
+                tails.append(tail[1])
+                value = tail[0]
+                break
+            parts.append(")")
+        else:
+            return "".join(parts)
+
+
+def to_cons(items):
+    """Build a cons chain of nested tuples from a Python iterable."""
+    result = nil
+    for item in reversed(list(items)):
+        result = (item, result)
+    return result
 
 
 def cons_iter(nested_tuple):
@@ -95,6 +279,7 @@ builtins = {"tl_cons": "c",
             "tl_disp": "disp",
             "tl_string": "string",
             "tl_chars": "chars",
+            "tl_pmap": "pmap",
             # The following five are macros:
             "tl_def": "d",
             "tl_if": "i",
@@ -118,6 +303,13 @@ top_level_quiet_fns = ["tl_def", "tl_disp", "tl_load", "tl_comment"]
 top_level_only_fns = ["tl_load", "tl_comment", "tl_help", "tl_restart",
                       "tl_quit"]
 
+# These are builtins that have side effects, or (in the case of tl_eval)
+# can run code that isn't known in advance; functions that use them are
+# never memoized
+
+side_effect_fns = ["tl_disp", "tl_def", "tl_eval", "tl_load", "tl_restart",
+                   "tl_quit"]
+
 
 # Decorators for member functions that implement builtins
 
@@ -131,56 +323,1261 @@ def function(pyfunc):
     return pyfunc
 
 
+# Marker for a global name that has not been defined yet
+
+unbound = object()
+
+# Maximum number of resolved or compiled function bodies to cache
+
+CODE_CACHE_SIZE = 10000
+
+# Codec that converts the bytes of an array of char codes (as unsigned
+# 4-byte ints in the machine's byte order) to a name
+
+CHAR_CODES = ("utf-32-le" if sys.byteorder == "little" else "utf-32-be",
+              "surrogatepass")
+
+# Flag of a Python code object that takes *args (inspect.CO_VARARGS)
+
+CO_VARARGS = 0x04
+
+
+class Cell:
+    """Holds the global binding of a name, for use in resolved code."""
+    __slots__ = ("name", "value")
+
+    def __init__(self, name, value=unbound):
+        self.name = name
+        self.value = value
+
+
+class Slot:
+    """Refers to a parameter by its index in a call's frame."""
+    __slots__ = ("name", "index")
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+
+class ResolvedCall:
+    """A list expression whose names have been resolved.
+
+The original code is kept so that it can be passed to macros
+unevaluated. The arguments are resolved the first time they are
+needed, since quoted data doesn't need resolving at all.
+"""
+    __slots__ = ("form", "head", "layout", "argc", "args")
+
+    def __init__(self, form, head, layout):
+        self.form = form
+        self.head = head
+        self.layout = layout
+        self.argc = sum(1 for arg in cons_iter(form[1]))
+        self.args = None
+
+
+class GlobalNames(dict):
+    """Symbol table for global names.
+
+Besides working as a regular dictionary, it gives out a Cell for each
+name that resolved code refers to and keeps the cell up to date when
+the name is defined.
+"""
+
+    def __init__(self):
+        super().__init__()
+        self.cells = {}
+        # Counts bindings, so that users of the table can tell when
+        # names have been defined
+        self.version = 0
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self.version += 1
+        if name in self.cells:
+            self.cells[name].value = value
+
+    def cell(self, name):
+        if name not in self.cells:
+            value = self.get(name, unbound)
+            if type(value) is LazyDefinition:
+                value = value.force()
+            self.cells[name] = Cell(name, value)
+        return self.cells[name]
+
+
+class LazyDefinition:
+    """Stands in for a global name whose module definition hasn't run.
+
+With lazy loading, a module's top-level definitions that only call an
+expansion-pure macro (such as lambda) are bound to one of these instead
+of being evaluated. The first lookup of the name forces the definition:
+it is evaluated as it would have been while loading the module, and the
+name is bound to the result.
+"""
+    __slots__ = ("program", "name", "value", "module_path")
+
+    def __init__(self, program, name, value, module_path):
+        self.program = program
+        self.name = name
+        self.value = value
+        self.module_path = module_path
+
+    def force(self):
+        program = self.program
+        global_names = program.global_names
+        if global_names.get(self.name) is not self:
+            # Forced in the meantime through another reference
+            return program.global_value(self.name)
+        del global_names[self.name]
+        # Evaluate the definition at top level of its module, where
+        # output is suppressed
+        frame, layout = program.frame, program.layout
+        program.frame, program.layout = [], {}
+        program.module_paths.append(self.module_path)
+        try:
+            program.tl_def(self.name, self.value)
+        finally:
+            program.module_paths.pop()
+            program.frame, program.layout = frame, layout
+        program.register_intrinsic(self.name)
+        return global_names[self.name]
+
+
+# Default maximum number of results to cache for each memoized function
+
+MEMO_SIZE = 10000
+
+
+class MemoTable:
+    """Cache of the results of a memoized function.
+
+Results are keyed by the tuple of argument values. When the cache is
+full, the least recently used result is evicted.
+"""
+
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return whether there is a result for the key, and the result."""
+        try:
+            result = self.results[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return True, result
+
+    def store(self, key, result):
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+# Maximum number of cells in the intern table for hash-consed lists
+
+CONS_TABLE_SIZE = 250000
+
+
+class ConsTable:
+    """Intern table for hash-consed list cells.
+
+A cell is canonical if it is the one stored in the table for its head
+and tail. Only cells whose head is an atom or a canonical cell, and
+whose tail is nil or a canonical cell, are interned, so two canonical
+lists are equal exactly when they are the same object. Tuples can't be
+weakly referenced, so the table holds its cells and is cleared when it
+fills up; cells from before that are no longer canonical and are
+compared item by item.
+"""
+
+    def __init__(self):
+        self.cells = {}
+
+    @staticmethod
+    def key(head, tail):
+        # Cells are looked up by identity, so that interning a cell
+        # doesn't have to hash a whole list
+        if isinstance(head, tuple):
+            return (id(head), id(tail), None)
+        else:
+            return (head, id(tail))
+
+    def canonical(self, cell):
+        return self.cells.get(self.key(*cell)) is cell
+
+    def cons(self, head, tail):
+        if ((isinstance(head, tuple) and head and not self.canonical(head))
+                or (tail and not self.canonical(tail))):
+            return (head, tail)
+        key = self.key(head, tail)
+        cell = self.cells.get(key)
+        if cell is None:
+            if len(self.cells) >= CONS_TABLE_SIZE:
+                # Clearing the table makes head and tail non-canonical
+                self.cells.clear()
+                return (head, tail)
+            cell = self.cells[key] = (head, tail)
+        return cell
+
+    def equal(self, value1, value2):
+        if value1 is value2:
+            return True
+        if (isinstance(value1, tuple) and isinstance(value2, tuple)
+                and value1 and value2
+                and self.canonical(value1) and self.canonical(value2)):
+            return False
+        return value1 == value2
+
+
+def param_layout(param_names):
+    """Map each parameter name of a function to an index in its frame."""
+    layout = {}
+    if isinstance(param_names, tuple):
+        for name in cons_iter(param_names):
+            if isinstance(name, str) and name not in layout:
+                layout[name] = len(layout)
+    elif isinstance(param_names, str):
+        layout[param_names] = 0
+    return layout
+
+
+class CallPlan:
+    """How to bind the arguments of a call to a function's parameters.
+
+The plan is worked out the first time the function is called, so that
+a call only has to compare the number of arguments with param_count
+(which is None if the parameters are a single name that receives all
+the arguments, and -1 if they are invalid). The parameters that shadow
+global names are looked up again whenever more names have been defined.
+"""
+    __slots__ = ("param_count", "names", "slots", "shadows", "global_count")
+
+    def __init__(self, param_names, layout):
+        if isinstance(param_names, str):
+            self.param_count = None
+            self.names = (param_names,)
+        elif (isinstance(param_names, tuple)
+                and all(isinstance(name, str)
+                        for name in cons_iter(param_names))):
+            self.names = tuple(cons_iter(param_names))
+            self.param_count = len(self.names)
+        else:
+            # bind_params gives the error message
+            self.param_count = -1
+            self.names = ()
+        # Frame index of each argument, or None if the arguments fill
+        # the frame in order (as they do unless some name is repeated)
+        slots = tuple(layout[name] for name in self.names)
+        self.slots = None if slots == tuple(range(len(layout))) else slots
+        self.shadows = ()
+        self.global_count = -1
+
+    def shadowed(self, global_names):
+        """Return the parameter names that shadow global names."""
+        if self.global_count != len(global_names):
+            self.shadows = tuple(name for name in self.names
+                                 if name in global_names)
+            self.global_count = len(global_names)
+        return self.shadows
+
+
+class BuiltinPlan:
+    """What a call to a builtin needs to know about it."""
+    __slots__ = ("name", "is_macro", "top_level_only", "min_args",
+                 "max_args")
+
+    def __init__(self, builtin):
+        code = builtin.__code__
+        self.name = builtin.__name__
+        self.is_macro = builtin.is_macro
+        self.top_level_only = self.name in top_level_only_fns
+        # Numbers of arguments the builtin takes, not counting self; a
+        # maximum of None means any number
+        param_count = code.co_argcount - 1
+        self.min_args = param_count - len(builtin.__defaults__ or ())
+        self.max_args = None if code.co_flags & CO_VARARGS else param_count
+
+    def takes(self, argc):
+        return (self.min_args <= argc
+                and (self.max_args is None or argc <= self.max_args))
+
+
+# Native implementations of standard library functions, keyed by the
+# name the library defines them under. Each is stored with a digest of
+# the library definition (see Program.definition_digest), so that it
+# only replaces a definition that is known to give the same results.
+# An intrinsic returns NotImplemented for arguments it doesn't handle,
+# and the call goes ahead with the tinylisp definition instead.
+
+intrinsics = {}
+
+
+def intrinsic(name, digest):
+    def register(pyfunc):
+        intrinsics[name] = (digest, pyfunc)
+        return pyfunc
+    return register
+
+
+def int_items(value):
+    """Return the items of a list of Ints, or None if it isn't one."""
+    if isinstance(value, tuple):
+        items = list(cons_iter(value))
+        if all(type(item) is int for item in items):
+            return items
+    return None
+
+
+def sortable_items(value):
+    """Return the items of a list of all Ints or all Names, or None."""
+    if isinstance(value, tuple):
+        items = list(cons_iter(value))
+        if (all(type(item) is int for item in items)
+                or all(type(item) is str for item in items)):
+            return items
+    return None
+
+
+def factors(num):
+    """Prime factors of a positive integer, in increasing order."""
+    result = []
+    factor = 2
+    while factor * factor <= num:
+        while num % factor == 0:
+            result.append(factor)
+            num //= factor
+        factor += 1
+    if num > 1:
+        result.append(num)
+    return result
+
+
+@intrinsic("abs", "7de925c87f1f7ff4")
+def intrinsic_abs(num):
+    if type(num) is int:
+        return abs(num)
+    return NotImplemented
+
+
+@intrinsic("-", "50a51a8ee7fe6b78")
+def intrinsic_sub(args):
+    args = int_items(args)
+    if args is None:
+        return NotImplemented
+    elif not args:
+        return 0
+    elif len(args) == 1:
+        return -args[0]
+    return args[0] - sum(args[1:])
+
+
+@intrinsic("+", "4172da6e05f6ce06")
+def intrinsic_add(args):
+    args = int_items(args)
+    if args is None:
+        return NotImplemented
+    return sum(args)
+
+
+@intrinsic("sum", "0cc645bd47c64a0e")
+def intrinsic_sum(lyst):
+    items = int_items(lyst)
+    if items is None:
+        return NotImplemented
+    return sum(items)
+
+
+@intrinsic("mul2", "56e51138f34f4e6a")
+def intrinsic_mul2(factor1, factor2):
+    if type(factor1) is int and type(factor2) is int:
+        return factor1 * factor2
+    return NotImplemented
+
+
+@intrinsic("*", "95800478ba0ab67a")
+def intrinsic_mul(args):
+    args = int_items(args)
+    if args is None:
+        return NotImplemented
+    return math.prod(args)
+
+
+@intrinsic("product", "7ac823fbff9d241a")
+def intrinsic_product(lyst):
+    items = int_items(lyst)
+    if items is None:
+        return NotImplemented
+    return math.prod(items)
+
+
+@intrinsic("div2", "db5429957a19e62f")
+def intrinsic_div2(dividend, divisor):
+    if type(dividend) is int and type(divisor) is int:
+        if divisor:
+            return dividend // divisor
+        return nil
+    return NotImplemented
+
+
+@intrinsic("/", "8fc4662c3160af48")
+def intrinsic_div(args):
+    args = int_items(args)
+    if args is None:
+        return NotImplemented
+    elif not args:
+        return 1
+    elif len(args) == 1:
+        args = [1] + args
+    # Dividing by zero gives nil, which is only a valid result if it's
+    # the last division
+    if 0 in args[1:-1]:
+        return NotImplemented
+    elif args[-1] == 0:
+        return nil
+    result = args[0]
+    for divisor in args[1:]:
+        result //= divisor
+    return result
+
+
+@intrinsic("mod", "eaf9bcaf1ba4da99")
+def intrinsic_mod(num, modulus):
+    if type(num) is int and type(modulus) is int:
+        if modulus:
+            return num % modulus
+        return nil
+    return NotImplemented
+
+
+@intrinsic("divides?", "b093884310aac04b")
+def intrinsic_divides(divisor, multiple):
+    if type(divisor) is int and type(multiple) is int:
+        if divisor:
+            return int(multiple % divisor == 0)
+        return 0
+    return NotImplemented
+
+
+# The library only counts nonnegative numbers as even
+
+@intrinsic("even?", "53cc62700e654e03")
+def intrinsic_even(num):
+    if type(num) is int:
+        return int(num >= 0 and num % 2 == 0)
+    return NotImplemented
+
+
+@intrinsic("odd?", "ce7a473d2151754f")
+def intrinsic_odd(num):
+    if type(num) is int:
+        return int(not (num >= 0 and num % 2 == 0))
+    return NotImplemented
+
+
+@intrinsic("pow", "4eb179905510b8aa")
+def intrinsic_pow(base, exponent):
+    if type(base) is int and type(exponent) is int:
+        if exponent >= 0:
+            return base ** exponent
+        elif base == 0:
+            return nil
+        elif abs(base) == 1:
+            return base ** -exponent
+        return 0
+    return NotImplemented
+
+
+@intrinsic("gcd", "cfa52280b9bc5990")
+def intrinsic_gcd(num1, num2):
+    if type(num1) is int and type(num2) is int:
+        return math.gcd(num1, num2)
+    return NotImplemented
+
+
+@intrinsic("to-base", "4413ac61a7e13232")
+def intrinsic_to_base(base, num):
+    if type(base) is int and type(num) is int:
+        if base < 1:
+            return nil
+        elif base == 1:
+            return to_cons([1] * num)
+        digits = nil
+        while num > 0:
+            num, digit = divmod(num, base)
+            digits = (digit, digits)
+        return digits
+    return NotImplemented
+
+
+@intrinsic("from-base", "cd5e6e32ef24069f")
+def intrinsic_from_base(base, digits):
+    digits = int_items(digits)
+    if type(base) is int and digits is not None:
+        result = 0
+        for digit in digits:
+            result = result * base + digit
+        return result
+    return NotImplemented
+
+
+@intrinsic("max", "a09901d8cc7c5b02")
+def intrinsic_max(lyst):
+    items = int_items(lyst)
+    if items is None:
+        return NotImplemented
+    return max(items) if items else nil
+
+
+@intrinsic("min", "a22b12b5cf5fbd60")
+def intrinsic_min(lyst):
+    items = int_items(lyst)
+    if items is None:
+        return NotImplemented
+    return min(items) if items else nil
+
+
+@intrinsic("factorial", "1c931dfd4612ea51")
+def intrinsic_factorial(num):
+    if type(num) is int:
+        return math.factorial(num) if num > 0 else 1
+    return NotImplemented
+
+
+@intrinsic("prime?", "63e530a83a5bcb09")
+def intrinsic_is_prime(num):
+    if type(num) is int:
+        if num == -1:
+            return 1
+        return int(num >= 2 and factors(num) == [num])
+    return NotImplemented
+
+
+@intrinsic("prime-factors", "d082246793406201")
+def intrinsic_prime_factors(num):
+    if type(num) is int:
+        if num == 0:
+            return (0, nil)
+        result = (-1, nil) if num < 0 else nil
+        for factor in factors(abs(num)):
+            result = (factor, result)
+        return result
+    return NotImplemented
+
+
+@intrinsic("length", "146f45bc4779e0c7")
+def intrinsic_length(lyst):
+    if isinstance(lyst, tuple):
+        return sum(1 for item in cons_iter(lyst))
+    return NotImplemented
+
+
+@intrinsic("nth", "89aaf9b7c107e0ea")
+def intrinsic_nth(lyst, index):
+    if type(index) is not int or index < 0:
+        return nil
+    while index and lyst and isinstance(lyst, tuple):
+        lyst = lyst[1]
+        index -= 1
+    if lyst == nil:
+        return nil
+    elif index or not isinstance(lyst, tuple):
+        return NotImplemented
+    return lyst[0]
+
+
+@intrinsic("last", "41c502e2f06c7450")
+def intrinsic_last(lyst):
+    if isinstance(lyst, tuple):
+        item = nil
+        for item in cons_iter(lyst):
+            pass
+        return item
+    return NotImplemented
+
+
+@intrinsic("reverse", "33b6fcf06dbdc888")
+def intrinsic_reverse(lyst):
+    if isinstance(lyst, tuple):
+        result = nil
+        for item in cons_iter(lyst):
+            result = (item, result)
+        return result
+    return NotImplemented
+
+
+@intrinsic("concat", "af9fdfe7f9e8f1a5")
+def intrinsic_concat(front, back):
+    if isinstance(front, tuple) and (isinstance(back, tuple) or not front):
+        for item in reversed(list(cons_iter(front))):
+            back = (item, back)
+        return back
+    return NotImplemented
+
+
+@intrinsic("insert-end", "9582b736d50606af")
+def intrinsic_insert_end(value, lyst):
+    if isinstance(lyst, tuple):
+        return to_cons(chain(cons_iter(lyst), [value]))
+    return NotImplemented
+
+
+@intrinsic("contains?", "23a46fa7f5ef8e46")
+def intrinsic_contains(lyst, item):
+    if isinstance(lyst, tuple):
+        return int(item in cons_iter(lyst))
+    return NotImplemented
+
+
+@intrinsic("count-occurrences", "f5baefcc98885ac3")
+def intrinsic_count_occurrences(lyst, item):
+    if isinstance(lyst, tuple):
+        return sum(1 for value in cons_iter(lyst) if value == item)
+    return NotImplemented
+
+
+@intrinsic("first-index", "e10f5ebcbe5dc063")
+def intrinsic_first_index(lyst, item):
+    if isinstance(lyst, tuple):
+        for index, value in enumerate(cons_iter(lyst)):
+            if value == item:
+                return index
+        return nil
+    return NotImplemented
+
+
+@intrinsic("last-index", "6afbe98980996bf7")
+def intrinsic_last_index(lyst, item):
+    if isinstance(lyst, tuple):
+        result = nil
+        for index, value in enumerate(cons_iter(lyst)):
+            if value == item:
+                result = index
+        return result
+    return NotImplemented
+
+
+@intrinsic("repeat-val", "a5a7f4516f8d3644")
+def intrinsic_repeat_val(value, count):
+    if type(count) is int:
+        result = nil
+        for i in range(count):
+            result = (value, result)
+        return result
+    return NotImplemented
+
+
+def int_range(lower, upper):
+    """List of the Ints from lower up to upper, inclusive."""
+    if type(lower) is int and type(upper) is int:
+        return to_cons(range(lower, upper + 1))
+    return NotImplemented
+
+
+def reverse_int_range(upper, lower):
+    """List of the Ints from upper down to lower, inclusive."""
+    if type(lower) is int and type(upper) is int:
+        return to_cons(range(upper, lower - 1, -1))
+    return NotImplemented
+
+
+intrinsic("inclusive-range", "81cc38ef278f331c")(int_range)
+intrinsic("reverse-inclusive-range", "53b9dccd0e770e69")(reverse_int_range)
+
+
+@intrinsic("0to", "9aa086deda8bd14b")
+def intrinsic_0to(num):
+    return int_range(0, num)
+
+
+@intrinsic("1to", "d0e3a3932966c6d9")
+def intrinsic_1to(num):
+    return int_range(1, num)
+
+
+@intrinsic("to0", "5217473abb0548d9")
+def intrinsic_to0(num):
+    return reverse_int_range(num, 0)
+
+
+@intrinsic("to1", "f181a0cf003e3a45")
+def intrinsic_to1(num):
+    return reverse_int_range(num, 1)
+
+
+@intrinsic("range", "8b5ffbdce1a2b6d1")
+def intrinsic_range(args):
+    args = list(cons_iter(args))
+    if len(args) == 1 and type(args[0]) is int:
+        return int_range(0, args[0] - 1)
+    elif len(args) > 1 and type(args[1]) is int:
+        return int_range(args[0], args[1] - 1)
+    return NotImplemented
+
+
+@intrinsic("insertion-sort", "815123974c9a2a42")
+def intrinsic_insertion_sort(lyst):
+    items = sortable_items(lyst)
+    if items is None:
+        return NotImplemented
+    return to_cons(sorted(items))
+
+
+@intrinsic("merge-sort", "0f27ba1db33c359d")
+def intrinsic_merge_sort(lyst):
+    items = sortable_items(lyst)
+    if items is None:
+        return NotImplemented
+    return to_cons(sorted(items))
+
+
+# String intrinsics, which work on names directly instead of on lists of
+# char codes
+
+def name_items(value):
+    """Return the items of a list of Names, or None if it isn't one."""
+    if isinstance(value, tuple):
+        items = list(cons_iter(value))
+        if all(type(item) is str for item in items):
+            return items
+    return None
+
+
+@intrinsic("strlen", "68722e378962ec13")
+def intrinsic_strlen(name):
+    if type(name) is str:
+        return len(name)
+    return NotImplemented
+
+
+@intrinsic("strcat", "0a81cdc3d02ce4ca")
+def intrinsic_strcat(name1, name2):
+    if type(name1) is str and type(name2) is str:
+        return name1 + name2
+    return NotImplemented
+
+
+@intrinsic("starts-with?", "30f2cd6cdf4b747b")
+def intrinsic_starts_with(name, prefix):
+    if type(name) is str and type(prefix) is str:
+        return int(name.startswith(prefix))
+    return NotImplemented
+
+
+@intrinsic("join2", "d455d7fd5a46daf7")
+def intrinsic_join2(name1, name2, sep):
+    if type(name1) is str and type(name2) is str and type(sep) is str:
+        return name1 + sep + name2
+    return NotImplemented
+
+
+@intrinsic("join", "af74d5bfed425489")
+def intrinsic_join(names, sep):
+    items = name_items(names)
+    if items is None or type(sep) is not str:
+        return NotImplemented
+    return sep.join(items)
+
+
+# Matrix intrinsics, which need NumPy; without it, matrices.tl runs as
+# tinylisp code. NumPy is slow to import, so that waits until a matrix
+# intrinsic is called.
+
+numpy = None
+numpy_checked = False
+
+
+def import_numpy():
+    """Import NumPy if possible; return the module, or None."""
+    global numpy, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def int_matrix(value):
+    """Convert a rectangular matrix of Ints to a NumPy array.
+
+Returns None if NumPy isn't available or the value isn't a nonempty
+list of equally long lists of Ints. The array holds int64s if sums of
+its items can't overflow, and Python ints otherwise.
+"""
+    if not (value and isinstance(value, tuple)) or import_numpy() is None:
+        return None
+    rows = []
+    for row in cons_iter(value):
+        items = int_items(row)
+        if items is None or rows and len(items) != len(rows[0]):
+            return None
+        rows.append(items)
+    limit = max((abs(item) for row in rows for item in row), default=0)
+    if limit * len(rows) * max(len(rows[0]), 1) < 2 ** 63:
+        dtype = numpy.int64
+    else:
+        dtype = object
+    return numpy.array(rows, dtype=dtype).reshape(len(rows), len(rows[0]))
+
+
+def from_matrix(array):
+    """Convert a NumPy array back to nested tinylisp lists."""
+    return to_cons(to_cons(row) for row in array.tolist())
+
+
+@intrinsic("transpose", "7438b73096458c70")
+def intrinsic_transpose(matrix):
+    if matrix == nil:
+        return nil
+    array = int_matrix(matrix)
+    if array is None:
+        return NotImplemented
+    return from_matrix(array.T)
+
+
+@intrinsic("zip", "e834102cf39cdf69")
+def intrinsic_zip(lists):
+    return intrinsic_transpose(lists)
+
+
+@intrinsic("main-diagonal", "3d467d6a52ab5584")
+def intrinsic_main_diagonal(matrix):
+    array = int_matrix(matrix)
+    if array is None:
+        return NotImplemented
+    return to_cons(numpy.diagonal(array).tolist())
+
+
+@intrinsic("trace", "a07c1667c47881e1")
+def intrinsic_trace(matrix):
+    array = int_matrix(matrix)
+    if array is None:
+        return NotImplemented
+    return int(numpy.trace(array))
+
+
+# Builtins that map* can apply to whole arrays at once
+
+elementwise_builtins = {"tl_add2": lambda x, y: x + y,
+                        "tl_sub2": lambda x, y: x - y,
+                        "tl_less2": lambda x, y: (x < y).astype(numpy.int64),
+                        "tl_eq2": lambda x, y: (x == y).astype(numpy.int64),
+                        }
+
+
+@intrinsic("map*", "a1fdc0603e76d804")
+def intrinsic_map_star(func_and_lists):
+    func = func_and_lists[0] if func_and_lists else nil
+    if not (isinstance(getattr(func, "__self__", None), Program)
+            and func.__name__ in elementwise_builtins):
+        return NotImplemented
+    array = int_matrix(func_and_lists[1])
+    if array is None or len(array) != 2:
+        return NotImplemented
+    result = elementwise_builtins[func.__name__](array[0], array[1])
+    return to_cons(result.tolist())
+
+
+# Parsed modules are cached in this directory, next to their source
+# files; changing CACHE_VERSION invalidates existing cache files
+
+CACHE_DIRECTORY = "__tlcache__"
+CACHE_VERSION = 1
+
+
+def cache_path(abspath):
+    directory, filename = os.path.split(abspath)
+    return os.path.join(directory, CACHE_DIRECTORY, filename + "c")
+
+
+def read_module(abspath, use_cache=True):
+    """Return an iterator over the expressions in a module file.
+
+The expressions are parsed as the file is read, so that each one can
+run before the rest are parsed. They are also kept in a cache file,
+which is used instead of the source as long as the source's
+modification time and size, or failing that its content hash, are
+unchanged. Raises OSError if the module can't be opened.
+"""
+    return module_forms(open(abspath), abspath, use_cache)
+
+
+def module_forms(module_file, abspath, use_cache):
+    """Yield the expressions for read_module, then update the cache."""
+    with module_file:
+        if not use_cache:
+            yield from read_forms(module_file)
+            return
+        stat = os.fstat(module_file.fileno())
+        cached = read_cache(abspath)
+        if cached is not None:
+            if cached[2:4] == (stat.st_mtime_ns, stat.st_size):
+                yield from cached[5]
+                return
+            source = module_file.read()
+            digest = hashlib.sha256(source.encode(errors="surrogateescape"))
+            if cached[4] == digest.hexdigest():
+                forms = cached[5]
+                yield from forms
+            else:
+                forms = yield from parse_module(source.split("\n"))
+        else:
+            # Hash the lines as they are read
+            digest = hashlib.sha256()
+            forms = yield from parse_module(hashed_lines(module_file,
+                                                         digest))
+    write_cache(abspath, (CACHE_VERSION, abspath, stat.st_mtime_ns,
+                          stat.st_size, digest.hexdigest(), forms))
+
+
+def parse_module(lines):
+    """Yield the expressions in the lines, then return them as a tuple."""
+    forms = []
+    for form in read_forms(lines):
+        forms.append(form)
+        yield form
+    return tuple(forms)
+
+
+def hashed_lines(lines, digest):
+    """Yield the lines, adding each one to a hashlib digest."""
+    for line in lines:
+        digest.update(line.encode(errors="surrogateescape"))
+        yield line
+
+
+def read_cache(abspath):
+    """Return the cache entry for a module, or None if there isn't one."""
+    try:
+        with open(cache_path(abspath), "rb") as cache_file:
+            cached = marshal.loads(cache_file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (isinstance(cached, tuple) and len(cached) == 6
+            and cached[:2] == (CACHE_VERSION, abspath)):
+        return cached
+    return None
+
+
+def write_cache(abspath, entry):
+    """Write the cache entry for a module, if possible."""
+    path = cache_path(abspath)
+    try:
+        data = marshal.dumps(entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that other processes never
+        # see a partly written cache file
+        temp_path = "%s.%d" % (path, os.getpid())
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, path)
+    except (OSError, ValueError):
+        # The cache is only an optimization (and marshal can't handle
+        # very deeply nested code)
+        pass
+
+
+# Version of the image format written by Program.save_image
+
+IMAGE_VERSION = 2
+
+
 # Exception that is raised by the (quit) macro
 
 class UserQuit(BaseException):
     pass
 
 
+class EvaluationLimit(Exception):
+    """Raised when evaluation goes over a limit set on the VM."""
+    pass
+
+
+def memory_use():
+    """Return the memory used by this process in bytes, or None if it
+can't be found out.
+
+Where the current resident size isn't available, the peak is used.
+"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Per-function statistics gathered with --profile
+
+class ProfileRecord:
+    __slots__ = ("name", "calls", "tail_calls", "builtin_calls",
+                 "self_time", "total_time", "active")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.tail_calls = 0
+        self.builtin_calls = 0
+        self.self_time = 0.0
+        self.total_time = 0.0
+        # Number of calls of the function that haven't returned yet;
+        # total time is only counted for the outermost one
+        self.active = 0
+
+    def as_dict(self):
+        return {"name": self.name,
+                "calls": self.calls,
+                "tail_calls": self.tail_calls,
+                "builtin_calls": self.builtin_calls,
+                "self_time": self.self_time,
+                "total_time": self.total_time,
+                }
+
+
+class Profiler:
+    """Collects call statistics for the functions a Program runs.
+
+Program.run_call reports each call of a user-defined function or macro
+and each tail call its loop makes; builtin calls are counted toward
+the function whose body makes them. Functions are recorded under the
+global name they are bound to. Anonymous functions share one record,
+and code outside any function counts as the top level.
+"""
+
+    TOP_LEVEL = "(top level)"
+    ANONYMOUS = "(anonymous)"
+
+    def __init__(self, program):
+        self.program = program
+        self.records = {}
+        self.builtin_counts = {}
+        # Map id() of each function bound to a global name to the
+        # function and the name; globals can't be rebound, so the
+        # names only need to be scanned again when a function isn't
+        # found after new definitions
+        self.names = {}
+        self.scanned_table = None
+        self.scanned_version = -1
+        # Each active call is a [record, start time, child time] list
+        top_level = self.record_for(self.TOP_LEVEL)
+        top_level.calls = top_level.active = 1
+        self.stack = [[top_level, time.perf_counter(), 0.0]]
+
+    def record_for(self, name):
+        record = self.records.get(name)
+        if record is None:
+            record = self.records[name] = ProfileRecord(name)
+        return record
+
+    def function_name(self, function):
+        global_names = self.program.global_names
+        if global_names is not self.scanned_table:
+            # The program restarted with a new symbol table
+            self.scanned_table = global_names
+            self.scanned_version = -1
+        entry = self.names.get(id(function))
+        if entry is None and self.scanned_version != global_names.version:
+            for name, value in global_names.items():
+                if (value and isinstance(value, tuple)
+                        and id(value) not in self.names):
+                    self.names[id(value)] = (value, name)
+            self.scanned_version = global_names.version
+            entry = self.names.get(id(function))
+        if entry is not None and entry[0] is function:
+            return entry[1]
+        return self.ANONYMOUS
+
+    def enter(self, function):
+        """Start timing a call of a user-defined function or macro."""
+        record = self.record_for(self.function_name(function))
+        record.calls += 1
+        record.active += 1
+        self.stack.append([record, time.perf_counter(), 0.0])
+
+    def tail_call(self, function):
+        """Switch the current call over to a tail-called function."""
+        self.exit()
+        record = self.record_for(self.function_name(function))
+        record.tail_calls += 1
+        record.active += 1
+        self.stack.append([record, time.perf_counter(), 0.0])
+
+    def exit(self):
+        """Stop timing the current call."""
+        record, start, child_time = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        record.self_time += elapsed - child_time
+        record.active -= 1
+        if not record.active:
+            record.total_time += elapsed
+        self.stack[-1][2] += elapsed
+
+    def builtin_call(self, builtin):
+        self.stack[-1][0].builtin_calls += 1
+        name = builtins[builtin.__name__]
+        self.builtin_counts[name] = self.builtin_counts.get(name, 0) + 1
+
+    def memo_counts(self):
+        """Return the hits, misses and size of each memoized function."""
+        counts = {}
+        for function, name, memo in self.program.memos.values():
+            if memo:
+                counts[name] = {"hits": memo.hits,
+                                "misses": memo.misses,
+                                "entries": len(memo.results),
+                                }
+        return dict(sorted(counts.items()))
+
+    def results(self):
+        """Return the records, sorted by self time, and builtin counts."""
+        # The top level is still running, so bring its times up to date
+        top_level, start, child_time = self.stack[0]
+        now = time.perf_counter()
+        top_level.total_time = now - start
+        top_level.self_time = top_level.total_time - child_time
+        self.stack[0][1:] = [now, 0.0]
+        records = sorted(self.records.values(),
+                         key=lambda record: record.self_time, reverse=True)
+        return records, dict(sorted(self.builtin_counts.items()))
+
+    def report(self, file=sys.stderr):
+        records, builtin_counts = self.results()
+        print("%10s %10s %10s %10s %10s  %s"
+              % ("calls", "tail calls", "builtins", "self (s)", "total (s)",
+                 "function"), file=file)
+        for record in records:
+            print("%10d %10d %10d %10.4f %10.4f  %s"
+                  % (record.calls, record.tail_calls, record.builtin_calls,
+                     record.self_time, record.total_time, record.name),
+                  file=file)
+        memo_counts = self.memo_counts()
+        if memo_counts:
+            print(file=file)
+            print("%10s %10s %10s  %s"
+                  % ("hits", "misses", "entries", "memoized function"),
+                  file=file)
+            for name, counts in memo_counts.items():
+                print("%10d %10d %10d  %s"
+                      % (counts["hits"], counts["misses"], counts["entries"],
+                         name), file=file)
+
+    def write_json(self, filename):
+        records, builtin_counts = self.results()
+        with open(filename, "w") as json_file:
+            json.dump({"functions": [record.as_dict() for record in records],
+                       "builtins": builtin_counts,
+                       "memo": self.memo_counts()},
+                      json_file, indent=1)
+            json_file.write("\n")
+
+
 class Program:
-    def __init__(self, repl=False):
+    def __init__(self, repl=False, intrinsics=True, module_cache=True,
+                 hash_cons=False, memo=(), memo_size=MEMO_SIZE,
+                 pure_macros=(), lazy=False):
         self.repl = repl
+        self.use_intrinsics = intrinsics
+        self.module_cache = module_cache
+        # Whether definitions in modules are only evaluated when the
+        # names they define are first used (see defer_definition)
+        self.lazy = lazy
+        # Macros that deferred definitions may call, keyed by id(); each
+        # is stored with its CallPlan and the parameter names of the
+        # functions it can reach, or None if calls can't be deferred
+        self.lazy_macros = {}
+        # Parameter names of the macros that deferred definitions call,
+        # and of the global functions those macros refer to; defining
+        # one of them forces the deferred definitions first, so that
+        # the calls don't warn about it shadowing a global
+        self.lazy_params = set()
+        # Intern table that c puts list cells through, if hash-consing
+        self.cons_table = ConsTable() if hash_cons else None
+        # Names of the global functions to memoize, and the functions
+        # bound to them so far, keyed by id(); each is stored as a
+        # [function, name, MemoTable] list, where the table is None
+        # until the first call checks that the function can be memoized,
+        # and False if it can't
+        self.memo_names = frozenset(memo)
+        self.memo_size = memo_size
+        self.memos = {}
+        # Names of the global macros declared expansion-pure, and the
+        # macros bound to them so far, keyed by id(); each is stored as a
+        # [macro, name, pure] list, where pure is None until the first
+        # call checks it. The results of calls to pure macros are cached
+        # in expansions, keyed by the id()s of the call's argument list
+        # and the macro
+        self.pure_macro_names = frozenset(pure_macros)
+        self.pure_macros = {}
+        self.expansions = {}
         self.modules = []
         self.module_paths = [os.path.abspath(os.path.dirname(__file__))]
-        self.names = [{}]
-        self.depth = 0
         self.builtins = []
-        self.global_names = self.names[0]
-        self.local_names = self.global_names
+        self.global_names = GlobalNames()
+        # Parameter values of the current call, and the layout that maps
+        # each parameter name to its index in the frame
+        self.frame = []
+        self.layout = {}
+        # Resolved function bodies, keyed by id(); each is stored with
+        # its function, which keeps the id from being reused
+        self.resolved = {}
+        # Native implementations of functions and macros, keyed by id();
+        # each is a (function, python function, parameter count) triple
+        self.natives = {}
+        # Digest entries for the definitions of global names, which can't
+        # change once they are bound (see definition_digest)
+        self.definition_entries = {}
+        # Profiler that run_call reports calls to, when profiling
+        self.profiler = None
+        # Number of errors and warnings given so far (a memoized call
+        # that gives one isn't cached, so that it gives it again the next
+        # time)
+        self.message_count = 0
         # Go through the tinylisp builtins and put the corresponding
         # member functions into the top-level symbol table
         for func_name, tl_func_name in builtins.items():
             builtin = getattr(self, func_name)
             self.builtins.append(builtin)
             self.global_names[tl_func_name] = builtin
+        # Facts about each builtin that calls to it need, which also
+        # serve to recognize builtins
+        self.builtin_plans = {builtin: BuiltinPlan(builtin)
+                              for builtin in self.builtins}
 
     def execute(self, code):
+        """Evaluate each expression in the code and (possibly) display it.
+
+The code can be a string, an iterable of lines (such as a file), or a
+tinylisp list of parsed expressions. Returns the value of the last
+expression.
+"""
         if isinstance(code, str):
-            # First determine whether the code is in single-line or
-            # multiline form:
-            # In single-line form, the code is parsed one line at a time
-            # with closing parentheses inferred at the end of each line
-            # In multiline form, the code is parsed as a whole, with
-            # closing parentheses inferred only at the end
-            # If any line in the code contains more closing parens than
-            # opening parens, the code is assumed to be in multiline
-            # form; otherwise, it's single-line
-            codelines = code.split("\n")
-            multiline = any(line.count(")") > line.count("(")
-                            for line in codelines)
-            if not multiline:
-                for codeline in codelines:
-                    self.execute(parse(codeline))
-                return
-            else:
-                code = parse(code)
-        # Evaluate each expression in the code and (possibly) display it
-        for expr in cons_iter(code):
+            forms = read_forms(code.split("\n"))
+        elif isinstance(code, tuple):
+            forms = cons_iter(code)
+        else:
+            forms = read_forms(code)
+        result = nil
+        for expr in forms:
             # Figure out which function the outermost call is
             outer_function = None
             if expr and isinstance(expr, tuple) and isinstance(expr[0], str):
                 outer_function = self.tl_eval(expr[0])
-                if outer_function in self.builtins:
+                if (not isinstance(outer_function, tuple)
+                        and outer_function in self.builtin_plans):
                     outer_function = outer_function.__name__
             result = self.tl_eval(expr, top_level=True)
             # If outer function is in the top_level_quiet_fns list,
@@ -188,120 +1585,192 @@ class Program:
             # repl mode
             if self.repl or outer_function not in top_level_quiet_fns:
                 self.tl_disp(result)
+        return result
+
+    def error(self, *args):
+        self.message_count += 1
+        error(*args)
+
+    def warn(self, *args):
+        self.message_count += 1
+        warn(*args)
 
-    def call_data(self, function, raw_args):
-        """Returns function/macro flag, param names, body, & arglist."""
+    def function_parts(self, function):
+        """Returns function/macro flag, param names, & body."""
         if function[0] == nil:
             # Potential macro
-            is_macro = True
             # function should be a nested-tuple structure containing
             # nil, parameter names, and macro body
             if function[1] and function[1][1]:
-                param_names = function[1][0]
-                body = function[1][1][0]
-                # Macro arguments stay unevaluated
-                arglist = [arg for arg in cons_iter(raw_args)]
+                return True, function[1][0], function[1][1][0]
             else:
-                error("list too short to be interpreted as macro")
+                self.error("list too short to be interpreted as macro")
                 raise TypeError
         else:
             # Potential function
-            is_macro = False
             # function should be a nested-tuple structure containing
             # parameter names and function body
             if function[1]:
-                param_names = function[0]
-                body = function[1][0]
-                # Function arguments are evaluated
-                arglist = [self.tl_eval(arg) for arg in cons_iter(raw_args)]
+                return False, function[0], function[1][0]
             else:
-                error("list too short to be interpreted as function")
+                self.error("list too short to be interpreted as function")
                 raise TypeError
+
+    def call_data(self, function, raw_args, site=None):
+        """Returns function/macro flag, param names, body, & arglist.
+
+If the call comes from resolved code, site is the ResolvedCall, and the
+arguments of a function are evaluated from its resolved arguments.
+"""
+        is_macro, param_names, body = self.function_parts(function)
+        if is_macro:
+            # Macro arguments stay unevaluated
+            arglist = [arg for arg in cons_iter(raw_args)]
+        elif site is None:
+            # Function arguments are evaluated
+            arglist = [self.tl_eval(arg) for arg in cons_iter(raw_args)]
+        else:
+            arglist = [self.evaluate(arg) for arg in self.resolved_args(site)]
         return is_macro, param_names, body, arglist
 
-    def call(self, function, raw_args):
+    def call(self, function, raw_args, site=None):
         """Perform a function call with a user-defined function or macro."""
         try:
             is_macro, param_names, body, arglist \
-                   = self.call_data(function, raw_args)
+                   = self.call_data(function, raw_args, site)
         except TypeError:
             # There was a problem with the structure of the supposed
             # function/macro (call_data already gave the error message)
             return nil
-        with self.new_scope():
+        return self.run_call(function, is_macro, param_names, body, arglist,
+                             raw_args)
+
+    def cached_expansion(self, macro, raw_args):
+        """Look up the result of a call of an expansion-pure macro.
+
+Results are cached for the call site, which is identified by its
+argument list, so later calls from the same place return them
+directly. Returns whether there is a result, and the result.
+"""
+        entry = self.expansions.get((id(raw_args), id(macro)))
+        if entry is not None and entry[0] is raw_args and entry[1] is macro:
+            return True, entry[2]
+        return False, None
+
+    def store_expansion(self, macro, raw_args, result):
+        if self.expansion_pure(macro):
+            if len(self.expansions) >= CODE_CACHE_SIZE:
+                self.expansions.clear()
+            self.expansions[id(raw_args), id(macro)] = (raw_args, macro,
+                                                        result)
+
+    def call_values(self, function, arglist):
+        """Call a user-defined function or macro with a list of arguments.
+
+The arguments have already been evaluated (or, for a macro, are the
+unevaluated argument expressions).
+"""
+        try:
+            is_macro, param_names, body = self.function_parts(function)
+        except TypeError:
+            return nil
+        return self.run_call(function, is_macro, param_names, body, arglist)
+
+    def run_call(self, function, is_macro, param_names, body, arglist,
+                 raw_args=None):
+        """Run a call of a user-defined function or macro.
+
+If the call comes from code, raw_args is its unevaluated argument
+list, which identifies the call site for expansion-pure macros.
+"""
+        # Save the caller's frame to restore when the call is finished
+        caller_frame = self.frame
+        caller_layout = self.layout
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(function)
+        # Results of memoized functions that this call has to store; the
+        # result of a tail call is also the result of the calls before it
+        memo_keys = None
+        # Likewise for calls of expansion-pure macros; each is stored
+        # with its argument list and the message count when it started
+        expansion_calls = None
+        try:
             # Loop while recursive calls are optimizable tail-calls
             while function is not None:
-                # Assign arg values to param names in local scope
-                if isinstance(param_names, tuple):
-                    name_iter = cons_iter(param_names)
-                    name_count = 0
-                    val_count = 0
-                    for name, val in zip_longest(name_iter, arglist):
-                        if name is None:
-                            # Ran out of argument names
-                            val_count += 1
-                        elif val is None:
-                            # Ran out of argument values
-                            name_count += 1
-                        elif isinstance(name, str):
-                            if name in self.global_names:
-                                warn("macro" if is_macro else "function",
-                                     "parameter name shadows global name",
-                                     name)
-                            self.local_names[name] = val
-                            name_count += 1
-                            val_count += 1
+                if (self.pure_macros and raw_args is not None
+                        and id(function) in self.pure_macros):
+                    found, return_val = self.cached_expansion(function,
+                                                              raw_args)
+                    if found:
+                        break
+                    if expansion_calls is None:
+                        expansion_calls = []
+                    expansion_calls.append((function, raw_args,
+                                            self.message_count))
+                if self.memos and id(function) in self.memos:
+                    memo = self.memo_table(function)
+                    if memo is not None and not is_macro:
+                        key = tuple(arglist)
+                        try:
+                            found, return_val = memo.lookup(key)
+                        except RecursionError:
+                            # Too deeply nested to hash
+                            pass
                         else:
-                            error("parameter list must contain names, not",
-                                  self.tl_type(name))
-                            return nil
-                    if name_count != val_count:
-                        # Wrong number of arguments
-                        error("macro" if is_macro else "function",
-                              "expected", name_count, "arguments, got",
-                              val_count)
-                        return nil
-                elif isinstance(param_names, str):
-                    # Single name, bind entire arglist to it
-                    arglist_name = param_names
-                    if arglist_name in self.global_names:
-                        warn("macro" if is_macro else "function",
-                             "parameter name shadows global name",
-                             arglist_name)
-                    args = nil
-                    while arglist:
-                        args = (arglist.pop(), args)
-                    self.local_names[arglist_name] = args
-                else:
-                    error("parameters must either be name or list of names,",
-                          "not", self.tl_type(param_names))
+                            if found:
+                                break
+                            if memo_keys is None:
+                                memo_keys = []
+                                messages = self.message_count
+                            memo_keys.append((memo, key))
+                if self.natives and id(function) in self.natives:
+                    native = self.natives[id(function)]
+                    if native[0] is function:
+                        return_val = self.call_native(native, is_macro,
+                                                      param_names, arglist)
+                        if return_val is not NotImplemented:
+                            break
+                layout, body, plan = self.resolve_function(
+                    function, param_names, body)
+                # Assign arg values to param slots in a new frame
+                frame = self.bind_frame(plan, is_macro, param_names,
+                                        arglist, layout)
+                if frame is None:
                     return nil
+                self.frame = frame
+                self.layout = layout
 
                 # Tail-call elimination
                 head = None
                 # Eliminate any ifs and evals
-                while body and isinstance(body, tuple):
-                    head = self.tl_eval(body[0])
+                while type(body) is ResolvedCall:
+                    head = self.evaluate(body.head)
+                    if (profiler is not None
+                            and (head == self.tl_if or head == self.tl_eval)):
+                        # Other builtin calls are counted when the body
+                        # is evaluated after the loop
+                        profiler.builtin_call(head)
                     if head == self.tl_if:
                         # The head is (some name for) tl_if
-                        tail = body[1]
-                        if (tail and tail[1] and tail[1][1]
-                                and not tail[1][1][1]):
-                            test = self.tl_eval(tail[0])
+                        if body.argc == 3:
+                            cond, trueval, falseval = self.resolved_args(body)
+                            test = self.evaluate(cond)
                             if test == 0 or test == nil:
-                                body = tail[1][1][0]
+                                body = falseval
                             else:
-                                body = tail[1][0]
+                                body = trueval
                         else:
-                            error("wrong number of arguments for tl_if")
+                            self.error("wrong number of arguments for tl_if")
                             return nil
                     elif head == self.tl_eval:
-                        # The head is (some name for) tl_eval
-                        tail = body[1]
-                        if tail and not tail[1]:
-                            body = self.tl_eval(tail[0])
+                        # The head is (some name for) tl_eval; the code
+                        # it evaluates has to be resolved on the fly
+                        if body.argc == 1:
+                            code = self.evaluate(self.resolved_args(body)[0])
+                            body = self.resolve(code, layout)
                         else:
-                            error("wrong number of arguments for tl_eval")
+                            self.error("wrong number of arguments for tl_eval")
                             return nil
                     else:
                         break
@@ -313,44 +1782,672 @@ class Program:
                     # for the updated args, the function for the new
                     # function (which might be the same function), and
                     # loop for the recursive call
-                    raw_args = body[1]
                     function = head
+                    raw_args = body.form[1]
+                    if profiler is not None:
+                        profiler.tail_call(function)
                     try:
                         is_macro, param_names, body, arglist \
-                               = self.call_data(function, raw_args)
+                               = self.call_data(function, raw_args, body)
                     except TypeError:
                         # There was a problem with the structure of the
                         # supposed function/macro (call_data already gave
                         # the error message)
                         return nil
-                    # Clear the local scope to prepare for the next
-                    # iteration
-                    self.local_names.clear()
                 else:
                     # Otherwise, eval the final expression, break out
                     # of the loop, and return it
-                    return_val = self.tl_eval(body)
+                    return_val = self.evaluate(body)
                     function = None
+            if memo_keys is not None and self.message_count == messages:
+                for memo, key in memo_keys:
+                    memo.store(key, return_val)
+            if expansion_calls is not None:
+                for macro, macro_args, count in expansion_calls:
+                    if self.message_count == count:
+                        self.store_expansion(macro, macro_args, return_val)
+        finally:
+            self.frame = caller_frame
+            self.layout = caller_layout
+            if profiler is not None:
+                profiler.exit()
         return return_val
 
-    @contextmanager
-    def new_scope(self):
-        self.depth += 1
-        self.names.append({})
-        self.local_names = self.names[self.depth]
+    def call_value(self, function, arglist):
+        """Call a function, user-defined or builtin, with argument values."""
+        if isinstance(function, tuple):
+            return self.call_values(function, arglist)
+        plan = self.builtin_plans[function]
+        if not plan.takes(len(arglist)):
+            self.error("wrong number of arguments for", plan.name)
+            return nil
+        return function(*arglist)
+
+    def parallel_map(self, function, items, chunk, workers):
+        """Call a function on each item, in a pool of worker processes.
+
+Each worker starts from an image of the global environment and the
+function, and is sent chunks of items; values are sent back and forth
+in flattened form.
+"""
+        from concurrent.futures import ProcessPoolExecutor
+        function_refs, function_tables = self.flatten([function])
+        chunks = [self.flatten(items[start:start + chunk])
+                  for start in range(0, len(items), chunk)]
+        # Worker processes may start as copies of this one, so nothing
+        # can be left waiting to be written out
+        output.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with ProcessPoolExecutor(
+                max_workers=min(workers, len(chunks)),
+                initializer=pmap_init,
+                initargs=(self.image(), self.use_intrinsics,
+                          function_refs, function_tables)) as pool:
+            results = []
+            for refs, tables in pool.map(pmap_chunk, *zip(*chunks)):
+                results.extend(self.unflatten(refs, tables))
+        return results
+
+    def call_native(self, native, is_macro, param_names, arglist):
+        """Call the native implementation of a function or macro.
+
+The native takes one argument per parameter, or, if the parameters are
+a single name, one argument that is a list of all the arguments. It
+can return NotImplemented to have the caller run the tinylisp code.
+"""
+        function, pyfunc, param_count = native
+        if param_count is None:
+            return pyfunc(to_cons(arglist))
+        elif len(arglist) == param_count:
+            return pyfunc(*arglist)
+        else:
+            # Let bind_params give the error message
+            self.bind_params(is_macro, param_names, arglist, {})
+            return nil
+
+    def eval_in(self, code, layout, frame):
+        """Evaluate code in a frame with the given layout."""
+        caller_frame = self.frame
+        caller_layout = self.layout
+        self.frame = frame
+        self.layout = layout
+        try:
+            return self.tl_eval(code)
+        finally:
+            self.frame = caller_frame
+            self.layout = caller_layout
+
+    def dynamic_call(self, function, form, arg_thunk, layout, frame):
+        """Make a call from compiled code that couldn't be resolved.
+
+The function is the value of the head of the form; arg_thunk returns
+the values of the arguments, evaluated by compiled code. The layout
+and frame describe the parameters of the compiled function.
+"""
+        if function and isinstance(function, tuple):
+            # User-defined function or macro
+            try:
+                is_macro, param_names, body = self.function_parts(function)
+            except TypeError:
+                return nil
+            if is_macro:
+                arglist = [arg for arg in cons_iter(form[1])]
+            else:
+                arglist = arg_thunk()
+            return self.run_call(function, is_macro, param_names, body,
+                                 arglist)
+        plan = self.builtin_plans.get(function)
+        if plan is None:
+            # Trying to call an int or unevaluated name
+            self.error(function, "is not a function or macro")
+            return nil
+        elif plan.is_macro or plan.top_level_only:
+            # Builtin macros, and builtins that will give an error, are
+            # left to the interpreter
+            return self.eval_in(form, layout, frame)
+        # Builtin function; v needs to see the compiled function's
+        # parameters, so switch to its frame for the call
+        args = arg_thunk()
+        if not plan.takes(len(args)):
+            self.error("wrong number of arguments for", plan.name)
+            return nil
+        caller_frame = self.frame
+        caller_layout = self.layout
+        self.frame = frame
+        self.layout = layout
+        try:
+            return function(*args)
+        finally:
+            self.frame = caller_frame
+            self.layout = caller_layout
+
+    def resolve_function(self, function, param_names, body):
+        """Return the layout, resolved body and call plan of a function."""
+        entry = self.resolved.get(id(function))
+        if entry is None:
+            if len(self.resolved) >= CODE_CACHE_SIZE:
+                self.resolved.clear()
+            layout = param_layout(param_names)
+            entry = (function, layout, self.resolve(body, layout),
+                     CallPlan(param_names, layout))
+            self.resolved[id(function)] = entry
+        return entry[1], entry[2], entry[3]
+
+    def resolve(self, code, layout):
+        """Resolve the names in an expression ahead of evaluating it.
+
+Parameter names become Slots indexing into a frame with the given
+layout, other names become Cells holding their global bindings, and
+nonempty lists become ResolvedCalls.
+"""
+        if isinstance(code, tuple):
+            if code == nil:
+                return nil
+            return ResolvedCall(code, self.resolve(code[0], layout), layout)
+        elif isinstance(code, str):
+            if code in layout:
+                return Slot(code, layout[code])
+            return self.global_names.cell(code)
+        else:
+            # Ints and builtins evaluate to themselves
+            return code
+
+    def resolved_args(self, site):
+        if site.args is None:
+            site.args = tuple(self.resolve(arg, site.layout)
+                              for arg in cons_iter(site.form[1]))
+        return site.args
+
+    def evaluate(self, node):
+        """Evaluate resolved code in the current frame."""
+        node_type = type(node)
+        if node_type is Slot:
+            return self.frame[node.index]
+        elif node_type is Cell:
+            if node.value is unbound:
+                self.error("referencing undefined name", node.name)
+                return nil
+            return node.value
+        elif node_type is ResolvedCall:
+            # Function/macro call, as in tl_eval
+            function = self.evaluate(node.head)
+            if function and isinstance(function, tuple):
+                # User-defined function or macro
+                return self.call(function, node.form[1], node)
+            plan = self.builtin_plans.get(function)
+            if plan is None:
+                # Trying to call an int or unevaluated name
+                self.error(function, "is not a function or macro")
+                return nil
+            # Builtin function or macro
+            if plan.top_level_only:
+                # Resolved code is never at top level
+                self.error("call to", plan.name, "cannot be nested")
+                return nil
+            if self.profiler is not None:
+                self.profiler.builtin_call(function)
+            if function == self.tl_if and node.argc == 3:
+                # Evaluate the branches from their resolved code
+                cond, trueval, falseval = self.resolved_args(node)
+                test = self.evaluate(cond)
+                if test == 0 or test == nil:
+                    return self.evaluate(falseval)
+                else:
+                    return self.evaluate(trueval)
+            if plan.is_macro:
+                # Macros receive their args unevaluated
+                args = cons_iter(node.form[1])
+            else:
+                # Functions receive their args evaluated
+                args = [self.evaluate(arg) for arg in self.resolved_args(node)]
+            if not plan.takes(node.argc):
+                self.error("wrong number of arguments for", plan.name)
+                return nil
+            return function(*args)
+        else:
+            # Nil, ints, and builtins evaluate to themselves
+            return node
+
+    def definition_digest(self, name):
+        """Fingerprint the definition of a global name.
+
+The digest covers the source of the value bound to the name and,
+recursively, of the global names its code refers to. Returns the digest
+and the set of parameter names of all the functions involved, or None
+and None if some value can't be written as source.
+"""
+        entries = []
+        param_names = set()
+        seen = set()
+        builtin_ids = {id(builtin) for builtin in self.builtins}
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name not in self.global_names:
+                entries.append("%s unbound" % name)
+                continue
+            if name not in self.definition_entries:
+                self.definition_entries[name] = self.definition_entry(
+                    name, builtin_ids)
+            entry, params, names = self.definition_entries[name]
+            if entry is None:
+                return None, None
+            entries.append(entry)
+            param_names.update(params)
+            pending.extend(names)
+        text = "\n".join(sorted(entries))
+        return hashlib.sha256(text.encode()).hexdigest()[:16], param_names
+
+    def definition_entry(self, name, builtin_ids):
+        """Digest entry, parameter names and names used for a definition."""
+        value = self.global_value(name)
+        if id(value) in builtin_ids:
+            return "%s %s" % (name, value.__name__), (), ()
+        try:
+            entry = "%s %s" % (name, to_source(value))
+        except ValueError:
+            return None, (), ()
+        if not (value and isinstance(value, tuple) and value[1]):
+            return entry, (), ()
+        elif value[0] == nil and value[1][1]:
+            params, body = value[1][0], value[1][1][0]
+        else:
+            params, body = value[0], value[1][0]
+        params = param_layout(params)
+        # Collect the names in the body that aren't parameters
+        names = []
+        code = [body]
+        while code:
+            item = code.pop()
+            if isinstance(item, tuple):
+                code.extend(cons_iter(item))
+            elif isinstance(item, str) and item not in params:
+                names.append(item)
+        return entry, tuple(params), tuple(names)
+
+    def register_intrinsics(self):
+        """Use native code for library functions that have intrinsics."""
+        if not self.use_intrinsics:
+            return
+        for name in intrinsics:
+            self.register_intrinsic(name)
+
+    def register_intrinsic(self, name):
+        if not self.use_intrinsics or name not in intrinsics:
+            return
+        value = self.global_names.get(name)
+        if type(value) is LazyDefinition:
+            # Checked when the definition is forced
+            return
+        if id(value) not in self.natives:
+            param_names = self.intrinsic_params(name)
+            if param_names is not None:
+                self.add_intrinsic(name, param_names)
+
+    def intrinsic_params(self, name):
+        """Check whether an intrinsic can replace a name's definition.
+
+If so, returns the parameter names involved in the definition (which
+the intrinsic has to check for shadowing); otherwise, returns None.
+"""
+        value = self.global_names.get(name)
+        if value and isinstance(value, tuple):
+            value_digest, param_names = self.definition_digest(name)
+            if value_digest == intrinsics[name][0]:
+                return param_names
+        return None
+
+    def add_intrinsic(self, name, param_names):
+        value = self.global_names[name]
+        params = value[1][0] if value[0] == nil else value[0]
+        param_count = (None if isinstance(params, str)
+                       else sum(1 for param in cons_iter(params)))
+        pyfunc = intrinsics[name][1]
+        self.natives[id(value)] = (
+            value, self.shadow_checked(pyfunc, param_names), param_count)
+
+    def shadow_checked(self, pyfunc, param_names):
+        """Wrap an intrinsic so that it steps aside for shadowed names.
+
+When a parameter name of the library code shadows a global name, the
+tinylisp code has to run so that it gives the warnings.
+"""
+        global_names = self.global_names
+
+        def native(*args):
+            for name in param_names:
+                if name in global_names:
+                    return NotImplemented
+            return pyfunc(*args)
+        return native
+
+    def flatten(self, values):
+        """Store values in flat tables that marshal can handle.
+
+Lists become a table of cons cells, so that structure shared between
+values (such as a function bound to two names) is kept and deep nesting
+doesn't matter. Returns a reference to each value and the tables of
+cells, atoms and builtin names, for unflatten to turn back into values.
+"""
+        builtin_names = {id(builtin): builtin.__name__
+                         for builtin in self.builtins}
+        # Each value is stored as a reference: its index in the table of
+        # cells, atoms (nil, ints, and names), or builtins, times 3, plus
+        # 0, 1, or 2 respectively. Cells only refer to earlier cells.
+        refs = {}
+        cells = []
+        atoms = []
+        atom_refs = {}
+        builtins_used = []
+        for value in values:
+            stack = [value]
+            while stack:
+                item = stack[-1]
+                if id(item) in refs:
+                    stack.pop()
+                elif item and isinstance(item, tuple):
+                    missing = [part for part in item if id(part) not in refs]
+                    if missing:
+                        stack.extend(missing)
+                        continue
+                    refs[id(item)] = len(cells) // 2 * 3
+                    cells.extend(refs[id(part)] for part in item)
+                    stack.pop()
+                elif id(item) in builtin_names:
+                    refs[id(item)] = len(builtins_used) * 3 + 2
+                    builtins_used.append(builtin_names[id(item)])
+                    stack.pop()
+                else:
+                    key = (type(item), item)
+                    if key not in atom_refs:
+                        atom_refs[key] = len(atoms) * 3 + 1
+                        atoms.append(item)
+                    refs[id(item)] = atom_refs[key]
+                    stack.pop()
+        return [refs[id(value)] for value in values], (cells, atoms,
+                                                        builtins_used)
+
+    def unflatten(self, refs, tables):
+        """Turn the references and tables from flatten back into values."""
+        cells, atoms, builtins_used = tables
+        builtin_values = {builtin.__name__: builtin
+                          for builtin in self.builtins}
+        tables = [[], atoms, [builtin_values[func_name]
+                              for func_name in builtins_used]]
+        values = tables[0]
+        for index in range(0, len(cells), 2):
+            head, tail = cells[index], cells[index + 1]
+            values.append((tables[head % 3][head // 3],
+                           tables[tail % 3][tail // 3]))
+        return [tables[ref % 3][ref // 3] for ref in refs]
+
+    def image(self):
+        """Return the global environment in a form that marshal can store.
+
+The image is restored with restore_image.
+"""
+        self.force_definitions()
+        names = list(self.global_names)
+        refs, tables = self.flatten(list(self.global_names.values()))
+        # The definitions that intrinsics can replace are recorded, so
+        # that restoring the image doesn't need to fingerprint them again
+        intrinsic_names = []
+        for name in intrinsics:
+            param_names = self.intrinsic_params(name)
+            if param_names is not None:
+                intrinsic_names.append((name, tuple(param_names)))
+        return (IMAGE_VERSION, tuple(builtins.items()), self.modules,
+                tables, list(zip(names, refs)), intrinsic_names)
+
+    def restore_image(self, image):
+        version, builtin_table, modules, tables, global_refs, \
+            intrinsic_names = image
+        names = [name for name, ref in global_refs]
+        values = self.unflatten([ref for name, ref in global_refs], tables)
+        for name, value in zip(names, values):
+            self.global_names[name] = value
+        self.modules.extend(modules)
+        if self.use_intrinsics:
+            for name, param_names in intrinsic_names:
+                self.add_intrinsic(name, param_names)
+        for name in self.memo_names:
+            if name in self.global_names:
+                self.add_memo(name)
+        for name in self.pure_macro_names:
+            if name in self.global_names:
+                self.add_pure_macro(name)
+
+    def save_image(self, filename):
+        """Write the global environment to an image file.
+
+Returns True if successful.
+"""
+        image = self.image()
         try:
-            yield self.local_names
-        finally:
-            self.names.pop()
-            self.depth -= 1
-            self.local_names = self.names[self.depth]
+            with open(filename, "wb") as image_file:
+                marshal.dump(image, image_file)
+        except OSError:
+            self.error("could not write image", filename)
+            return False
+        return True
+
+    def load_image(self, filename):
+        """Restore the global environment from an image file.
+
+Returns True if successful.
+"""
+        try:
+            with open(filename, "rb") as image_file:
+                image = marshal.loads(image_file.read())
+        except FileNotFoundError:
+            self.error("could not find", filename)
+            return False
+        except (OSError, EOFError, ValueError, TypeError):
+            self.error("could not read image", filename)
+            return False
+        if (not isinstance(image, tuple) or len(image) != 6
+                or image[:2] != (IMAGE_VERSION, tuple(builtins.items()))):
+            self.error("image", filename, "was made by a different version of",
+                       "tinylisp")
+            return False
+        self.restore_image(image)
+        return True
+
+    def add_memo(self, name):
+        value = self.global_names[name]
+        if value and isinstance(value, tuple):
+            self.memos[id(value)] = [value, name, None]
+
+    def memo_table(self, function):
+        """Return the MemoTable of a function, or None if it has none."""
+        entry = self.memos[id(function)]
+        if entry[0] is not function:
+            return None
+        if entry[2] is None:
+            if function[0] == nil:
+                reason = "it is a macro"
+            else:
+                reason = self.side_effect(entry[1])
+            if reason is None:
+                entry[2] = MemoTable(self.memo_size)
+            else:
+                self.warn("not memoizing", entry[1], "because", reason)
+                entry[2] = False
+        return entry[2] or None
+
+    def add_pure_macro(self, name):
+        value = self.global_names[name]
+        if value and isinstance(value, tuple):
+            self.pure_macros[id(value)] = [value, name, None]
+
+    def expansion_pure(self, macro):
+        """Check whether a macro's results can be cached by call site."""
+        entry = self.pure_macros[id(macro)]
+        if entry[0] is not macro:
+            return False
+        if entry[2] is None:
+            if macro[0] != nil:
+                reason = "it is not a macro"
+            else:
+                reason = self.side_effect(entry[1])
+            if reason is not None:
+                self.warn("not caching results of", entry[1], "because",
+                          reason)
+            entry[2] = reason is None
+        return entry[2]
+
+    def side_effect(self, name):
+        """Find out whether a global function might have side effects.
+
+Returns the reason why, or None if it can't. The code of the function
+and of the global names it refers to, recursively, must not call
+parameters or anything else that isn't a global name (such as quoted
+code or the result of another call), since that can be any function,
+or builtins that have side effects.
+"""
+        seen = set()
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name not in self.global_names:
+                return "it refers to undefined name %s" % name
+            value = self.global_value(name)
+            if value in self.builtins:
+                if value.__name__ in side_effect_fns:
+                    return "it uses %s" % builtins[value.__name__]
+                continue
+            if not (value and isinstance(value, tuple) and value[1]):
+                continue
+            elif value[0] == nil and value[1][1]:
+                params, body = value[1][0], value[1][1][0]
+            else:
+                params, body = value[0], value[1][0]
+            is_macro = value[0] == nil
+            params = param_layout(params)
+            # Each item is stored with whether it is quoted data rather
+            # than code
+            code = [(body, False)]
+            while code:
+                item, quoted = code.pop()
+                if isinstance(item, tuple):
+                    if not item:
+                        continue
+                    head = item[0]
+                    if isinstance(head, str) and head in params:
+                        return "%s calls its parameter %s" % (name, head)
+                    if quoted:
+                        code.extend((part, True) for part in cons_iter(item))
+                        continue
+                    if not isinstance(head, str):
+                        # The head is computed, and may be quoted code
+                        # like ((q ((y) (disp y))) x)
+                        return "%s calls a value that is not a name" % name
+                    if self.global_value(head, None) == self.tl_quote:
+                        # Quoted data in a function is only run as code
+                        # by v or as a call head, which are both refused;
+                        # a macro can return it as code, so the names in
+                        # it are checked too
+                        if is_macro:
+                            code.extend((part, True)
+                                        for part in cons_iter(item[1]))
+                        continue
+                    code.extend((part, False) for part in cons_iter(item))
+                elif isinstance(item, str) and item not in params:
+                    pending.append(item)
+        return None
+
+    def bind_frame(self, plan, is_macro, param_names, arglist, layout):
+        """Return a new frame with the arguments of a call in it.
+
+Does the same as bind_params, but with the help of the function's call
+plan. If the call is invalid, gives an error message and returns None.
+"""
+        if plan.param_count is not None and plan.param_count != len(arglist):
+            # Let bind_params give the error message
+            self.bind_params(is_macro, param_names, arglist, {})
+            return None
+        for name in plan.shadowed(self.global_names):
+            self.warn("macro" if is_macro else "function",
+                      "parameter name shadows global name", name)
+        if plan.param_count is None:
+            # Single name, bind entire arglist to it
+            return [to_cons(arglist)]
+        elif plan.slots is None:
+            return arglist
+        frame = [None] * len(layout)
+        for index, val in zip(plan.slots, arglist):
+            frame[index] = val
+        return frame
+
+    def bind_params(self, is_macro, param_names, arglist, scope, layout=None):
+        """Assign argument values to parameter names in the given scope.
+
+The scope is a dictionary of names, or, if a layout is given, a frame
+whose slot for each name is found in the layout. Returns True if
+successful. If the parameters or the number of arguments
+are invalid, gives an error message and returns False.
+"""
+        if isinstance(param_names, tuple):
+            name_iter = cons_iter(param_names)
+            name_count = 0
+            val_count = 0
+            for name, val in zip_longest(name_iter, arglist):
+                if name is None:
+                    # Ran out of argument names
+                    val_count += 1
+                elif val is None:
+                    # Ran out of argument values
+                    name_count += 1
+                elif isinstance(name, str):
+                    if name in self.global_names:
+                        self.warn("macro" if is_macro else "function",
+                                  "parameter name shadows global name",
+                                  name)
+                    scope[name if layout is None else layout[name]] = val
+                    name_count += 1
+                    val_count += 1
+                else:
+                    self.error("parameter list must contain names, not",
+                               self.tl_type(name))
+                    return False
+            if name_count != val_count:
+                # Wrong number of arguments
+                self.error("macro" if is_macro else "function",
+                           "expected", name_count, "arguments, got",
+                           val_count)
+                return False
+        elif isinstance(param_names, str):
+            # Single name, bind entire arglist to it
+            arglist_name = param_names
+            if arglist_name in self.global_names:
+                self.warn("macro" if is_macro else "function",
+                          "parameter name shadows global name",
+                          arglist_name)
+            args = nil
+            while arglist:
+                args = (arglist.pop(), args)
+            scope[arglist_name if layout is None else 0] = args
+        else:
+            self.error("parameters must either be name or list of names,",
+                       "not", self.tl_type(param_names))
+            return False
+        return True
 
     @function
     def tl_cons(self, head, tail):
         if isinstance(tail, tuple):
+            if self.cons_table is not None:
+                return self.cons_table.cons(head, tail)
             return (head, tail)
         else:
-            error("cannot cons to", self.tl_type(tail), "in tinylisp")
+            self.error("cannot cons to", self.tl_type(tail), "in tinylisp")
             return nil
 
     @function
@@ -361,7 +2458,7 @@ class Program:
             else:
                 return lyst[0]
         else:
-            error("cannot get head of", self.tl_type(lyst))
+            self.error("cannot get head of", self.tl_type(lyst))
             return nil
 
     @function
@@ -372,7 +2469,7 @@ class Program:
             else:
                 return lyst[1]
         else:
-            error("cannot get tail of", self.tl_type(lyst))
+            self.error("cannot get tail of", self.tl_type(lyst))
             return nil
 
     @function
@@ -380,7 +2477,8 @@ class Program:
         if isinstance(arg1, int) and isinstance(arg2, int):
             return arg1 + arg2
         else:
-            error("cannot add", self.tl_type(arg1), "and", self.tl_type(arg2))
+            self.error("cannot add", self.tl_type(arg1), "and",
+                       self.tl_type(arg2))
             return nil
 
     @function
@@ -388,8 +2486,8 @@ class Program:
         if isinstance(arg1, int) and isinstance(arg2, int):
             return arg1 - arg2
         else:
-            error("cannot subtract", self.tl_type(arg1), "and",
-                  self.tl_type(arg2))
+            self.error("cannot subtract", self.tl_type(arg1), "and",
+                       self.tl_type(arg2))
             return nil
 
     @function
@@ -397,12 +2495,14 @@ class Program:
         try:
             return int(arg1 < arg2)
         except TypeError:
-            error("cannot use less-than to compare", self.tl_type(arg1),
-                  "and", self.tl_type(arg2))
+            self.error("cannot use less-than to compare", self.tl_type(arg1),
+                       "and", self.tl_type(arg2))
             return nil
 
     @function
     def tl_eq2(self, arg1, arg2):
+        if self.cons_table is not None:
+            return int(self.cons_table.equal(arg1, arg2))
         return int(arg1 == arg2)
 
     @function
@@ -416,38 +2516,41 @@ class Program:
             if function and isinstance(function, tuple):
                 # User-defined function or macro
                 return self.call(function, code[1])
-            elif function in self.builtins:
-                # Builtin function or macro
-                if function.__name__ in top_level_only_fns and not top_level:
-                    error("call to", function.__name__, "cannot be nested")
-                    return nil
-                if function.is_macro:
-                    # Macros receive their args unevaluated
-                    args = cons_iter(code[1])
-                else:
-                    # Functions receive their args evaluated
-                    args = (self.tl_eval(arg) for arg in cons_iter(code[1]))
-                try:
-                    return function(*args)
-                except TypeError as err:
-                    # Wrong number of arguments to builtin
-                    error("wrong number of arguments for", function.__name__)
-                    return nil
-            else:
+            plan = self.builtin_plans.get(function)
+            if plan is None:
                 # Trying to call an int or unevaluated name
-                error(function, "is not a function or macro")
+                self.error(function, "is not a function or macro")
+                return nil
+            # Builtin function or macro
+            if plan.top_level_only and not top_level:
+                self.error("call to", plan.name, "cannot be nested")
+                return nil
+            if self.profiler is not None:
+                self.profiler.builtin_call(function)
+            if plan.is_macro:
+                # Macros receive their args unevaluated
+                args = list(cons_iter(code[1]))
+            else:
+                # Functions receive their args evaluated
+                args = [self.tl_eval(arg) for arg in cons_iter(code[1])]
+            if not plan.takes(len(args)):
+                self.error("wrong number of arguments for", plan.name)
                 return nil
+            return function(*args)
         elif isinstance(code, int):
             # Integer literal
             return code
         elif isinstance(code, str):
             # Name; look up its value
-            if code in self.local_names:
-                return self.local_names[code]
+            if code in self.layout:
+                return self.frame[self.layout[code]]
             elif code in self.global_names:
-                return self.global_names[code]
+                value = self.global_names[code]
+                if type(value) is LazyDefinition:
+                    value = value.force()
+                return value
             else:
-                error("referencing undefined name", code)
+                self.error("referencing undefined name", code)
                 return nil
         else:
             # Probably a builtin
@@ -467,28 +2570,8 @@ class Program:
     @function
     def tl_disp(self, value, end="\n"):
         if value is not None and not self.quiet:
-            if value == nil:
-                write("()")
-            elif isinstance(value, tuple):
-                # List (as nested tuple)
-                beginning = True
-                for item in cons_iter(value):
-                    if beginning:
-                        write("(")
-                        beginning = False
-                    else:
-                        write(" ")
-                    self.tl_disp(item, end="")
-                write(")")
-            elif value in self.builtins:
-                # One of the builtin functions or macros
-                write("<builtin %s %s>"
-                      % ("macro" if value.is_macro else "function",
-                         value.__name__))
-            else:
-                # Integer or name
-                write(value)
-            write(end)
+            output.write(display_text(value) + str(end))
+            output.end_value()
         return nil
 
     @function
@@ -499,20 +2582,28 @@ class Program:
             # TBD: chr(value) instead?
             return str(value)
         elif isinstance(value, tuple):
-            result = ""
-            for char_code in cons_iter(value):
+            char_codes = list(cons_iter(value))
+            try:
+                # Convert all the char codes at once
+                return array("I", char_codes).tobytes().decode(*CHAR_CODES)
+            except (TypeError, ValueError, OverflowError):
+                # Some item isn't a char code; convert them one at a time
+                # to give the right messages
+                pass
+            result = []
+            for char_code in char_codes:
                 if isinstance(char_code, int):
                     try:
-                        result += chr(char_code)
+                        result.append(chr(char_code))
                     except ValueError:
                         # Can't convert this number to a character
-                        warn("cannot convert", char_code, "to character")
+                        self.warn("cannot convert", char_code, "to character")
                         pass
                 else:
-                    error("argument of string must be list of Ints, not of",
-                          self.tl_type(char_code))
+                    self.error("argument of string must be list of Ints,",
+                               "not of", self.tl_type(char_code))
                     return nil
-            return result
+            return "".join(result)
         else:
             # Builtin
             return value.__name__
@@ -525,20 +2616,59 @@ class Program:
                 result = (ord(char), result)
             return result
         else:
-            error("argument of chars must be Name, not", self.tl_type(value))
+            self.error("argument of chars must be Name, not",
+                       self.tl_type(value))
             return nil
 
+    @function
+    def tl_pmap(self, function, lyst, chunk=None):
+        if isinstance(function, tuple):
+            if function == nil or function[0] == nil:
+                self.error("pmap needs a function, not",
+                           "nil" if function == nil else "a macro")
+                return nil
+        elif function not in self.builtin_plans:
+            self.error(function, "is not a function or macro")
+            return nil
+        elif (self.builtin_plans[function].is_macro
+                or self.builtin_plans[function].top_level_only):
+            self.error("pmap cannot call", function.__name__)
+            return nil
+        if not isinstance(lyst, tuple):
+            self.error("cannot pmap over", self.tl_type(lyst))
+            return nil
+        if chunk is not None and not (isinstance(chunk, int) and chunk > 0):
+            self.error("chunk size for pmap must be a positive Int")
+            return nil
+        items = list(cons_iter(lyst))
+        workers = os.cpu_count() or 1
+        if chunk is None:
+            # A few chunks per worker evens out the load
+            chunk = max(1, -(-len(items) // (workers * 4)))
+        if pmap_worker is not None or workers == 1 or len(items) <= chunk:
+            # Not worth starting processes for (or already in a worker)
+            results = [self.call_value(function, [item]) for item in items]
+        else:
+            results = self.parallel_map(function, items, chunk, workers)
+        return to_cons(results)
+
     @macro
     def tl_def(self, name, value):
         if isinstance(name, str):
             if name in self.global_names:
-                error("name", name, "already in use")
+                self.error("name", name, "already in use")
                 return nil
             else:
+                if name in self.lazy_params:
+                    self.force_definitions()
                 self.global_names[name] = self.tl_eval(value)
+                if name in self.memo_names:
+                    self.add_memo(name)
+                if name in self.pure_macro_names:
+                    self.add_pure_macro(name)
                 return name
         else:
-            error("cannot define", self.tl_type(name))
+            self.error("cannot define", self.tl_type(name))
             return nil
 
     @macro
@@ -564,24 +2694,107 @@ class Program:
         if abspath not in self.modules:
             # Module has not already been loaded
             try:
-                with open(abspath) as f:
-                    module_code = f.read()
+                forms = read_module(abspath, self.module_cache)
             except (FileNotFoundError, IOError):
-                error("could not load", module_name, "from", module_directory)
+                self.error("could not load", module_name, "from",
+                           module_directory)
                 return nil
-            else:
-                # Add the module to the list of loaded modules
-                self.modules.append(abspath)
-                # Push the module's directory to the stack of module
-                # directories--this allows relative paths in load calls
-                # from within the module
-                self.module_paths.append(module_directory)
-                # Execute the module code
-                self.execute(module_code)
-                # Put everything back the way it was before loading
-                self.module_paths.pop()
+            # Add the module to the list of loaded modules
+            self.modules.append(abspath)
+            # Push the module's directory to the stack of module
+            # directories--this allows relative paths in load calls
+            # from within the module
+            self.module_paths.append(module_directory)
+            # Execute the module code, one expression at a time as it
+            # is read
+            for form in forms:
+                if not (self.lazy and self.defer_definition(form)):
+                    self.execute((form, nil))
+            # Put everything back the way it was before loading
+            self.module_paths.pop()
+            # Switch any library functions it defined to native code
+            self.register_intrinsics()
         return "Loaded %s" % module
 
+    def defer_definition(self, form):
+        """Bind a LazyDefinition for a top-level form of a module, if it
+is a definition that can safely be evaluated later.
+
+That is the case for a definition whose value is a call to a macro
+that can't have side effects (like lambda) with the right number of
+arguments, when the macro's parameters don't shadow global names and
+no resolved code refers to the name yet. Evaluating it later then gives
+the same result, with no output, errors or warnings in the meantime.
+Returns True if the definition was deferred.
+"""
+        if not (form and isinstance(form, tuple)
+                and isinstance(form[0], str)
+                and self.global_value(form[0]) == self.tl_def):
+            return False
+        args = list(cons_iter(form[1]))
+        if (len(args) != 2 or not isinstance(args[0], str)
+                or args[0] in self.global_names
+                or args[0] in self.global_names.cells):
+            return False
+        name, value = args
+        if not (value and isinstance(value, tuple)
+                and isinstance(value[0], str)):
+            return False
+        macro = self.global_value(value[0])
+        if not (macro and isinstance(macro, tuple)
+                and macro[0] == nil):
+            return False
+        entry = self.lazy_macros.get(id(macro))
+        if entry is None or entry[0] is not macro:
+            entry = self.lazy_macros[id(macro)] = (
+                macro, self.deferrable_macro(value[0], macro))
+        if entry[1] is None:
+            return False
+        plan, param_names = entry[1]
+        if not (plan.param_count is None
+                or plan.param_count == sum(1 for arg in cons_iter(value[1]))):
+            return False
+        self.lazy_params.update(param_names)
+        self.global_names[name] = LazyDefinition(
+            self, name, value, self.module_paths[-1])
+        return True
+
+    def force_definitions(self):
+        """Evaluate all the definitions that have been deferred."""
+        for value in list(self.global_names.values()):
+            if type(value) is LazyDefinition:
+                value.force()
+
+    def deferrable_macro(self, name, macro):
+        """Check whether calls to a global macro can be put off.
+
+Returns the macro's CallPlan and the parameter names of all the global
+functions its code can reach, or None if not.
+"""
+        if not (macro[1] and macro[1][1] and not macro[1][1][1]):
+            return None
+        params = macro[1][0]
+        plan = CallPlan(params, param_layout(params))
+        if plan.param_count == -1 or plan.shadowed(self.global_names):
+            # Calls would give an error or warning
+            return None
+        if self.side_effect(name) is not None:
+            return None
+        # The functions the macro calls warn if their parameters shadow
+        # a global name, so defining one of those names later has to
+        # force the deferred definitions too
+        digest, param_names = self.definition_digest(name)
+        if param_names is None:
+            return None
+        return plan, param_names
+
+    def global_value(self, name, default=unbound):
+        """Look up a global name, forcing its definition if deferred."""
+        value = self.global_names.get(name, default)
+        if type(value) is LazyDefinition:
+            value = value.force()
+        return value
+
     @macro
     def tl_comment(self, *args):
         return nil
@@ -592,7 +2805,13 @@ class Program:
 
     @macro
     def tl_restart(self):
-        self.__init__(repl=self.repl)
+        profiler = self.profiler
+        self.__init__(repl=self.repl, intrinsics=self.use_intrinsics,
+                      module_cache=self.module_cache,
+                      hash_cons=self.cons_table is not None,
+                      memo=self.memo_names, memo_size=self.memo_size,
+                      pure_macros=self.pure_macro_names, lazy=self.lazy)
+        self.profiler = profiler
         return "Restarting..."
 
     @macro
@@ -605,24 +2824,968 @@ class Program:
         return len(self.module_paths) > 1
 
 
+# Worker processes for pmap; each has its own Program, set up from an
+# image of the calling program's global environment, and the function
+# being mapped
+
+pmap_worker = None
+
+
+def pmap_init(image, use_intrinsics, function_refs, function_tables):
+    global pmap_worker
+    program = Program(intrinsics=use_intrinsics)
+    program.restore_image(image)
+    function = program.unflatten(function_refs, function_tables)[0]
+    pmap_worker = (program, function)
+
+
+def pmap_chunk(refs, tables):
+    program, function = pmap_worker
+    results = [program.call_value(function, [item])
+               for item in program.unflatten(refs, tables)]
+    output.flush()
+    return program.flatten(results)
+
+
+# Opcodes for the bytecode virtual machine used by VMProgram
+# A compiled block is a flat list of alternating opcodes and operands
+
+OP_CONST = 0    # Push the operand
+OP_LOAD = 1     # Push the value bound to the operand (a name)
+OP_CALL = 2     # Pop a head value and dispatch the operand (a CallSite)
+OP_APPLY = 3    # Pop a function and the operand's worth of args; apply it
+OP_BRANCH = 4   # Pop a value; if it is falsy, jump to the operand
+OP_DEFINE = 5   # Pop a value and bind the operand (a name) to it globally
+OP_RETURN = 6   # Resume the most recent continuation
+
+
+class CallSite:
+    """A list expression awaiting dispatch in the bytecode VM.
+
+Whether the arguments of a call get evaluated depends on whether the
+head turns out to be a function or a macro, which isn't known until
+the call happens. So only the head is compiled up front; the blocks
+for the other parts of the call are compiled the first time they
+are needed and then reused.
+"""
+    __slots__ = ("args", "argc", "top_level",
+                 "arg_block", "if_block", "def_block")
+
+    def __init__(self, code, top_level=False):
+        self.args = code[1]
+        self.argc = sum(1 for arg in cons_iter(code[1]))
+        self.top_level = top_level
+        self.arg_block = None
+        self.if_block = None
+        self.def_block = None
+
+
+# Number of calls the VM makes between checks of its memory use, when
+# that is limited
+
+HEAP_CHECK_CALLS = 10000
+
+
+class VMProgram(Program):
+    """A Program that evaluates code on a bytecode virtual machine.
+
+Expressions are compiled into blocks of bytecode and run with an
+explicit value stack and continuation stack. Calls don't use the
+Python stack, so recursion depth is limited only by memory, and any
+call whose continuation is a return (including the tail calls that
+Program.call eliminates through i and v) doesn't grow the stack.
+
+Evaluation can be limited to max_depth calls in progress at once, and
+to max_heap megabytes of memory for the whole process; going over a
+limit raises EvaluationLimit.
+"""
+
+    def __init__(self, repl=False, max_depth=None, max_heap=None,
+                 **options):
+        super().__init__(repl=repl, **options)
+        self.max_depth = max_depth
+        self.max_heap = max_heap
+        # Compiled function bodies, keyed by id(); each block is stored
+        # with its body, which keeps the id from being reused
+        self.blocks = {}
+
+    @macro
+    def tl_restart(self):
+        max_depth, max_heap = self.max_depth, self.max_heap
+        result = super().tl_restart()
+        self.max_depth, self.max_heap = max_depth, max_heap
+        return result
+
+    def check_heap(self):
+        used = memory_use()
+        if used is not None and used > self.max_heap * 1024 * 1024:
+            raise EvaluationLimit("memory use exceeded limit of %d MB"
+                                  % self.max_heap)
+
+    @function
+    def tl_eval(self, code, top_level=False):
+        # Top-level code has no parameters, so its scope is empty
+        return self.run(self.compile(code, top_level), {})
+
+    def compile(self, code, top_level=False):
+        """Compile an expression into a block of bytecode."""
+        block = []
+        self.compile_expr(code, block, top_level)
+        block += (OP_RETURN, None)
+        return block
+
+    def compile_expr(self, code, block, top_level=False):
+        if isinstance(code, tuple):
+            if code == nil:
+                # Nil evaluates to itself
+                block += (OP_CONST, nil)
+            else:
+                # Function/macro call: evaluate the head, then decide
+                # what to do with the arguments at run time
+                self.compile_expr(code[0], block)
+                block += (OP_CALL, CallSite(code, top_level))
+        elif isinstance(code, str):
+            block += (OP_LOAD, code)
+        else:
+            # Integers and builtins evaluate to themselves
+            block += (OP_CONST, code)
+
+    def body_block(self, body):
+        entry = self.blocks.get(id(body))
+        if entry is None:
+            if len(self.blocks) >= CODE_CACHE_SIZE:
+                self.blocks.clear()
+            entry = self.blocks[id(body)] = (body, self.compile(body))
+        return entry[1]
+
+    def arg_block(self, site):
+        """Block that evaluates a call's arguments and applies its head."""
+        if site.arg_block is None:
+            block = []
+            for arg in cons_iter(site.args):
+                self.compile_expr(arg, block)
+            block += (OP_APPLY, site.argc, OP_RETURN, None)
+            site.arg_block = block
+        return site.arg_block
+
+    def if_block(self, site):
+        """Block that evaluates the condition and one branch of an if."""
+        if site.if_block is None:
+            cond, trueval, falseval = cons_iter(site.args)
+            block = []
+            self.compile_expr(cond, block)
+            block += (OP_BRANCH, None)
+            branch = len(block) - 1
+            self.compile_expr(trueval, block)
+            block += (OP_RETURN, None)
+            block[branch] = len(block)
+            self.compile_expr(falseval, block)
+            block += (OP_RETURN, None)
+            site.if_block = block
+        return site.if_block
+
+    def def_block(self, site):
+        """Block that evaluates a definition's value and binds it."""
+        if site.def_block is None:
+            name, value = cons_iter(site.args)
+            block = []
+            self.compile_expr(value, block)
+            block += (OP_DEFINE, name, OP_RETURN, None)
+            site.def_block = block
+        return site.def_block
+
+    def run(self, block, frame):
+        """Execute a block of bytecode in a scope and return the result."""
+        global_names = self.global_names
+        builtin_plans = self.builtin_plans
+        tl_if = self.tl_if
+        tl_def = self.tl_def
+        tl_eval = self.tl_eval
+        stack = []
+        # Each continuation is a (block, pc, frame) triple to resume
+        continuations = []
+        max_depth = self.max_depth or sys.maxsize
+        # Memory use is checked every HEAP_CHECK_CALLS calls; without a
+        # limit, the count goes negative and never reaches zero
+        calls_left = HEAP_CHECK_CALLS if self.max_heap else -1
+        pc = 0
+        while True:
+            op = block[pc]
+            arg = block[pc + 1]
+            pc += 2
+            # When a call needs to run another block, it sets target to
+            # that block and scope to the frame to run it in
+            target = None
+            if op == OP_LOAD:
+                if arg in frame:
+                    stack.append(frame[arg])
+                elif arg in global_names:
+                    value = global_names[arg]
+                    if type(value) is LazyDefinition:
+                        value = value.force()
+                    stack.append(value)
+                else:
+                    self.error("referencing undefined name", arg)
+                    stack.append(nil)
+            elif op == OP_CONST:
+                stack.append(arg)
+            elif op == OP_CALL:
+                function = stack.pop()
+                site = arg
+                if function and isinstance(function, tuple):
+                    # User-defined function or macro
+                    if function[0] == nil:
+                        # Macro arguments stay unevaluated, so the body
+                        # can be entered right away
+                        if function[1] and function[1][1]:
+                            args = list(cons_iter(site.args))
+                            native = self.natives.get(id(function))
+                            scope = {}
+                            result = NotImplemented
+                            if native is not None and native[0] is function:
+                                result = self.call_native(
+                                    native, True, function[1][0], args)
+                            if result is not NotImplemented:
+                                stack.append(result)
+                            elif self.bind_params(True, function[1][0], args,
+                                                  scope):
+                                target = self.body_block(function[1][1][0])
+                            else:
+                                stack.append(nil)
+                        else:
+                            self.error("list too short to be interpreted as",
+                                       "macro")
+                            stack.append(nil)
+                    elif function[1]:
+                        # Function arguments are evaluated first, and
+                        # then OP_APPLY makes the call
+                        stack.append(function)
+                        target = self.arg_block(site)
+                        scope = frame
+                    else:
+                        self.error("list too short to be interpreted as",
+                                   "function")
+                        stack.append(nil)
+                elif function in builtin_plans:
+                    # Builtin function or macro
+                    if (builtin_plans[function].top_level_only
+                            and not site.top_level):
+                        self.error("call to", function.__name__,
+                                   "cannot be nested")
+                        stack.append(nil)
+                    elif not function.is_macro:
+                        stack.append(function)
+                        target = self.arg_block(site)
+                        scope = frame
+                    elif function == tl_if:
+                        if site.argc == 3:
+                            target = self.if_block(site)
+                            scope = frame
+                        else:
+                            self.error("wrong number of arguments for tl_if")
+                            stack.append(nil)
+                    elif function == tl_def:
+                        if site.argc != 2:
+                            self.error("wrong number of arguments for tl_def")
+                            stack.append(nil)
+                        elif not isinstance(site.args[0], str):
+                            self.error("cannot define",
+                                       self.tl_type(site.args[0]))
+                            stack.append(nil)
+                        elif site.args[0] in global_names:
+                            self.error("name", site.args[0], "already in use")
+                            stack.append(nil)
+                        else:
+                            if site.args[0] in self.lazy_params:
+                                self.force_definitions()
+                            target = self.def_block(site)
+                            scope = frame
+                    else:
+                        # Other macros don't evaluate anything, so they
+                        # can be called directly
+                        try:
+                            stack.append(function(*cons_iter(site.args)))
+                        except TypeError:
+                            self.error("wrong number of arguments for",
+                                       function.__name__)
+                            stack.append(nil)
+                else:
+                    # Trying to call an int or unevaluated name
+                    self.error(function, "is not a function or macro")
+                    stack.append(nil)
+            elif op == OP_APPLY:
+                if arg:
+                    args = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    args = []
+                function = stack.pop()
+                if isinstance(function, tuple):
+                    # User-defined function
+                    native = self.natives.get(id(function))
+                    scope = {}
+                    result = NotImplemented
+                    if native is not None and native[0] is function:
+                        result = self.call_native(native, False,
+                                                  function[0], args)
+                    if result is not NotImplemented:
+                        stack.append(result)
+                    elif self.bind_params(False, function[0], args, scope):
+                        target = self.body_block(function[1][0])
+                    else:
+                        stack.append(nil)
+                elif function == tl_eval:
+                    # Compile the argument and evaluate it in the
+                    # current scope
+                    try:
+                        target = self.compile(*args)
+                    except TypeError:
+                        self.error("wrong number of arguments for tl_eval")
+                        stack.append(nil)
+                    else:
+                        scope = frame
+                else:
+                    try:
+                        stack.append(function(*args))
+                    except TypeError:
+                        # Wrong number of arguments to builtin
+                        self.error("wrong number of arguments for",
+                                   function.__name__)
+                        stack.append(nil)
+            elif op == OP_BRANCH:
+                cond = stack.pop()
+                if cond == 0 or cond == nil:
+                    pc = arg
+            elif op == OP_RETURN:
+                if continuations:
+                    block, pc, frame = continuations.pop()
+                else:
+                    return stack.pop()
+            elif op == OP_DEFINE:
+                global_names[arg] = stack.pop()
+                stack.append(arg)
+            if target is not None:
+                # Save the current position to come back to, unless all
+                # that's left to do here is return
+                if block[pc] != OP_RETURN:
+                    continuations.append((block, pc, frame))
+                    if len(continuations) > max_depth:
+                        raise EvaluationLimit(
+                            "call depth exceeded limit of %d" % self.max_depth)
+                calls_left -= 1
+                if not calls_left:
+                    calls_left = HEAP_CHECK_CALLS
+                    self.check_heap()
+                block = target
+                pc = 0
+                frame = scope
+
+
+# Evaluation engines selectable from the command line
+
+engines = {"tree": Program,
+           "vm": VMProgram,
+           }
+
+
+# Support for Python modules generated by Transpiler
+
+class TailCall:
+    """A tail call returned by compiled code, to be made by trampoline."""
+    __slots__ = ("body", "args")
+
+    def __init__(self, body, args):
+        self.body = body
+        self.args = args
+
+
+def trampoline(result):
+    """Make tail calls returned by compiled code until a value results."""
+    while type(result) is TailCall:
+        result = result.body(*result.args)
+    return result
+
+
+def trampolined(body):
+    """Wrap compiled code that can return TailCalls for use as a native."""
+    def native(*args):
+        return trampoline(body(*args))
+    return native
+
+
+def cell_value(cell):
+    """Look up a global name from compiled code."""
+    value = cell.value
+    if value is unbound:
+        error("referencing undefined name", cell.name)
+        return nil
+    return value
+
+
+def to_source(value):
+    """Write tinylisp code that parses to a value equal to the given one.
+
+Raises ValueError if the value can't be written that way (for example,
+negative integers, names containing whitespace, and builtins).
+"""
+    if isinstance(value, int) and value >= 0:
+        return str(value)
+    elif (isinstance(value, str) and token_regex.fullmatch(value)
+            and value not in symbols and not value.isdigit()):
+        return value
+    elif isinstance(value, tuple):
+        return "(%s)" % " ".join(to_source(item) for item in cons_iter(value))
+    else:
+        raise ValueError("cannot write %r as tinylisp code" % (value,))
+
+
+def run_compiled(main):
+    """Run the main function of a module generated by Transpiler."""
+    try:
+        main()
+    except RecursionError:
+        error("recursion depth exceeded. How could you forget "
+              "to use tail calls?!")
+    except UserQuit:
+        pass
+
+
+def arg_count(code):
+    """Number of arguments in a list expression."""
+    return sum(1 for arg in cons_iter(code[1]))
+
+
+class CompiledFunction:
+    """A user-defined function or macro that Transpiler is compiling."""
+
+    def __init__(self, value, const, ident, fold_index):
+        self.value = value
+        self.const = const
+        self.ident = ident
+        # Position of the definition among the folded definitions
+        self.fold_index = fold_index
+        self.is_macro = value[0] == nil
+        if self.is_macro:
+            params, self.body = value[1][0], value[1][1][0]
+        else:
+            params, self.body = value[0], value[1][0]
+        self.variadic = isinstance(params, str)
+        self.names = [params] if self.variadic else list(cons_iter(params))
+        self.pvars = {name: "p%d" % index
+                      for index, name in enumerate(self.names)}
+        self.frame = "[%s]" % ", ".join(self.pvars.values())
+        self.layout = None
+        self.loops = False
+        self.returns_tail_calls = False
+
+    @staticmethod
+    def compilable(value):
+        """Check whether a value is a well-formed function or macro."""
+        if not (value and isinstance(value, tuple)):
+            return False
+        if value[0] == nil:
+            if not (value[1] and value[1][1]):
+                return False
+            params = value[1][0]
+        elif value[1]:
+            params = value[0]
+        else:
+            return False
+        if isinstance(params, str):
+            return True
+        elif isinstance(params, tuple):
+            names = list(cons_iter(params))
+            return (all(isinstance(name, str) for name in names)
+                    and len(set(names)) == len(names))
+        else:
+            return False
+
+    def takes(self, argc):
+        return self.variadic or argc == len(self.names)
+
+
+class Transpiler:
+    """Translates a tinylisp program into the source of a Python module.
+
+The top-level forms of the program are run at compile time in a
+separate environment, as far as that can be done without side effects:
+modules loaded at top level are inlined, and definitions whose values
+can be computed without any output are folded into constants. Each
+function or macro defined that way is translated into a Python function,
+with self tail calls as while loops, and registered as the native
+implementation of its value, so that it is used whether it is called
+from compiled code or from the interpreter. Other top-level forms are
+left to the interpreter at run time. Compiled code checks that the
+global names it relies on are still bound to what they were at compile
+time, and hands the call to the interpreter if not.
+"""
+
+    def __init__(self, intrinsics=True, module_cache=True):
+        self.intrinsics = intrinsics
+        self.env = Program(intrinsics=intrinsics, module_cache=module_cache)
+        self.env_builtins = {id(builtin): builtin
+                             for builtin in self.env.builtins}
+        self.builtin_plans = {plan.name: plan
+                              for plan in self.env.builtin_plans.values()}
+        self.sources = []
+        # Module-level definitions of constants, cells, builtins and
+        # layouts, keyed by the code that defines them
+        self.constants = {}
+        self.cells = {}
+        self.builtin_idents = {}
+        self.layouts = {}
+        # Folded definition values, keyed by id(), each with the function
+        # compiled from it (if any); and the names defined by folding,
+        # in order
+        self.folded = {}
+        self.functions = []
+        self.folded_names = {}
+        # Lines of the module's main function, and the forms waiting to
+        # be added to it for the interpreter
+        self.main = []
+        self.pending = []
+        self.folding = True
+
+    def add_file(self, filename):
+        try:
+            code_file = open(filename)
+        except FileNotFoundError:
+            error("could not find", filename)
+        except IOError:
+            error("could not read", filename)
+        else:
+            with code_file:
+                self.sources.append(filename)
+                self.add_forms(read_forms(code_file), 1)
+            self.flush(1)
+
+    def add_forms(self, forms, depth):
+        for form in forms:
+            if self.folding and (self.add_load(form, depth)
+                                 or self.add_definition(form, depth)):
+                continue
+            self.pending.append(form)
+            if self.top_level_builtin(form) != "tl_comment":
+                # The form could change the global names at run time
+                # without changing them in the compile-time environment,
+                # so nothing after it can be folded
+                self.folding = False
+
+    def emit(self, depth, line):
+        self.main.append((depth, line))
+
+    def flush(self, depth):
+        """Add the pending forms to main, to be run by the interpreter."""
+        if self.pending:
+            self.emit(depth, "program.execute(%s)"
+                      % self.constant(to_cons(self.pending)))
+            self.pending = []
+
+    def top_level_builtin(self, form):
+        """The builtin that a top-level form calls, if any."""
+        if form and isinstance(form, tuple) and isinstance(form[0], str):
+            value = self.env.global_names.get(form[0])
+            if id(value) in self.env_builtins:
+                return value.__name__
+
+    def add_load(self, form, depth):
+        """Inline a module loaded at top level."""
+        if self.top_level_builtin(form) != "tl_load":
+            return False
+        args = list(cons_iter(form[1]))
+        if len(args) != 1 or not isinstance(args[0], str):
+            return False
+        module = args[0]
+        if not module.endswith(".tl"):
+            module += ".tl"
+        abspath = os.path.abspath(os.path.join(self.env.module_paths[-1],
+                                               module))
+        module_directory = os.path.dirname(abspath)
+        if abspath in self.env.modules:
+            # Already loaded, so the load does nothing
+            return True
+        try:
+            forms = read_module(abspath, self.env.module_cache)
+        except (FileNotFoundError, IOError):
+            # Leave the error message for run time
+            return False
+        self.flush(depth)
+        self.env.modules.append(abspath)
+        self.env.module_paths.append(module_directory)
+        self.emit(depth, "program.modules.append(%r)" % abspath)
+        self.emit(depth, "program.module_paths.append(%r)"
+                  % module_directory)
+        self.add_forms(forms, depth)
+        self.flush(depth)
+        self.emit(depth, "program.module_paths.pop()")
+        self.env.module_paths.pop()
+        # Library functions that have intrinsics are left to them
+        self.emit(depth, "program.register_intrinsics()")
+        self.env.register_intrinsics()
+        for function in self.functions:
+            if id(function.value) in self.env.natives:
+                self.folded[id(function.value)] = (function.value, None)
+        self.functions = [function for function in self.functions
+                          if id(function.value) not in self.env.natives]
+        return True
+
+    def add_definition(self, form, depth):
+        """Fold a top-level definition if it has no side effects."""
+        if self.top_level_builtin(form) != "tl_def":
+            return False
+        args = list(cons_iter(form[1]))
+        if (len(args) != 2 or not isinstance(args[0], str)
+                or args[0] in self.env.global_names):
+            return False
+        name = args[0]
+        name_count = len(self.env.global_names)
+        text = io.StringIO()
+        with redirect_stdout(text), redirect_stderr(text):
+            try:
+                self.env.execute((form, nil))
+            except RecursionError:
+                return False
+            finally:
+                output.flush()
+        if (text.getvalue() or name not in self.env.global_names
+                or len(self.env.global_names) != name_count + 1):
+            return False
+        value = self.env.global_names[name]
+        try:
+            literal = self.literal(value)
+        except ValueError:
+            return False
+        self.flush(depth)
+        self.emit(depth, "define(%r, %r, %s, %r)"
+                  % (form[0], name, literal, to_source(form)))
+        self.folded_names[name] = len(self.folded_names)
+        if isinstance(value, tuple) and id(value) not in self.folded:
+            function = None
+            if CompiledFunction.compilable(value):
+                function = CompiledFunction(value, literal,
+                                            "F%d" % len(self.folded),
+                                            self.folded_names[name])
+                self.functions.append(function)
+            self.folded[id(value)] = (value, function)
+        return True
+
+    def constant(self, value):
+        """Name of a module-level constant equal to a tuple value."""
+        code = to_source(value)
+        if code not in self.constants:
+            self.constants[code] = "K%d" % len(self.constants)
+        return self.constants[code]
+
+    def literal(self, value):
+        """Python expression for a value."""
+        if isinstance(value, (int, str)):
+            return repr(value)
+        elif isinstance(value, tuple):
+            return "()" if value == nil else self.constant(value)
+        elif id(value) in self.env_builtins:
+            return self.builtin(value.__name__)
+        else:
+            raise ValueError("cannot compile %r" % (value,))
+
+    def cell(self, name):
+        if name not in self.cells:
+            self.cells[name] = "C%d" % len(self.cells)
+        return self.cells[name]
+
+    def builtin(self, func_name):
+        if func_name not in self.builtin_idents:
+            self.builtin_idents[func_name] = "B_" + func_name
+        return self.builtin_idents[func_name]
+
+    def layout(self, function):
+        layout = repr(param_layout(function.value[1][0] if function.is_macro
+                                   else function.value[0]))
+        if layout not in self.layouts:
+            self.layouts[layout] = "L%d" % len(self.layouts)
+        return self.layouts[layout]
+
+    def compile_function(self, function):
+        """Translate a function or macro into a Python function."""
+        self.function = function
+        function.layout = self.layout(function)
+        body = self.tail(function.body, 2)
+        kind = "macro" if function.is_macro else "function"
+        lines = [(0, "def %s(%s):" % (function.ident,
+                                       ", ".join(function.pvars.values()))),
+                 (1, "# %s" % self.describe(function))]
+        if function.loops:
+            lines.append((1, "while True:"))
+            depth = 2
+        else:
+            depth = 1
+            body = [(line_depth - 1, line) for line_depth, line in body]
+        for name in function.names:
+            lines.append((depth, "if %r in G:" % name))
+            lines.append((depth + 1, "warn(%r, 'parameter name shadows "
+                                     "global name', %r)" % (kind, name)))
+        return lines + body
+
+    def describe(self, function):
+        """The names a compiled function was defined under."""
+        names = [name for name, value in self.env.global_names.items()
+                 if value is function.value]
+        return ", ".join(names)
+
+    def classify(self, head, argc):
+        """Work out how to compile a call, based on its head.
+
+Returns a guard expression that has to be true at run time for the
+compiled call to be valid (or None if it is always valid), the kind of
+call, and what is being called.
+"""
+        if not isinstance(head, str) or head in self.function.pvars:
+            return None, None, None
+        value = self.env.global_names.get(head, unbound)
+        if id(value) in self.env_builtins:
+            func_name = value.__name__
+            target = self.builtin(func_name)
+            if self.bound_before(head):
+                guard = None
+            else:
+                guard = "%s.value is %s" % (self.cell(head), target)
+            if func_name == "tl_if" and argc == 3:
+                return guard, "if", target
+            elif func_name == "tl_quote" and argc == 1:
+                return guard, "quote", target
+            elif func_name == "tl_eval" and argc == 1:
+                return guard, "eval", target
+            elif (not value.is_macro
+                    and func_name not in top_level_only_fns
+                    and self.builtin_plans[func_name].takes(argc)):
+                return guard, "builtin", target
+        elif id(value) in self.folded:
+            function = self.folded[id(value)][1]
+            if function is not None and function.takes(argc):
+                if self.bound_before(head):
+                    guard = None
+                else:
+                    guard = "%s.value is %s" % (self.cell(head),
+                                                function.const)
+                return guard, "call", function
+        return None, None, None
+
+    def bound_before(self, name):
+        """Check whether a name is bound whenever the function runs.
+
+Builtin names can't be redefined, and names folded before the function
+was defined are bound to the same values at run time as at compile time
+by the time the function can be called. Other names need checking.
+"""
+        return (name in builtins.values()
+                or self.folded_names.get(name, len(self.folded_names))
+                <= self.function.fold_index)
+
+    def args(self, code, function=None):
+        """Python expressions for the arguments of a call."""
+        if function is not None and function.is_macro:
+            args = [self.literal(arg) for arg in cons_iter(code[1])]
+        else:
+            args = [self.expr(arg) for arg in cons_iter(code[1])]
+        if function is not None and function.variadic:
+            if len(args) > 10:
+                return ["to_cons([%s])" % ", ".join(args)]
+            return ["".join("(%s, " % arg for arg in args)
+                    + "()" + ")" * len(args)]
+        return args
+
+    def dynamic(self, code):
+        """Python expression that leaves a call to the interpreter."""
+        function = self.function
+        if isinstance(code[0], str):
+            return ("program.dynamic_call(%s, %s, lambda: [%s], %s, %s)"
+                    % (self.expr(code[0]), self.literal(code),
+                       ", ".join(self.args(code)),
+                       function.layout, function.frame))
+        else:
+            return ("program.eval_in(%s, %s, %s)"
+                    % (self.literal(code), function.layout, function.frame))
+
+    def expr(self, code):
+        """Python expression for a tinylisp expression."""
+        if isinstance(code, tuple):
+            if code == nil:
+                return "()"
+            guard, kind, target = self.classify(code[0], arg_count(code))
+            args = list(cons_iter(code[1]))
+            if kind == "if":
+                result = ("(%s if %s not in (0, ()) else %s)"
+                          % (self.expr(args[1]), self.expr(args[0]),
+                             self.expr(args[2])))
+            elif kind == "quote":
+                result = self.literal(args[0])
+            elif kind == "eval":
+                result = ("program.eval_in(%s, %s, %s)"
+                          % (self.expr(args[0]), self.function.layout,
+                             self.function.frame))
+            elif kind == "builtin":
+                result = "%s(%s)" % (target, ", ".join(self.args(code)))
+            elif kind == "call":
+                result = ("\0%s\0(%s(%s))"
+                          % (target.ident, target.ident,
+                             ", ".join(self.args(code, target))))
+            else:
+                return self.dynamic(code)
+            if guard is None:
+                return result
+            return "(%s if %s else %s)" % (result, guard, self.dynamic(code))
+        elif isinstance(code, str):
+            if code in self.function.pvars:
+                return self.function.pvars[code]
+            elif self.bound_before(code):
+                return "%s.value" % self.cell(code)
+            return "cell_value(%s)" % self.cell(code)
+        else:
+            return self.literal(code)
+
+    def tail(self, code, depth):
+        """Python statements that return the value of an expression."""
+        if not (code and isinstance(code, tuple)):
+            return [(depth, "return %s" % self.expr(code))]
+        guard, kind, target = self.classify(code[0], arg_count(code))
+        if guard is not None:
+            # The compiled call goes in a branch of its own, with the
+            # interpreter to fall back on
+            return ([(depth, "if %s:" % guard)]
+                    + self.tail_call(code, kind, target, depth + 1)
+                    + [(depth, "else:"),
+                       (depth + 1, "return %s" % self.dynamic(code))])
+        return self.tail_call(code, kind, target, depth)
+
+    def tail_call(self, code, kind, target, depth):
+        function = self.function
+        if kind == "if":
+            cond, trueval, falseval = cons_iter(code[1])
+            return ([(depth, "if %s not in (0, ()):" % self.expr(cond))]
+                    + self.tail(trueval, depth + 1)
+                    + [(depth, "else:")]
+                    + self.tail(falseval, depth + 1))
+        elif kind == "call" and target is function:
+            # Self tail call; loop with the new arguments
+            function.loops = True
+            lines = []
+            if function.names:
+                lines.append((depth, "%s = %s"
+                              % (", ".join(function.pvars.values()),
+                                 ", ".join(self.args(code, target)))))
+            lines.append((depth, "continue"))
+            return lines
+        elif kind == "call":
+            # Tail call to another compiled function; the trampoline
+            # makes it once this one has returned
+            function.returns_tail_calls = True
+            return [(depth, "return TailCall(%s, (%s,))"
+                     % (target.ident, ", ".join(self.args(code, target))))]
+        elif kind is None:
+            return [(depth, "return %s" % self.dynamic(code))]
+        else:
+            return [(depth, "return %s" % self.expr(code))]
+
+    def module_source(self):
+        """Put together the source code of the Python module."""
+        function_lines = []
+        for function in self.functions:
+            function_lines.append("")
+            function_lines.append("")
+            function_lines += ["    " * depth + line for depth, line
+                               in self.compile_function(function)]
+        functions = "\n".join(function_lines)
+        # Calls to functions that can return tail calls need a
+        # trampoline; the others can be made directly
+        for function in self.functions:
+            functions = functions.replace(
+                "\0%s\0" % function.ident,
+                "trampoline" if function.returns_tail_calls else "")
+        header = ['#!/usr/bin/python3',
+                  '# Generated by tinylisp.py --compile from: %s'
+                  % ", ".join(self.sources),
+                  '',
+                  'import sys',
+                  'sys.path.insert(0, %r)'
+                  % os.path.abspath(os.path.dirname(__file__)),
+                  'from tinylisp import (Program, TailCall, trampoline, '
+                  'trampolined,',
+                  '                      cell_value, parse_forms, to_cons, '
+                  'run_compiled, warn)',
+                  '',
+                  'program = Program(intrinsics=%r)' % self.intrinsics,
+                  'G = program.global_names',
+                  'B = {builtin.__name__: builtin '
+                  'for builtin in program.builtins}',
+                  '',
+                  '',
+                  'def value(code):',
+                  '    return next(parse_forms(code))',
+                  '',
+                  '',
+                  'def define(head, name, data, code):',
+                  '    if G.get(head) is B["tl_def"]:',
+                  '        program.tl_def(name, ("q", (data, ())))',
+                  '    else:',
+                  '        program.execute(code)',
+                  '',
+                  '']
+        header += ["%s = value(%r)" % (ident, code)
+                   for code, ident in self.constants.items()]
+        header += ["%s = G.cell(%r)" % (ident, name)
+                   for name, ident in self.cells.items()]
+        header += ["%s = B[%r]" % (ident, func_name)
+                   for func_name, ident in self.builtin_idents.items()]
+        header += ["%s = %s" % (ident, layout)
+                   for layout, ident in self.layouts.items()]
+        natives = []
+        for function in self.functions:
+            native = function.ident
+            if function.returns_tail_calls:
+                native = "trampolined(%s)" % native
+            param_count = (None if function.variadic
+                           else len(function.names))
+            natives.append("program.natives[id(%s)] = (%s, %s, %r)"
+                           % (function.const, function.const, native,
+                              param_count))
+        main = ["def main():"]
+        main += ["    " * depth + line for depth, line in self.main]
+        if len(main) == 1:
+            main.append("    pass")
+        footer = ['',
+                  '',
+                  'if __name__ == "__main__":',
+                  '    run_compiled(main)',
+                  '']
+        return "\n".join(header + [functions, "", ""] + natives + ["", ""]
+                         + main + footer)
+
+
 def run_file(filename, environment=None):
     if environment is None:
         environment = Program(repl=False)
     try:
-        with open(filename) as f:
-            code = f.read()
+        if filename == "-":
+            # Read the code from stdin
+            code_file = sys.stdin
+        else:
+            code_file = open(filename)
     except FileNotFoundError:
         error("could not find", filename)
     except IOError:
         error("could not read", filename)
     else:
         try:
-            environment.execute(code)
+            environment.execute(code_file)
         except RecursionError:
             error("recursion depth exceeded. How could you forget "
                   "to use tail calls?!")
+        except EvaluationLimit as err:
+            error(err)
         except UserQuit:
             pass
+        finally:
+            if code_file is not sys.stdin:
+                code_file.close()
 
 
 def repl(environment=None):
@@ -638,16 +3801,20 @@ def repl(environment=None):
         except RecursionError:
             error("recursion depth exceeded. How could you forget "
                   "to use tail calls?!")
+        except EvaluationLimit as err:
+            error(err)
         except UserQuit:
             break
         except Exception as err:
             error(err)
             break
         instruction = input_instruction()
+    output.flush()
     print("Bye!")
 
 
 def input_instruction():
+    output.flush()
     try:
         instruction = input("tl> ")
     except (EOFError, KeyboardInterrupt):
@@ -655,6 +3822,154 @@ def input_instruction():
     return instruction
 
 
+# Default number of seconds that a request to the evaluation server can
+# run for
+
+SERVE_TIMEOUT = 10.0
+
+
+def serve(environment, lines, send, timeout=SERVE_TIMEOUT):
+    """Answer evaluation requests, one JSON object per line.
+
+Each request is an object with the code to run as "code", and optionally
+a time limit in seconds as "timeout" and an "id" to copy to the
+response. The response is passed to send as a line of JSON.
+"""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            response = {"id": None, "status": "invalid", "error": str(err)}
+        else:
+            response = serve_request(environment, request, timeout)
+        send(json.dumps(response) + "\n")
+
+
+def serve_request(environment, request, timeout=SERVE_TIMEOUT):
+    """Run the code of a request and return the response.
+
+The code runs in a forked copy of the environment, so that nothing it
+does carries over to later requests, and is killed if it runs for
+longer than the time limit. The response has the status of the request
+("ok", "timeout", "failed" or "invalid"), the text written to stdout and
+stderr, the value of the last expression and the time taken in
+milliseconds (as "time_ms").
+"""
+    if not isinstance(request, dict):
+        return {"id": None, "status": "invalid",
+                "error": "request is not an object"}
+    response = {"id": request.get("id")}
+    code = request.get("code")
+    timeout = request.get("timeout", timeout)
+    if not isinstance(code, str):
+        response.update(status="invalid", error="code is not a string")
+        return response
+    if (not isinstance(timeout, (int, float)) or isinstance(timeout, bool)
+            or timeout <= 0):
+        response.update(status="invalid",
+                        error="timeout is not a positive number")
+        return response
+    start = time.perf_counter()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # In the child process: run the code and send back the results
+        try:
+            os.close(read_end)
+            data = json.dumps(run_request(environment, code)).encode()
+            with os.fdopen(write_end, "wb") as pipe:
+                pipe.write(data)
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    chunks = []
+    timed_out = False
+    deadline = start + timeout
+    with os.fdopen(read_end, "rb", buffering=0) as pipe:
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not select.select([pipe], [], [],
+                                                   remaining)[0]:
+                os.kill(pid, signal.SIGKILL)
+                timed_out = True
+                break
+            chunk = pipe.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    os.waitpid(pid, 0)
+    if timed_out:
+        response.update(status="timeout", stdout="", stderr="", result=None)
+    elif chunks:
+        response.update(json.loads(b"".join(chunks)))
+    else:
+        # The child process died without giving results
+        response.update(status="failed", stdout="", stderr="", result=None)
+    response["time_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return response
+
+
+def run_request(environment, code):
+    """Run code for serve_request, capturing its output."""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = "ok"
+    result = nil
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            result = environment.execute(code)
+        except RecursionError:
+            error("recursion depth exceeded. How could you forget "
+                  "to use tail calls?!")
+            status = "failed"
+        except EvaluationLimit as err:
+            error(err)
+            status = "failed"
+        except UserQuit:
+            pass
+        except Exception as err:
+            error(err)
+            status = "failed"
+        finally:
+            output.flush()
+    return {"status": status,
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+            "result": display_text(result) if status == "ok" else None}
+
+
+# Forking and Unix sockets aren't available on every platform (such as
+# Windows); --serve --socket checks for the server class before using it
+if (hasattr(socketserver, "ForkingMixIn")
+        and hasattr(socketserver, "UnixStreamServer")):
+    class EvaluationServer(socketserver.ForkingMixIn,
+                           socketserver.UnixStreamServer):
+        """Evaluation server that listens on a Unix socket.
+
+Each connection is handled in a process of its own, which answers the
+requests sent on it with serve.
+"""
+
+        def __init__(self, path, environment, timeout=SERVE_TIMEOUT):
+            self.environment = environment
+            self.timeout_seconds = timeout
+            super().__init__(path, EvaluationHandler)
+
+
+class EvaluationHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lines = (line.decode("utf-8", "replace") for line in self.rfile)
+
+        def send(text):
+            self.wfile.write(text.encode())
+            self.wfile.flush()
+
+        serve(self.server.environment, lines, send,
+              self.server.timeout_seconds)
+
+
 help_text = """
 Enter expressions at the prompt.
 
@@ -694,6 +4009,10 @@ Builtin functions and macros:
 - type. Takes a value and returns its type, one of Int, Name, List, or
      Builtin.
 - disp. Takes a value and writes it to stdout.
+- pmap. Takes a function and a list, and returns a list of the results
+     of calling the function on each item. The calls are made in
+     parallel by worker processes, in chunks of the size given by an
+     optional third argument.
 - load (macro). Takes a filename and evaluates that file as code.
 
 You can create your own functions and macros. (A macro is like a
@@ -721,11 +4040,217 @@ Special commands for the interactive prompt:
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        # User specified one or more files--run them
-        environment = Program()
-        for filename in sys.argv[1:]:
-            run_file(filename, environment)
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-e",
+                           "--engine",
+                           help="evaluation engine: tree-walking "
+                                "interpreter (default) or bytecode VM",
+                           choices=engines,
+                           default="tree")
+    argparser.add_argument("filenames",
+                           help="code files to run, or - for stdin (omit "
+                                "to start the interactive prompt)",
+                           nargs="*")
+    argparser.add_argument("--no-intrinsics",
+                           help="run standard library functions as "
+                                "tinylisp code instead of native code",
+                           dest="intrinsics",
+                           action="store_false")
+    argparser.add_argument("--no-cache",
+                           help="parse library modules from source "
+                                "without reading or writing the "
+                                "module cache",
+                           dest="module_cache",
+                           action="store_false")
+    argparser.add_argument("--lazy",
+                           help="only evaluate the definitions in library "
+                                "modules when the names they define are "
+                                "first used",
+                           action="store_true")
+    argparser.add_argument("--flush",
+                           help="when to write out the output of disp: "
+                                "after each value, only at exit (or when "
+                                "a lot of it has collected), or auto (after "
+                                "each value if stdout is a terminal; the "
+                                "default)",
+                           choices=Output.policies,
+                           default="auto")
+    argparser.add_argument("--hash-cons",
+                           help="share the cells of equal lists built "
+                                "with c, which makes comparing them fast",
+                           action="store_true")
+    argparser.add_argument("--memo",
+                           help="cache the results of the global function "
+                                "with this name (can be given more than "
+                                "once)",
+                           metavar="NAME",
+                           action="append",
+                           default=[])
+    argparser.add_argument("--memo-size",
+                           help="maximum number of results to cache for "
+                                "each memoized function (default: %d)"
+                                % MEMO_SIZE,
+                           metavar="N",
+                           type=int,
+                           default=MEMO_SIZE)
+    argparser.add_argument("--pure-macro",
+                           help="cache the result of each call of the "
+                                "global macro with this name, which must "
+                                "depend only on the call's arguments (can "
+                                "be given more than once)",
+                           metavar="NAME",
+                           dest="pure_macros",
+                           action="append",
+                           default=[])
+    argparser.add_argument("--image",
+                           help="start from the global environment saved "
+                                "in an image file instead of from scratch")
+    argparser.add_argument("--save-image",
+                           help="after running, save the global "
+                                "environment to an image file")
+    argparser.add_argument("--profile",
+                           help="report the calls and running time of "
+                                "each function on stderr after running",
+                           action="store_true")
+    argparser.add_argument("--profile-json",
+                           help="write the profile to a JSON file "
+                                "instead of reporting it")
+    argparser.add_argument("--serve",
+                           help="run the code files once, then answer "
+                                "requests to run code, given as lines of "
+                                "JSON on stdin, in copies of the resulting "
+                                "environment",
+                           action="store_true")
+    argparser.add_argument("--socket",
+                           help="with --serve, take requests on "
+                                "connections to a Unix socket at this path "
+                                "instead of on stdin")
+    argparser.add_argument("--timeout",
+                           help="with --serve, the default time limit for "
+                                "a request in seconds (default: %g)"
+                                % SERVE_TIMEOUT,
+                           type=float,
+                           default=SERVE_TIMEOUT)
+    argparser.add_argument("--max-depth",
+                           help="with -e vm, the most calls that can be "
+                                "in progress at once (default: no limit)",
+                           metavar="N",
+                           type=int)
+    argparser.add_argument("--max-heap",
+                           help="with -e vm, stop evaluating when the "
+                                "interpreter uses more than this many "
+                                "megabytes of memory (default: no limit)",
+                           metavar="MB",
+                           type=int)
+    argparser.add_argument("--compile",
+                           help="translate the code files to a Python "
+                                "module instead of running them",
+                           action="store_true")
+    argparser.add_argument("-o",
+                           "--output",
+                           help="file to write the compiled module to "
+                                "(default: stdout)")
+    options = argparser.parse_args()
+    output.policy = options.flush
+    engine = engines[options.engine]
+    engine_options = {"intrinsics": options.intrinsics,
+                      "module_cache": options.module_cache}
+    profiling = options.profile or options.profile_json
+    if profiling and (options.compile or options.engine != "tree"):
+        argparser.error("profiling is only supported by the tree engine")
+    if options.memo and (options.compile or options.engine != "tree"):
+        argparser.error("--memo is only supported by the tree engine")
+    if options.pure_macros and (options.compile or options.engine != "tree"):
+        argparser.error("--pure-macro is only supported by the tree engine")
+    if options.hash_cons and options.compile:
+        argparser.error("--hash-cons can't be used with --compile")
+    if options.lazy and options.compile:
+        argparser.error("--lazy can't be used with --compile")
+    if options.serve:
+        if options.compile or profiling:
+            argparser.error("--serve can't be used with --compile or "
+                            "profiling")
+        if not hasattr(os, "fork"):
+            argparser.error("--serve needs os.fork, which this platform "
+                            "doesn't have")
+        if options.socket and not hasattr(socketserver, "UnixStreamServer"):
+            argparser.error("--socket needs Unix sockets, which this "
+                            "platform doesn't have")
+        if options.timeout <= 0:
+            argparser.error("--timeout must be positive")
+    elif options.socket:
+        argparser.error("--socket can only be used with --serve")
+    if options.max_depth is not None or options.max_heap is not None:
+        if options.compile or options.engine != "vm":
+            argparser.error("--max-depth and --max-heap are only supported "
+                            "by the vm engine")
+        if options.max_depth is not None and options.max_depth < 1:
+            argparser.error("--max-depth must be positive")
+        if options.max_heap is not None and options.max_heap < 1:
+            argparser.error("--max-heap must be positive")
+        engine_options.update(max_depth=options.max_depth,
+                              max_heap=options.max_heap)
+    if options.compile:
+        # Translate the files into a single Python module
+        if not options.filenames:
+            argparser.error("--compile needs at least one code file")
+        transpiler = Transpiler(**engine_options)
+        for filename in options.filenames:
+            transpiler.add_file(filename)
+        if options.output:
+            with open(options.output, "w") as output_file:
+                output_file.write(transpiler.module_source())
+        else:
+            write(transpiler.module_source())
     else:
-        # No filename specified, so...
-        repl()
+        # Served requests never echo values the way the prompt does
+        environment = engine(repl=not (options.filenames or options.serve),
+                             hash_cons=options.hash_cons,
+                             memo=options.memo, memo_size=options.memo_size,
+                             pure_macros=options.pure_macros,
+                             lazy=options.lazy, **engine_options)
+        if options.image and not environment.load_image(options.image):
+            sys.exit(1)
+        if profiling:
+            environment.profiler = Profiler(environment)
+        if options.serve:
+            # Set up the environment; its output would get mixed up with
+            # the responses, so it goes to stderr
+            with redirect_stdout(sys.stderr):
+                for filename in options.filenames:
+                    run_file(filename, environment)
+                output.flush()
+            if options.socket:
+                try:
+                    server = EvaluationServer(options.socket, environment,
+                                              options.timeout)
+                except OSError as err:
+                    error("could not listen on", options.socket + ":",
+                          err.strerror)
+                    sys.exit(1)
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    server.server_close()
+                    os.remove(options.socket)
+            else:
+                def send(text):
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+
+                serve(environment, sys.stdin, send, options.timeout)
+        elif options.filenames:
+            # User specified one or more files--run them
+            for filename in options.filenames:
+                run_file(filename, environment)
+        else:
+            # No filename specified, so...
+            repl(environment)
+        if options.save_image:
+            environment.save_image(options.save_image)
+        if options.profile_json:
+            environment.profiler.write_json(options.profile_json)
+        elif options.profile:
+            environment.profiler.report()